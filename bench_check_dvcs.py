@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+# Benchmarks the full check_dvcs.main path on synthetic PRs served by a local GitHub stand-in.
+# Run with: ./bench_check_dvcs.py [--commits 10,1000] [--comments 0,100] [--placements first,none] [-- <check_dvcs.py options>]
+# or ./bench_check_dvcs.py --parsing 100,1000 to compare the memory of decoding pages of commits at once and streamed.
+
+import argparse
+import io
+import json
+import statistics
+import threading
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ
+from sys import argv
+from typing import Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import check_dvcs
+
+_REPOSITORY = "owner/repo"
+_PULL_NUMBER = 1
+_JIRA = "AAP-1234"
+_BOT_LOGIN = "github-actions[bot]"
+_DEFAULT_PER_PAGE = 30
+_MAX_PER_PAGE = 100
+_RATE_LIMIT = 5000
+_DEFAULT_COMMITS = (10, 1000, 10000)
+_DEFAULT_COMMENTS = (0, 100, 1000)
+_PLACEMENTS = ("first", "last", "none")
+_READ_SIZE = 64 * 1024
+
+
+class PullRequestData:
+    # The commits and comments of one synthetic PR. The key is in the oldest commit (first), the newest commit (last) or in no commit (none).
+    # GitHub's pulls/{number}/commits stops at 250 commits, the stand-in doesn't so the paging and decision paths can be measured at any size.
+
+    def __init__(self, commits: int, comments: int, placement: str):
+        self.commits = [self.commit(index, self.commit_message(index, commits, placement)) for index in range(commits)]
+        # Other people's discussion, followed by the results comment of the previous run
+        self.comments = {index: f"Review comment {index}\n\n" + "Looks good to me. " * 10 for index in range(1, comments)}
+        if comments:
+            self.comments[comments] = f"{check_dvcs.comment_preamble}\n* previous results"
+        self.next_comment_id = comments + 1
+
+    @staticmethod
+    def commit_message(index: int, commits: int, placement: str) -> str:
+        position = {"first": 0, "last": commits - 1}.get(placement)
+        summary = f"{_JIRA} Change number {index}" if index == position else f"Change number {index}"
+        return f"{summary}\n\n" + "Some details about the change. " * 5
+
+    @staticmethod
+    def commit(index: int, message: str) -> dict:
+        # About the size of a real commit object, a lot of the payload GitHub returns is URLs and people
+        sha = f"{index:040x}"
+        person = {"name": "Some One", "email": "some.one@example.com", "date": "2024-01-01T00:00:00Z"}
+        user = {"login": "someone", "id": 1, "type": "User", "url": "https://api.github.com/users/someone"}
+        return {
+            "sha": sha,
+            "url": f"https://api.github.com/repos/{_REPOSITORY}/commits/{sha}",
+            "html_url": f"https://github.com/{_REPOSITORY}/commit/{sha}",
+            "commit": {"author": person, "committer": person, "message": message, "tree": {"sha": sha}, "comment_count": 0},
+            "author": user,
+            "committer": user,
+            "parents": [{"sha": f"{index - 1:040x}"}] if index else [],
+        }
+
+    def comment(self, base_url: str, comment_id: int) -> dict:
+        # The results comments are made by the workflow's token
+        body = self.comments[comment_id]
+        user = {"login": _BOT_LOGIN, "id": 2, "type": "Bot"} if body.startswith(check_dvcs.comment_preamble) else {"login": "someone", "id": 1, "type": "User"}
+        return {
+            "id": comment_id,
+            "url": f"{base_url}/repos/{_REPOSITORY}/issues/comments/{comment_id}",
+            "body": body,
+            "user": user,
+            "created_at": f"2024-01-01T00:00:{comment_id % 60:02d}Z",
+        }
+
+
+class GitHubStandIn(ThreadingHTTPServer):
+    # A local stand-in for the parts of the GitHub REST API check_dvcs uses.
+    # Lists are paginated with Link headers and every response carries the X-RateLimit-* headers of a shrinking budget.
+    daemon_threads = True
+
+    def __init__(self, data: PullRequestData, rate_limit: int = _RATE_LIMIT):
+        super().__init__(("127.0.0.1", 0), GitHubHandler)
+        self.data = data
+        self.base_url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.rate_limit = rate_limit
+        self.rate_limit_reset = int(time.time()) + 3600
+        self.requests: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def count(self, method: str) -> int:
+        # Returns the budget left after this request
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            return self.rate_limit - sum(self.requests.values())
+
+    def pull_request(self) -> dict:
+        return {
+            "number": _PULL_NUMBER,
+            "title": f"{_JIRA} A synthetic PR",
+            "head": {"ref": f"{_JIRA}-synthetic-branch", "sha": f"{len(self.data.commits):040x}"},
+            "base": {"ref": "main", "sha": "0" * 40, "repo": {"full_name": _REPOSITORY, "url": f"{self.base_url}/repos/{_REPOSITORY}"}},
+            "_links": {
+                "comments": {"href": f"{self.base_url}/repos/{_REPOSITORY}/issues/{_PULL_NUMBER}/comments"},
+                "commits": {"href": f"{self.base_url}/repos/{_REPOSITORY}/pulls/{_PULL_NUMBER}/commits"},
+            },
+        }
+
+
+class GitHubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: GitHubStandIn
+
+    def send_json(self, status: int, payload=None, headers: Optional[dict] = None, remaining: int = 0) -> None:
+        body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-RateLimit-Limit", str(self.server.rate_limit))
+        self.send_header("X-RateLimit-Remaining", str(max(0, remaining)))
+        self.send_header("X-RateLimit-Reset", str(self.server.rate_limit_reset))
+        self.send_header("X-RateLimit-Resource", "core")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_page(self, items: list, remaining: int) -> None:
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        per_page = min(int(query.get("per_page", [_DEFAULT_PER_PAGE])[0]), _MAX_PER_PAGE)
+        page = int(query.get("page", [1])[0])
+        last_page = max(1, -(-len(items) // per_page))
+        links = {"next": page + 1, "last": last_page} if page < last_page else {}
+        if page > 1:
+            links.update({"first": 1, "prev": page - 1})
+        link = ", ".join(
+            f'<{self.server.base_url}{url.path}?{urlencode({"per_page": per_page, "page": number})}>; rel="{rel}"' for rel, number in links.items()
+        )
+        self.send_json(200, items[(page - 1) * per_page : page * per_page], {"Link": link} if link else None, remaining)
+
+    def read_body(self) -> dict:
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+    def route(self, method: str) -> None:
+        remaining = self.server.count(method)
+        if remaining < 0:
+            self.send_json(403, {"message": "API rate limit exceeded"}, remaining=0)
+            return
+        data = self.server.data
+        path = urlparse(self.path).path
+        comments_path = f"/repos/{_REPOSITORY}/issues/{_PULL_NUMBER}/comments"
+        comment_prefix = f"/repos/{_REPOSITORY}/issues/comments/"
+        if method == "GET" and path == f"/repos/{_REPOSITORY}/pulls/{_PULL_NUMBER}/commits":
+            self.send_page(data.commits, remaining)
+        elif method == "GET" and path == comments_path:
+            self.send_page([data.comment(self.server.base_url, comment_id) for comment_id in sorted(data.comments)], remaining)
+        elif method == "POST" and path == comments_path:
+            with self.server.lock:
+                comment_id = data.next_comment_id
+                data.next_comment_id += 1
+                data.comments[comment_id] = self.read_body()["body"]
+            self.send_json(201, data.comment(self.server.base_url, comment_id), remaining=remaining)
+        elif path.startswith(comment_prefix) and path[len(comment_prefix) :].isdigit():
+            comment_id = int(path[len(comment_prefix) :])
+            if comment_id not in data.comments:
+                self.send_json(404, {"message": "Not Found"}, remaining=remaining)
+            elif method == "DELETE":
+                data.comments.pop(comment_id, None)
+                self.send_json(204, remaining=remaining)
+            elif method == "PATCH":
+                data.comments[comment_id] = self.read_body()["body"]
+                self.send_json(200, data.comment(self.server.base_url, comment_id), remaining=remaining)
+            else:
+                self.send_json(200, data.comment(self.server.base_url, comment_id), remaining=remaining)
+        else:
+            self.send_json(404, {"message": "Not Found"}, remaining=remaining)
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PATCH(self):
+        self.route("PATCH")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+    def log_message(self, *args):
+        pass
+
+
+def run_once(commits: int, comments: int, placement: str, check_args: list[str], trace_memory: bool = False) -> dict:
+    # Runs check_dvcs.main once against a fresh stand-in, the log is thrown away
+    server = GitHubStandIn(PullRequestData(commits, comments, placement))
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    environment = {"PULL_REQUEST": json.dumps(server.pull_request()), "GH_TOKEN": "benchmark", "GITHUB_STEP_SUMMARY": ""}
+    saved_environment = {name: environ.get(name) for name in environment}
+    environ.update(environment)
+    passed = True
+    try:
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            with redirect_stdout(io.StringIO()):
+                check_dvcs.main(check_args)
+        except SystemExit as e:
+            passed = e.code in (None, 0)
+        seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        for name, value in saved_environment.items():
+            if value is None:
+                environ.pop(name, None)
+            else:
+                environ[name] = value
+        server.shutdown()
+        server.server_close()
+    return {"seconds": seconds, "requests": dict(server.requests), "peak_bytes": peak, "passed": passed}
+
+
+def run_scenario(commits: int, comments: int, placement: str, check_args: list[str], repeat: int = 3) -> dict:
+    # The latency is the median of the untraced runs, tracemalloc slows everything down so the peak memory comes from one more run
+    runs = [run_once(commits, comments, placement, check_args) for _ in range(max(1, repeat))]
+    traced = run_once(commits, comments, placement, check_args, trace_memory=True)
+    return {
+        "commits": commits,
+        "comments": comments,
+        "placement": placement,
+        "seconds": statistics.median(run["seconds"] for run in runs),
+        "requests": runs[0]["requests"],
+        "peak_bytes": traced["peak_bytes"],
+        "passed": runs[0]["passed"],
+    }
+
+
+def measure_parsing(commits: int) -> dict:
+    # Peak memory of getting the commit messages out of a single page of `commits` commits,
+    # decoding the whole page at once (like response.json()) and one commit at a time (check_dvcs.iter_json_array)
+    body = json.dumps([PullRequestData.commit(index, PullRequestData.commit_message(index, commits, "none")) for index in range(commits)]).encode()
+
+    def chunks():
+        # Like reading the body from the connection
+        for start in range(0, len(body), _READ_SIZE):
+            yield body[start : start + _READ_SIZE]
+
+    peaks = {}
+    for mode, decode in (("full", lambda: json.loads(body)), ("streamed", lambda: check_dvcs.iter_json_array(chunks()))):
+        tracemalloc.start()
+        try:
+            messages = sum(1 for commit in decode() if len(commit["parents"]) <= 1 and commit["commit"]["message"])
+            peaks[mode] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {"commits": commits, "page_bytes": len(body), "messages": messages, "full_peak_bytes": peaks["full"], "streamed_peak_bytes": peaks["streamed"]}
+
+
+def format_row(result: dict) -> str:
+    requests = ", ".join(f"{method}: {count}" for method, count in sorted(result["requests"].items()))
+    return (
+        f"{result['commits']:>7} {result['comments']:>8} {result['placement']:>9} {result['seconds']:>9.3f} "
+        f"{sum(result['requests'].values()):>8} {result['peak_bytes'] / 1024 / 1024:>9.1f}  {'passed' if result['passed'] else 'failed':<6}  {requests}"
+    )
+
+
+def parse_sizes(value: str) -> list[int]:
+    return [int(size) for size in value.split(",") if size.strip()]
+
+
+def main(args: list[str]) -> list[dict]:
+    parser = argparse.ArgumentParser(description="Benchmark check_dvcs.py on synthetic PRs served by a local GitHub stand-in")
+    parser.add_argument("--commits", type=parse_sizes, default=list(_DEFAULT_COMMITS), help="Comma separated numbers of commits (default: %(default)s)")
+    parser.add_argument(
+        "--comments", type=parse_sizes, default=list(_DEFAULT_COMMENTS), help="Comma separated numbers of prior comments (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--placements",
+        type=lambda value: [placement for placement in value.split(",") if placement.strip()],
+        default=list(_PLACEMENTS),
+        help=f"Comma separated commits holding the JIRA key, any of {', '.join(_PLACEMENTS)} (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--parsing",
+        type=parse_sizes,
+        help="Instead of the scenarios, compare the peak memory of decoding pages of this many commits at once and streamed",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per scenario (default: %(default)s)")
+    parser.add_argument("--json", help="File to write the results to as JSON lines")
+    parser.add_argument("check_args", nargs="*", help="Options passed on to check_dvcs.py, after a --")
+    args = parser.parse_args(args)
+
+    results = []
+    if args.parsing:
+        print(f"{'commits':>7} {'page MB':>9} {'full MB':>9} {'streamed MB':>11}")
+        for commits in args.parsing:
+            result = measure_parsing(commits)
+            mb = 1024 * 1024
+            print(
+                f"{commits:>7} {result['page_bytes'] / mb:>9.2f} {result['full_peak_bytes'] / mb:>9.2f} {result['streamed_peak_bytes'] / mb:>11.2f}",
+                flush=True,
+            )
+            results.append(result)
+    else:
+        print(f"{'commits':>7} {'comments':>8} {'placement':>9} {'seconds':>9} {'requests':>8} {'peak MB':>9}  result  by method")
+        for commits in args.commits:
+            for comments in args.comments:
+                for placement in args.placements:
+                    result = run_scenario(commits, comments, placement, args.check_args, args.repeat)
+                    print(format_row(result), flush=True)
+                    results.append(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json_file.writelines(json.dumps(result) + "\n" for result in results)
+    return results
+
+
+if __name__ == "__main__":
+    main(argv[1:])
@@ -1,17 +1,134 @@
 #!/usr/bin/env python
 
+# The action runs this for every PR event, so only cheap modules are imported up front.
+# requests, concurrent.futures, subprocess, csv and friends are imported where they are used.
+from __future__ import annotations
+
 import argparse
+import base64
+import codecs
+import copy
+import hashlib
 import json
+import json as jsonlib  # For the sessions' request(json=...), which hides the module name
+import logging
+import os
 import re
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, redirect_stdout
 from os import getenv
 from sys import argv, exit
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional, TextIO, Union
+from urllib.parse import parse_qs, urlencode, urljoin, urlparse, urlsplit
+
+if TYPE_CHECKING:
+    import requests
 
-import requests
+    Response = Union[requests.Response, "UrllibResponse"]
+
+logger = logging.getLogger("check_dvcs")
 
 _NO_JIRA_MARKER = "NO_JIRA"
-_AAP_RE = "aap-[0-9]+"
+_DEFAULT_JIRA_PROJECTS = ("AAP",)
+_JIRA_PROJECT_RE = re.compile(r"^[A-Za-z][A-Za-z0-9_]*$")
+_COMMITS_PER_PAGE = 100
+_COMMENTS_PER_PAGE = 100
+_PULLS_PER_PAGE = 100
+_DEFAULT_TIMEOUT = 10.0
+_DEFAULT_MAX_RETRIES = 3
+_RETRY_BACKOFF_FACTOR = 0.5
+_RETRY_STATUSES = (500, 502, 503, 504)
+_POOL_SIZE = 10
+_IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE"])
+# GET and HEAD requests follow these like requests does, i.e. to the new name of a renamed repository
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 30
+_TRANSPORT_AUTO = "auto"
+_TRANSPORT_REQUESTS = "requests"
+_TRANSPORT_URLLIB = "urllib"
+_DEFAULT_DELETE_CONCURRENCY = 4
+_COMMENT_MODE_REPLACE = "replace"
+_COMMENT_MODE_UPSERT = "upsert"
+_OUTPUT_MODE_COMMENT = "comment"
+_OUTPUT_MODE_CHECK_RUN = "check-run"
+_CHECK_RUN_NAME = "DVCS PR Check"
+_LOG_FORMAT_TEXT = "text"
+_LOG_FORMAT_JSON = "json"
+# The attributes every LogRecord has, anything else was passed in with extra= and goes into the JSON lines as a field
+_LOG_RECORD_ATTRIBUTES = frozenset(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+_BACKEND_REST = "rest"
+_BACKEND_GRAPHQL = "graphql"
+_DEFAULT_GRAPHQL_URL = "https://api.github.com/graphql"
+_GRAPHQL_PAGE_SIZE = 100
+_COMMIT_SOURCE_API = "api"
+_COMMIT_SOURCE_GIT = "git"
+_GIT_READ_SIZE = 64 * 1024
+_JSON_READ_SIZE = 64 * 1024
+_JSON_WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+# What can follow a number, true, false or null in an array
+_JSON_SCALAR_END_RE = re.compile(r"[ \t\n\r,\]]")
+# Bump when the results change for the same inputs, so results stored by older versions aren't reused
+_STATE_VERSION = 1
+_STATE_RE = re.compile(r"<!-- dvcs-state: (\{.*?\}) -->")
+_DEFAULT_GITHUB_API_URL = "https://api.github.com"
+_DEFAULT_AUDIT_CONCURRENCY = 16
+_AUDIT_FIELDS = [
+    "repository",
+    "number",
+    "url",
+    "title",
+    "source_branch",
+    "passed",
+    "title_jira",
+    "source_branch_jira",
+    "commit_jiras",
+    "error",
+    "results",
+]
+_DEFAULT_CACHE_MAX_BYTES = 50 * 1024 * 1024
+_JIRA_KEYS_PER_QUERY = 100
+_DEFAULT_JIRA_CACHE_TTL = 6 * 60 * 60
+_DEFAULT_JIRA_CACHE_SIZE = 10000
+_JIRA_CACHE_VERSION = 1
+_JIRA_STATUS_OPEN = "open"
+_JIRA_STATUS_CLOSED = "closed"
+_JIRA_STATUS_MISSING = "missing"
+# Response headers which are needed to use a cached body again (i.e. pagination)
+_CACHED_HEADERS = ("Content-Type", "Link")
+_SNAPSHOT_EXCHANGES = "exchanges.jsonl"
+_SNAPSHOT_PULL_REQUEST = "pull_request.json"
+_SNAPSHOT_SKIPPED_HEADERS = frozenset(["content-encoding", "content-length", "transfer-encoding"])
+# Pace once fewer than this share of the rate limit is left (100 of a token's 5000, 20 of a GITHUB_TOKEN's 1000)
+_DEFAULT_RATE_LIMIT_RESERVE_SHARE = 0.02
+# A single process can't know how many calls other runs make, so a paced call never waits longer than this
+_RATE_LIMIT_MAX_PACING = 2.0
+_DEFAULT_RATE_LIMIT_MAX_WAIT = 300.0
+_RATE_LIMIT_RETRIES = 2
+_SECONDARY_RATE_LIMIT_WAIT = 60.0
 comment_preamble = "DVCS PR Check Results:"
+_GRAPHQL_PULL_REQUEST_QUERY = """
+query($owner: String!, $name: String!, $number: Int!, $pageSize: Int!,
+      $withCommits: Boolean!, $commitsCursor: String, $withComments: Boolean!, $commentsCursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      title
+      headRefName
+      commits(first: $pageSize, after: $commitsCursor) @include(if: $withCommits) {
+        pageInfo { hasNextPage endCursor }
+        nodes { commit { message parents { totalCount } } }
+      }
+      comments(first: $pageSize, after: $commentsCursor) @include(if: $withComments) {
+        pageInfo { hasNextPage endCursor }
+        nodes { databaseId body createdAt author { __typename login } }
+      }
+    }
+  }
+}
+"""
 good_icon = "✅"
 bad_icon = "❌"
 http_headers = {
@@ -24,155 +141,2075 @@ class CommandException(Exception):
     pass
 
 
-def get_previous_comments_urls(comments_url) -> list[str]:
-    # Load the existing comments
-    print("Getting comments ... ", end="")
-    comments = requests.get(comments_url)
-    print(comments.status_code)
-    if comments.status_code != 200:
-        raise CommandException("Failed to get existing comments!")
+class StdoutHandler(logging.Handler):
+    # Looks sys.stdout up on every record so redirect_stdout (and pytest's capsys) see the log
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            sys.stdout.write(self.format(record) + "\n")
+            sys.stdout.flush()
+        except Exception:
+            self.handleError(record)
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line for log pipelines
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S%z"),
+            "level": record.levelname.lower(),
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in record.__dict__.items() if key not in _LOG_RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(verbose: bool = False, log_format: str = _LOG_FORMAT_TEXT) -> None:
+    # The default level only logs summaries, verbose adds every comment and commit message that was looked at
+    handler = StdoutHandler()
+    handler.setFormatter(JsonFormatter() if log_format == _LOG_FORMAT_JSON else logging.Formatter("%(message)s"))
+    logger.handlers = [handler]
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+    logger.propagate = False
+
+
+def write_json_atomically(path: str, payload: object) -> None:
+    # Write to a temporary file next to path first, so a concurrent reader never sees a partial file
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as json_file:
+            json.dump(payload, json_file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class HttpCache:
+    # An on disk cache of GET responses keyed by URL. Each entry keeps the ETag/Last-Modified validators so the
+    # next request can be made conditional, GitHub doesn't count 304 Not Modified responses against the rate limit.
+    # The directory is bounded to max_bytes, the least recently used entries are evicted first.
+
+    def __init__(self, directory: str, max_bytes: int = _DEFAULT_CACHE_MAX_BYTES):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+    def get(self, url: str) -> Optional[dict]:
+        path = self._path(url)
+        try:
+            with open(path, encoding="utf-8") as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+        if entry.get("url") != url:
+            return None
+        # Reading an entry makes it the most recently used one, unless another thread evicted it in the meantime
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def put(self, url: str, etag: Optional[str], last_modified: Optional[str], headers: dict, body: str) -> None:
+        entry = {"url": url, "etag": etag, "last_modified": last_modified, "headers": headers, "body": body}
+        write_json_atomically(self._path(url), entry)
+        self.evict()
+
+    def evict(self) -> None:
+        # Several threads share the cache, an entry another thread evicted first is skipped
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+class RateLimiter:
+    # Keeps track of the GitHub rate limit budget from the X-RateLimit-* headers of every response.
+    # Once fewer than `reserve` requests (by default a share of X-RateLimit-Limit) are left the remaining ones are paced
+    # evenly until the budget resets, but no paced request waits longer than _RATE_LIMIT_MAX_PACING.
+    # Rate limited responses (including secondary limits) tell the caller how long to wait before retrying,
+    # nothing ever waits longer than max_wait, we rather fail than block the runner.
+
+    def __init__(
+        self,
+        reserve: Optional[int] = None,
+        max_wait: float = _DEFAULT_RATE_LIMIT_MAX_WAIT,
+        clock=time.time,
+        sleep=time.sleep,
+    ):
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._budgets: dict[str, dict] = {}
+        self._next_request_at = 0.0
+
+    @staticmethod
+    def _resource(url: str) -> str:
+        # REST and GraphQL calls are counted against separate budgets
+        return "graphql" if urlparse(url).path.endswith("/graphql") else "core"
+
+    def wait(self, url: str) -> None:
+        with self._lock:
+            budget = self._budgets.get(self._resource(url))
+            if budget is None:
+                return
+            reserve = self.reserve if self.reserve is not None else budget["limit"] * _DEFAULT_RATE_LIMIT_RESERVE_SHARE
+            if budget["remaining"] >= reserve:
+                return
+            now = self.clock()
+            until_reset = budget["reset"] - now
+            if until_reset <= 0:
+                return
+            if budget["remaining"] <= 0:
+                delay = until_reset
+            else:
+                # Hand out evenly spaced slots so concurrent requests are paced as well
+                start = max(now, self._next_request_at)
+                self._next_request_at = start + min(until_reset / budget["remaining"], _RATE_LIMIT_MAX_PACING)
+                delay = start - now
+            budget["remaining"] = max(0, budget["remaining"] - 1)
+        if 0 < delay <= self.max_wait:
+            logger.warning("Only %d GitHub API requests left, waiting %.1f seconds", budget["remaining"], delay)
+            self.sleep(delay)
+
+    def update(self, url: str, response: Response) -> Optional[float]:
+        # Record the budget from the response, returns how long to wait before retrying a rate limited response
+        headers = response.headers
+        if "X-RateLimit-Remaining" in headers and "X-RateLimit-Reset" in headers:
+            limit = int(headers.get("X-RateLimit-Limit", 0))
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset = int(headers["X-RateLimit-Reset"])
+            used = int(headers.get("X-RateLimit-Used", limit - remaining))
+            # A 304 Not Modified response is not counted against the budget
+            charged = 0 if response.status_code == 304 else 1
+            with self._lock:
+                resource = self._resource(url)
+                budget = self._budgets.get(resource)
+                if budget is None or budget["reset"] != reset:
+                    # First response or a new rate limit window, carry over what we used in the old one
+                    carried = 0 if budget is None else budget["carried"] + budget["max_used"] - budget["base_used"]
+                    budget = {"carried": carried, "base_used": used - charged, "max_used": used}
+                    self._budgets[resource] = budget
+                budget.update(limit=limit, remaining=remaining, reset=reset, max_used=max(budget["max_used"], used))
+
+        if response.status_code not in (403, 429):
+            return None
+        if "Retry-After" in headers:
+            delay = float(headers["Retry-After"])
+        elif headers.get("X-RateLimit-Remaining") == "0":
+            delay = max(0.0, int(headers["X-RateLimit-Reset"]) - self.clock()) + 1
+        elif "secondary rate limit" in response.text.lower():
+            delay = _SECONDARY_RATE_LIMIT_WAIT
+        else:
+            return None
+        return delay if delay <= self.max_wait else None
+
+    def used(self) -> dict[str, int]:
+        with self._lock:
+            return {resource: budget["carried"] + budget["max_used"] - budget["base_used"] for resource, budget in self._budgets.items()}
+
+    def report(self) -> str:
+        used = self.used()
+        if len(used) == 0:
+            return "GitHub API budget: no rate limit information received"
+        with self._lock:
+            return "GitHub API budget: " + ", ".join(
+                f"{resource} used {used[resource]} ({budget['remaining']} of {budget['limit']} left, "
+                f"resets at {time.strftime('%H:%M:%S', time.gmtime(budget['reset']))} UTC)"
+                for resource, budget in sorted(self._budgets.items())
+            )
+
+
+class Metrics:
+    # Wall-clock time and GitHub API traffic of each phase of a run. Phases entered on different threads can overlap,
+    # requests count towards the phase of their thread, or the phase entered last for (pool) threads without one.
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.phases: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._latest_phase = "setup"
+        self._local = threading.local()
+
+    @property
+    def current_phase(self) -> str:
+        return getattr(self._local, "phase", None) or self._latest_phase
+
+    def set_thread_phase(self, name: Optional[str]) -> None:
+        # Count the requests of this thread towards `name`, i.e. as the initializer of a thread pool working for a phase
+        self._local.phase = name
+
+    def _phase(self, name: str) -> dict:
+        return self.phases.setdefault(name, {"seconds": 0.0, "requests": 0, "bytes_sent": 0, "bytes_received": 0, "statuses": {}})
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        previous_thread_phase, previous_latest_phase = getattr(self._local, "phase", None), self._latest_phase
+        self._local.phase = self._latest_phase = name
+        started = self.clock()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phase(name)["seconds"] += self.clock() - started
+            self._local.phase = previous_thread_phase
+            self._latest_phase = previous_latest_phase
+
+    def record(self, response: Response, received: Optional[int] = None) -> None:
+        # received is the size of a streamed body, which is not kept in the response
+        body = getattr(response.request, "body", None) or b""
+        with self._lock:
+            phase = self._phase(self.current_phase)
+            phase["requests"] += 1
+            phase["bytes_sent"] += len(body.encode("utf-8") if isinstance(body, str) else body)
+            phase["bytes_received"] += len(response.content or b"") if received is None else received
+            status = str(response.status_code)
+            phase["statuses"][status] = phase["statuses"].get(status, 0) + 1
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            phases = {name: {**phase, "statuses": dict(phase["statuses"])} for name, phase in self.phases.items()}
+        totals = {"seconds": self.clock() - self.started, "requests": 0, "bytes_sent": 0, "bytes_received": 0, "statuses": {}}
+        for phase in phases.values():
+            for key in ("requests", "bytes_sent", "bytes_received"):
+                totals[key] += phase[key]
+            for status, count in phase["statuses"].items():
+                totals["statuses"][status] = totals["statuses"].get(status, 0) + count
+        return {**totals, "phases": phases}
+
+    def render_summary(self) -> str:
+        metrics = self.to_dict()
+        lines = [
+            "### DVCS check metrics",
+            "",
+            "| Phase | Seconds | Requests | Bytes sent | Bytes received | Status codes |",
+            "| --- | ---: | ---: | ---: | ---: | --- |",
+        ]
+        for name, phase in [*metrics["phases"].items(), ("**total**", metrics)]:
+            statuses = ", ".join(f"{status}: {count}" for status, count in sorted(phase["statuses"].items()))
+            lines.append(f"| {name} | {phase['seconds']:.2f} | {phase['requests']} | {phase['bytes_sent']} | {phase['bytes_received']} | {statuses} |")
+        return "\n".join(lines) + "\n"
+
+    def write(self, summary_path: Optional[str] = None, metrics_file: Optional[str] = None) -> None:
+        # The summary is appended, other steps of the job write to the same file
+        try:
+            if summary_path:
+                with open(summary_path, "a", encoding="utf-8") as summary:
+                    summary.write(self.render_summary())
+            if metrics_file:
+                with open(metrics_file, "w", encoding="utf-8") as metrics:
+                    json.dump(self.to_dict(), metrics, indent=2)
+        except OSError as e:
+            logger.warning("Failed to write the metrics: %s", e)
+
+
+def build_url(url: str, params: Optional[dict] = None) -> str:
+    if not params:
+        return url
+    return f"{url}{'&' if urlsplit(url).query else '?'}{urlencode(params)}"
+
+
+def parse_links(link_header: Optional[str]) -> dict[str, dict[str, str]]:
+    # The Link header GitHub paginates with, in the shape of requests.Response.links
+    links = {}
+    for match in re.finditer(r'<([^>]*)>\s*;\s*rel="([^"]*)"', link_header or ""):
+        links[match.group(2)] = {"url": match.group(1), "rel": match.group(2)}
+    return links
+
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator:
+    # Decode a JSON array from chunks of its UTF-8 text one item at a time, only the item being decoded is kept in memory
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    expecting = "["
+    for chunk, final in _with_final(chunks):
+        buffer = buffer[position:] + text_decoder.decode(chunk, final)
+        position = 0
+        while True:
+            position = _JSON_WHITESPACE_RE.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            char = buffer[position]
+            if expecting == "[":
+                if char != "[":
+                    raise ValueError(f"Expected a JSON array, got {buffer[position:position + 20]!r}")
+                expecting = "item or ]"
+            elif expecting == "end":
+                raise ValueError(f"Extra data after the JSON array: {buffer[position:position + 20]!r}")
+            elif char == "]" and expecting in ("item or ]", ", or ]"):
+                expecting = "end"
+            elif expecting == ", or ]":
+                if char != ",":
+                    raise ValueError(f"Expected , or ] in the JSON array, got {buffer[position:position + 20]!r}")
+                expecting = "item"
+            else:
+                # A number, true, false or null is only complete once what follows it was read,
+                # [1. would otherwise be decoded as 1 before the rest of 1.5 arrived
+                if char not in '"{[' and not final and _JSON_SCALAR_END_RE.search(buffer, position) is None:
+                    break
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break
+                yield item
+                position = end
+                expecting = ", or ]"
+                continue
+            position += 1
+    if expecting != "end":
+        raise ValueError("The JSON array ended early")
+
+
+def _with_final(chunks: Iterable[bytes]) -> Iterator[tuple[bytes, bool]]:
+    # The chunks, flagging the last one. An empty last chunk follows so the flag is always set
+    for chunk in chunks:
+        yield chunk, False
+    yield b"", True
+
+
+class Headers(dict):
+    # A dict of HTTP headers with case insensitive names, i.e. headers["etag"] is headers["ETag"]. The names keep the case they were set with.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._names: dict[str, str] = {}
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, name: str, value: str) -> None:
+        if name.lower() in self._names:
+            super().__delitem__(self._names[name.lower()])
+        self._names[name.lower()] = name
+        super().__setitem__(name, value)
+
+    def __getitem__(self, name: str) -> str:
+        return super().__getitem__(self._names.get(name.lower(), name))
+
+    def __contains__(self, name: object) -> bool:
+        return isinstance(name, str) and name.lower() in self._names
+
+    def __delitem__(self, name: str) -> None:
+        super().__delitem__(self._names.pop(name.lower(), name))
+
+    def get(self, name: str, default=None):
+        return self[name] if name in self else default
+
+    def update(self, *args, **kwargs) -> None:
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+
+class UrllibRequest:
+    def __init__(self, method: str, url: str, body: Optional[bytes]):
+        self.method = method
+        self.url = url
+        self.body = body
+
+
+class UrllibResponse:
+    # The parts of requests.Response the rest of this module uses.
+    # A streamed response (content is None) reads its body from raw, release hands the connection back once it has been read.
+
+    def __init__(
+        self,
+        request: UrllibRequest,
+        status_code: int,
+        headers: Headers,
+        content: Optional[bytes],
+        raw=None,
+        release: Optional[Callable[[bool], None]] = None,
+    ):
+        self.request = request
+        self.url = request.url
+        self.status_code = status_code
+        self.headers = headers
+        self._content = content
+        self.raw = raw
+        self._release = release
+        self._consumed = False
+        self.encoding: Optional[str] = None
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None:
+            self._content = b"".join(self.iter_content(_JSON_READ_SIZE))
+        return self._content
+
+    def iter_content(self, chunk_size: int = 1) -> Iterator[bytes]:
+        if self._content is not None:
+            for start in range(0, len(self._content), chunk_size):
+                yield self._content[start : start + chunk_size]
+            return
+        if self._consumed:
+            raise RuntimeError("The content of this response was already consumed")
+        self._consumed = True
+        finished = False
+        try:
+            while True:
+                chunk = self.raw.read(chunk_size)
+                if not chunk:
+                    finished = True
+                    return
+                yield chunk
+        finally:
+            # A connection with unread data in it can't be used for another request
+            self.close(finished)
+
+    def close(self, reusable: bool = False) -> None:
+        release, self._release = self._release, None
+        if release is not None:
+            release(reusable)
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or "utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    @property
+    def links(self) -> dict[str, dict[str, str]]:
+        return parse_links(self.headers.get("Link"))
+
+
+class UrllibSession:
+    # A minimal requests.Session built on http.client, so the action doesn't have to pip install anything.
+    # Up to pool_size idle keep-alive connections are kept per host. Like the requests transport, idempotent
+    # requests are retried with an exponential backoff on 5xx responses and connection errors.
+
+    def __init__(self, pool_size: int = _POOL_SIZE, max_retries: int = _DEFAULT_MAX_RETRIES):
+        self.headers = Headers()
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.connections_opened = 0
+        self._idle: dict[tuple[str, str], list] = {}
+        self._lock = threading.Lock()
+        self._ssl_context = None
+
+    def _connect(self, scheme: str, netloc: str, timeout: Optional[float]):
+        import http.client
+        import urllib.request
+
+        proxy = None if urllib.request.proxy_bypass(netloc) else urllib.request.getproxies().get(scheme)
+        proxy_url = urlsplit(proxy if proxy is None or "://" in proxy else f"http://{proxy}")
+        host = proxy_url.netloc.rpartition("@")[2] if proxy else netloc
+        if scheme == "https":
+            if self._ssl_context is None:
+                import ssl
+
+                self._ssl_context = ssl.create_default_context()
+            connection = http.client.HTTPSConnection(host, timeout=timeout, context=self._ssl_context)
+            if proxy:
+                headers = {}
+                if proxy_url.username:
+                    credentials = f"{proxy_url.username}:{proxy_url.password or ''}".encode("utf-8")
+                    headers["Proxy-Authorization"] = f"Basic {base64.b64encode(credentials).decode('ascii')}"
+                connection.set_tunnel(netloc, headers=headers)
+        else:
+            connection = http.client.HTTPConnection(host, timeout=timeout)
+        # Plain HTTP through a proxy sends the full URL in the request line
+        connection.absolute_urls = bool(proxy) and scheme == "http"
+        with self._lock:
+            self.connections_opened += 1
+        return connection
+
+    def _checkout(self, key: tuple[str, str], timeout: Optional[float]) -> tuple:
+        with self._lock:
+            idle = self._idle.get(key)
+            connection = idle.pop() if idle else None
+        if connection is None:
+            return self._connect(key[0], key[1], timeout), False
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection, True
+
+    def _release(self, key: tuple[str, str], connection, reusable: bool) -> None:
+        if reusable:
+            self._checkin(key, connection)
+        else:
+            connection.close()
+
+    def _checkin(self, key: tuple[str, str], connection) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        params: Optional[dict] = None,
+        json: Optional[object] = None,
+        headers: Optional[dict] = None,
+        timeout: Optional[float] = None,
+        stream: bool = False,
+    ) -> UrllibResponse:
+        url = build_url(url, params)
+        request_headers = Headers(self.headers)
+        request_headers.update(headers or {})
+        body = None
+        if json is not None:
+            body = jsonlib.dumps(json).encode("utf-8")
+            request_headers["Content-Type"] = "application/json"
+        for _ in range(_MAX_REDIRECTS):
+            response = self._send(method, url, body, request_headers, timeout, stream)
+            location = response.headers.get("Location")
+            if method not in ("GET", "HEAD") or response.status_code not in _REDIRECT_STATUSES or not location:
+                return response
+            response.close()
+            redirect_url = urljoin(url, location)
+            if urlsplit(redirect_url)[:2] != urlsplit(url)[:2] and "Authorization" in request_headers:
+                # Like requests, the token is not sent to another host
+                del request_headers["Authorization"]
+            url = redirect_url
+        raise ConnectionError(f"{method} {url} failed: Exceeded {_MAX_REDIRECTS} redirects")
+
+    def _send(self, method: str, url: str, body: Optional[bytes], request_headers: Headers, timeout: Optional[float], stream: bool) -> UrllibResponse:
+        import http.client
+
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.netloc:
+            raise ValueError(f"Invalid URL {url!r}: No scheme supplied")
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+
+        key = (parts.scheme, parts.netloc)
+        retries = 0
+        while True:
+            connection, reused = self._checkout(key, timeout)
+            try:
+                connection.request(method, url if connection.absolute_urls else path, body=body, headers=dict(request_headers))
+                raw_response = connection.getresponse()
+                retry = method in _IDEMPOTENT_METHODS and raw_response.status in _RETRY_STATUSES and retries < self.max_retries
+                content = None if stream and not retry else raw_response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                if reused and isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)):
+                    # The server closed the idle keep-alive connection, that's not a failure of the request
+                    continue
+                # Nothing was sent if the connection was refused, so even a POST can be tried again
+                if retries >= self.max_retries or (method not in _IDEMPOTENT_METHODS and not isinstance(e, ConnectionRefusedError)):
+                    raise ConnectionError(f"{method} {url} failed: {e}") from e
+                retries += 1
+                self._backoff(retries)
+                continue
+
+            request = UrllibRequest(method, url, body)
+            if content is None:
+
+                def release(reusable: bool, connection=connection, raw_response=raw_response) -> None:
+                    self._release(key, connection, reusable and not raw_response.will_close)
+
+                return UrllibResponse(request, raw_response.status, Headers(raw_response.getheaders()), None, raw_response, release)
+
+            self._release(key, connection, not raw_response.will_close)
+            response = UrllibResponse(request, raw_response.status, Headers(raw_response.getheaders()), content)
+            if retry:
+                retries += 1
+                self._backoff(retries)
+                continue
+            return response
+
+    @staticmethod
+    def _backoff(retries: int) -> None:
+        # The same schedule as urllib3: no wait before the first retry, then backoff_factor * 2^(retries - 1)
+        if retries > 1:
+            time.sleep(_RETRY_BACKOFF_FACTOR * 2 ** (retries - 1))
+
+    def close(self) -> None:
+        with self._lock:
+            idle_connections = [connection for idle in self._idle.values() for connection in idle]
+            self._idle.clear()
+        for connection in idle_connections:
+            connection.close()
+
+
+def create_requests_session(pool_size: int = _POOL_SIZE, max_retries: int = _DEFAULT_MAX_RETRIES):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=_RETRY_BACKOFF_FACTOR,
+        status_forcelist=_RETRY_STATUSES,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
-    response = []
-    for comment in comments.json():
-        print(f"Checking if {comment['body']} starts with {comment_preamble} ... ", end="")
-        if comment["body"].startswith(comment_preamble):
-            response.append(comment["url"])
-            print("Good!")
+
+def resolve_transport(transport: str = _TRANSPORT_AUTO) -> str:
+    # auto uses requests if it is installed and the stdlib transport otherwise
+    if transport != _TRANSPORT_AUTO:
+        return transport
+    import importlib.util
+
+    return _TRANSPORT_REQUESTS if importlib.util.find_spec("requests") is not None else _TRANSPORT_URLLIB
+
+
+class HttpSnapshot:
+    # The HTTP exchanges of a run and its PULL_REQUEST payload, saved to a directory by --record and served from it by --replay.
+    # Exchanges are replayed by method, URL and request body, the same request made several times gets the recorded responses in order.
+    # latency is added to every replayed exchange to make the timing closer to the real API's.
+
+    def __init__(self, directory: str, replay: bool = False, latency: float = 0.0):
+        self.directory = os.path.expanduser(directory)
+        self.replaying = replay
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._exchanges: dict[tuple, list[dict]] = {}
+        self._file: Optional[TextIO] = None
+        if replay:
+            with open(os.path.join(self.directory, _SNAPSHOT_EXCHANGES), encoding="utf-8") as exchanges:
+                for line in exchanges:
+                    exchange = json.loads(line)
+                    self._exchanges.setdefault((exchange["method"], exchange["url"], exchange["body"]), []).append(exchange)
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            # Written as the exchanges happen, so a run which fails halfway still leaves the exchanges up to the failure
+            self._file = open(os.path.join(self.directory, _SNAPSHOT_EXCHANGES), "w", encoding="utf-8")
+
+    def save_pull_request(self, pull_request: dict) -> None:
+        with open(os.path.join(self.directory, _SNAPSHOT_PULL_REQUEST), "w", encoding="utf-8") as pull_request_file:
+            json.dump(pull_request, pull_request_file, indent=2)
+
+    def load_pull_request(self) -> dict:
+        with open(os.path.join(self.directory, _SNAPSHOT_PULL_REQUEST), encoding="utf-8") as pull_request_file:
+            return json.load(pull_request_file)
+
+    def record(self, method: str, url: str, body: Optional[bytes], response: Response) -> None:
+        exchange = {
+            "method": method,
+            "url": url,
+            "body": _decode_body(body),
+            "status": response.status_code,
+            # The content is stored decoded, so its encoding and length headers don't apply to it any more
+            "headers": {name: value for name, value in response.headers.items() if name.lower() not in _SNAPSHOT_SKIPPED_HEADERS},
+            "content": _decode_body(response.content),
+        }
+        with self._lock:
+            self._file.write(json.dumps(exchange) + "\n")
+            self._file.flush()
+
+    def replay(self, method: str, url: str, body: Optional[bytes]) -> UrllibResponse:
+        with self._lock:
+            exchanges = self._exchanges.get((method, url, _decode_body(body)))
+            exchange = exchanges.pop(0) if exchanges else None
+        if exchange is None:
+            # Like a request which could not be sent, the snapshot was made by a run which took another path
+            raise ConnectionError(f"{method} {url} is not in the snapshot {self.directory}")
+        if self.latency > 0:
+            time.sleep(self.latency)
+        content = exchange["content"].encode("utf-8", "surrogateescape")
+        return UrllibResponse(UrllibRequest(method, url, body), exchange["status"], Headers(exchange["headers"]), content)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+
+def _decode_body(body: Optional[bytes]) -> Optional[str]:
+    # Bodies are JSON, anything else still survives the round trip through the snapshot
+    return None if body is None else body.decode("utf-8", "surrogateescape")
+
+
+class SnapshotSession:
+    # Wraps the transport of a GitHubSession to record its exchanges into a snapshot or to serve them from one.
+    # Everything above the transport (rate limiting, metrics, the cache, streaming the items of a list) runs as usual.
+
+    def __init__(self, session, snapshot: HttpSnapshot):
+        self._session = session
+        self.snapshot = snapshot
+        self.headers = session.headers
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        params: Optional[dict] = None,
+        json: Optional[object] = None,
+        headers: Optional[dict] = None,
+        timeout: Optional[float] = None,
+        stream: bool = False,
+    ) -> Response:
+        url = build_url(url, params)
+        body = None if json is None else jsonlib.dumps(json).encode("utf-8")
+        if self.snapshot.replaying:
+            return self.snapshot.replay(method, url, body)
+        # The body is recorded, so it is read in full even when it would have been streamed
+        response = self._session.request(method, url, json=json, headers=headers, timeout=timeout)
+        self.snapshot.record(method, url, body, response)
+        return response
+
+    def close(self) -> None:
+        self._session.close()
+
+
+class GitHubSession:
+    # A single keep-alive connection pool shared by every GitHub call in a run.
+    # All requests carry the same headers and timeout, idempotent requests (GET, DELETE, ...) are retried
+    # with an exponential backoff on 5xx responses and connection resets. Every call goes through the rate limiter.
+
+    def __init__(
+        self,
+        token: Optional[str] = None,
+        timeout: float = _DEFAULT_TIMEOUT,
+        max_retries: int = _DEFAULT_MAX_RETRIES,
+        pool_size: int = _POOL_SIZE,
+        cache: Optional[HttpCache] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        metrics: Optional[Metrics] = None,
+        transport: str = _TRANSPORT_AUTO,
+        snapshot: Optional[HttpSnapshot] = None,
+    ):
+        self.timeout = timeout
+        self.cache = cache
+        self.snapshot = snapshot
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.metrics = metrics or Metrics()
+        self.transport = resolve_transport(transport)
+        if self.transport == _TRANSPORT_URLLIB:
+            self._session = UrllibSession(pool_size, max_retries)
         else:
-            print("Failed")
+            self._session = create_requests_session(pool_size, max_retries)
+        if snapshot is not None:
+            self._session = SnapshotSession(self._session, snapshot)
+        self.headers = self._session.headers
+        self.headers.update(http_headers)
+        if token:
+            self.headers["Authorization"] = f"Bearer {token}"
+
+    def request(self, method: str, url: str, **kwargs) -> Response:
+        kwargs.setdefault("timeout", self.timeout)
+        if method == "GET" and self.cache is not None:
+            return self._cached_get(url, **kwargs)
+        return self._send(method, url, **kwargs)
+
+    def _send(self, method: str, url: str, **kwargs) -> Response:
+        attempt = 0
+        while True:
+            self.rate_limiter.wait(url)
+            response = self._session.request(method, url, **kwargs)
+            # A streamed body is recorded once it has been read, see iter_items
+            if not kwargs.get("stream") or response.status_code != 200:
+                self.metrics.record(response)
+            delay = self.rate_limiter.update(url, response)
+            if delay is None or attempt >= _RATE_LIMIT_RETRIES:
+                return response
+            attempt += 1
+            logger.warning("Hit a GitHub rate limit on %s, retrying in %.0f seconds", url, delay)
+            self.rate_limiter.sleep(delay)
+
+    def _cached_get(self, url: str, params: Optional[dict] = None, **kwargs) -> Response:
+        # The full URL (including the query string) is the cache key
+        url = build_url(url, params)
+        entry = self.cache.get(url)
+        headers = dict(kwargs.pop("headers", None) or {})
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = self._send("GET", url, headers=headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            # Serve the cached body as if this was a regular 200
+            response.status_code = 200
+            response._content = entry["body"].encode("utf-8")
+            response.encoding = "utf-8"
+            response.headers.update(entry["headers"])
+        elif response.status_code == 200 and ("ETag" in response.headers or "Last-Modified" in response.headers):
+            self.cache.put(
+                url,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                {name: response.headers[name] for name in _CACHED_HEADERS if name in response.headers},
+                response.text,
+            )
+        return response
+
+    def get(self, url: str, **kwargs) -> Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> Response:
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url: str, **kwargs) -> Response:
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> Response:
+        return self.request("DELETE", url, **kwargs)
+
+    def iter_items(self, url: str, params: Optional[dict] = None) -> tuple[Response, Iterator]:
+        # GET a JSON array and decode it one item at a time, so memory doesn't grow with the size of the page.
+        # The body is read from the connection as the items are consumed, unless it goes through the cache.
+        # Check the status of the response before consuming the items.
+        if self.cache is not None:
+            response = self.get(url, params=params)
+            return response, iter_json_array([response.content])
+        response = self.get(url, params=params, stream=True)
+        if response.status_code != 200:
+            return response, iter_json_array([response.content])
+        return response, self._iter_streamed_items(response)
+
+    def _iter_streamed_items(self, response: Response) -> Iterator:
+        received = 0
+
+        def chunks() -> Iterator[bytes]:
+            nonlocal received
+            for chunk in response.iter_content(_JSON_READ_SIZE):
+                received += len(chunk)
+                yield chunk
+
+        try:
+            yield from iter_json_array(chunks())
+        finally:
+            self.metrics.record(response, received)
+            response.close()
+
+    def with_metrics(self, metrics: Metrics) -> GitHubSession:
+        # The same connections, headers, cache and rate limit budget, recording into separate metrics (i.e. one per concurrent check)
+        session = copy.copy(self)
+        session.metrics = metrics
+        return session
+
+    def close(self) -> None:
+        self._session.close()
+
+
+class GraphQLPullRequest:
+    # The title, head ref, commit messages and our previous comments of a PR fetched through the GraphQL API.
+    # This is usually a single round trip, more pages of commits are only fetched when iter_commit_messages gets that far.
+
+    def __init__(self, session: GitHubSession, graphql_url: str, pull_request: dict, bot_login: Optional[str] = None):
+        self.session = session
+        self.graphql_url = graphql_url
+        repo = pull_request.get("base", {}).get("repo", {})
+        owner, _, name = repo.get("full_name", "").partition("/")
+        self.variables = {"owner": owner, "name": name, "number": pull_request.get("number"), "pageSize": _GRAPHQL_PAGE_SIZE}
+        # GraphQL only gives us the database id of a comment, deleting or editing it goes through the REST API
+        comments_api_url = f"{repo.get('url')}/issues/comments"
+
+        graphql_pull_request = self._query(withCommits=True, withComments=True)
+        self.title = graphql_pull_request["title"]
+        self.head_ref = graphql_pull_request["headRefName"]
+        self._first_commits = graphql_pull_request["commits"]
+
+        self.comments = []
+        comments = graphql_pull_request["comments"]
+        while True:
+            for comment in comments["nodes"]:
+                login = get_graphql_login(comment.get("author"))
+                if bot_login and login != bot_login:
+                    continue
+                if comment["body"].startswith(comment_preamble):
+                    self.comments.append(
+                        {
+                            "id": comment["databaseId"],
+                            "url": f"{comments_api_url}/{comment['databaseId']}",
+                            "body": comment["body"],
+                            "created_at": comment["createdAt"],
+                            "user": {"login": login},
+                        }
+                    )
+            if not comments["pageInfo"]["hasNextPage"]:
+                break
+            comments = self._query(withCommits=False, withComments=True, commentsCursor=comments["pageInfo"]["endCursor"])["comments"]
+
+    def _query(self, **variables) -> dict:
+        response = self.session.post(
+            self.graphql_url,
+            json={
+                "query": _GRAPHQL_PULL_REQUEST_QUERY,
+                "variables": {"commitsCursor": None, "commentsCursor": None, **self.variables, **variables},
+            },
+        )
+        logger.debug("Querying GraphQL ... %s", response.status_code)
+        if response.status_code != 200:
+            raise CommandException(f"GraphQL query failed with status {response.status_code}")
+
+        payload = response.json()
+        if payload.get("errors"):
+            raise CommandException(f"GraphQL query failed: {'; '.join(error.get('message', '') for error in payload['errors'])}")
+        graphql_pull_request = ((payload.get("data") or {}).get("repository") or {}).get("pullRequest")
+        if graphql_pull_request is None:
+            raise CommandException("GraphQL query did not return the pull request")
+        return graphql_pull_request
+
+    def iter_commit_messages(self) -> Iterator[str]:
+        commits = self._first_commits
+        while True:
+            for node in commits["nodes"]:
+                # Merge commits don't count, they are not the commits the DVCS sync looks at
+                if node["commit"]["parents"]["totalCount"] <= 1:
+                    yield node["commit"]["message"]
+            if not commits["pageInfo"]["hasNextPage"]:
+                return
+            commits = self._query(withCommits=True, withComments=False, commitsCursor=commits["pageInfo"]["endCursor"])["commits"]
+
+
+def get_graphql_login(author: Optional[dict]) -> Optional[str]:
+    # The REST login of a GraphQL actor, GraphQL leaves the [bot] suffix off the logins of apps (i.e. github-actions)
+    if not author:
+        return None
+    return f"{author['login']}[bot]" if author.get("__typename") == "Bot" else author["login"]
+
+
+def iter_pages_newest_first(
+    session: GitHubSession, url: str, params: Optional[dict] = None, keep: Callable[[dict], bool] = lambda item: True
+) -> Iterator[list[dict]]:
+    # The items to keep of each page of a GitHub list endpoint which is sorted oldest first (like the issue comments),
+    # newest first. The pages are walked from the last one to the first one with the Link: rel="last" and rel="prev" headers.
+    response, items = session.iter_items(url, params)
+    logger.debug("Getting %s ... %s", url, response.status_code)
+    if response.status_code != 200:
+        raise CommandException(f"Failed to get {url}, got status {response.status_code}")
+    first_page = [item for item in items if keep(item)]
+    url = response.links.get("last", {}).get("url")
+    while url and parse_qs(urlsplit(url).query).get("page") != ["1"]:
+        response, items = session.iter_items(url)
+        logger.debug("Getting %s ... %s", url, response.status_code)
+        if response.status_code != 200:
+            raise CommandException(f"Failed to get {url}, got status {response.status_code}")
+        yield [item for item in items if keep(item)][::-1]
+        url = response.links.get("prev", {}).get("url")
+    yield first_page[::-1]
+
+
+def get_previous_comments(comments_url, session: Optional[GitHubSession] = None, bot_login: Optional[str] = None) -> list[dict]:
+    # Our results comments, newest first. Comments of other users than bot_login (if given) are skipped without looking at them
+    # and older pages are not read once a page had results comments, every run removes or replaces the older ones.
+    session = session or GitHubSession()
+    response: list[dict] = []
+    checked = 0
+
+    def is_results_comment(comment: dict) -> bool:
+        nonlocal checked
+        checked += 1
+        if bot_login and (comment.get("user") or {}).get("login") != bot_login:
+            return False
+        is_results_comment = comment["body"].startswith(comment_preamble)
+        logger.debug("Checking if %s starts with %s ... %s", comment["body"], comment_preamble, "Good!" if is_results_comment else "Failed")
+        return is_results_comment
+
+    try:
+        for page in iter_pages_newest_first(session, comments_url, {"per_page": _COMMENTS_PER_PAGE}, is_results_comment):
+            response.extend(page)
+            if response:
+                break
+    except CommandException as ce:
+        logger.info("Getting comments ... %s", ce)
+        raise CommandException("Failed to get existing comments!")
+    logger.info(
+        "Found %d results comments out of %d comments",
+        len(response),
+        checked,
+        extra={"results_comments": len(response), "comments": checked},
+    )
 
     return response
 
 
-def delete_previous_comments(comments_urls: list[str]) -> None:
-    if 'Authorization' not in http_headers:
+def get_previous_comments_urls(comments_url, session: Optional[GitHubSession] = None, bot_login: Optional[str] = None) -> list[str]:
+    return [comment["url"] for comment in get_previous_comments(comments_url, session, bot_login)]
+
+
+def delete_previous_comments(
+    comments_urls: list[str],
+    session: Optional[GitHubSession] = None,
+    concurrency: int = _DEFAULT_DELETE_CONCURRENCY,
+) -> None:
+    session = session or GitHubSession(pool_size=max(_POOL_SIZE, concurrency))
+    if 'Authorization' not in session.headers:
         raise CommandException("Auth header missing, can't delete old comments!")
 
+    def delete_comment(url: str) -> int:
+        response = session.delete(url)
+        logger.debug("Deleting old comment %s ... %s", url, response.status_code)
+        return response.status_code
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # The deletes don't depend on each other so run them in a bounded pool, the bound keeps us under GitHub's secondary rate limits
+    metrics = session.metrics
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), initializer=metrics.set_thread_phase, initargs=(metrics.current_phase,)) as executor:
+        status_codes = list(executor.map(delete_comment, comments_urls))
+
     comments_that_failed_to_delete = []
-    for url in comments_urls:
-        print("Deleting old comment ... ", end="")
-        response = requests.delete(url, headers=http_headers)
-        print(response.status_code)
-        if response.status_code not in [204, 404]:
+    for url, status_code in zip(comments_urls, status_codes):
+        if status_code not in [204, 404]:
             comments_that_failed_to_delete.append(url)
 
+    logger.info("Deleted %d old comments", len(comments_urls) - len(comments_that_failed_to_delete))
     if len(comments_that_failed_to_delete) > 0:
         raise CommandException('\n'.join(comments_that_failed_to_delete))
 
 
-def does_string_start_with_jira(string_to_match: str) -> Optional[str]:
-    pr_title_re = re.compile(f"^({_AAP_RE}|{_NO_JIRA_MARKER})", re.IGNORECASE)
-    matches = pr_title_re.match(string_to_match)
-    print(f"Checking if {string_to_match} starts with our RE ... ", end="")
+def get_newest_comment(comments: list[dict]) -> dict:
+    return max(comments, key=lambda comment: (comment.get("created_at", ""), comment.get("id", 0)))
+
+
+def upsert_comment(
+    comments_url: str,
+    previous_comments: list[dict],
+    new_comment_body: str,
+    session: Optional[GitHubSession] = None,
+    concurrency: int = _DEFAULT_DELETE_CONCURRENCY,
+) -> None:
+    session = session or GitHubSession()
+    if len(previous_comments) == 0:
+        response = session.post(comments_url, json={"body": new_comment_body})
+        logger.info("Creating new comment ... %s", response.status_code)
+        if response.status_code != 201:
+            raise CommandException("Failed to add new comment")
+        return
+
+    # Keep the newest of our comments and get rid of any duplicates left behind by older runs
+    newest_comment = get_newest_comment(previous_comments)
+    duplicate_urls = [comment["url"] for comment in previous_comments if comment is not newest_comment]
+    if len(duplicate_urls) > 0:
+        delete_previous_comments(duplicate_urls, session, concurrency)
+
+    if newest_comment["body"] == new_comment_body:
+        logger.info("Results did not change, leaving the existing comment alone")
+        return
+
+    response = session.patch(newest_comment["url"], json={"body": new_comment_body})
+    logger.info("Updating existing comment ... %s", response.status_code)
+    if response.status_code != 200:
+        raise CommandException(f"Failed to update comment {newest_comment['url']}")
+
+
+def get_check_run(repository_url: str, head_sha: str, session: Optional[GitHubSession] = None, bot_login: Optional[str] = None) -> Optional[dict]:
+    # The newest of our check runs on the commit, if there is one. Every app can create a check run with our name,
+    # only the ones of the app bot_login (if given) belongs to are looked at
+    session = session or GitHubSession()
+    url = f"{repository_url}/commits/{head_sha}/check-runs"
+    response = session.get(url, params={"check_name": _CHECK_RUN_NAME, "filter": "latest"})
+    logger.debug("Getting %s ... %s", url, response.status_code)
+    if response.status_code != 200:
+        raise CommandException(f"Failed to get {url}, got status {response.status_code}")
+    check_runs = response.json().get("check_runs", [])
+    if bot_login:
+        check_runs = [check_run for check_run in check_runs if f"{(check_run.get('app') or {}).get('slug')}[bot]" == bot_login]
+    return check_runs[0] if check_runs else None
+
+
+def report_check_run(
+    repository_url: str,
+    head_sha: str,
+    result: DecisionResult,
+    text: str,
+    check_run: Optional[dict] = None,
+    session: Optional[GitHubSession] = None,
+) -> None:
+    # Complete our check run on the head commit with the results, updating the previous one instead of adding another
+    session = session or GitHubSession()
+    failed = len([decision for decision in result.decisions if not decision.passed])
+    output = {
+        "title": "All DVCS rules passed" if result.passed else f"{failed} DVCS rule{'s' if failed > 1 else ''} failed",
+        "summary": result.to_markdown(),
+        "annotations": result.to_annotations(),
+    }
+    if text:
+        output["text"] = text
+    body = {"name": _CHECK_RUN_NAME, "status": "completed", "conclusion": "success" if result.passed else "failure", "output": output}
+    if check_run:
+        response = session.patch(check_run["url"], json=body)
+        logger.info("Updating check run ... %s", response.status_code)
+        if response.status_code != 200:
+            raise CommandException(f"Failed to update check run {check_run['url']}")
+        return
+
+    response = session.post(f"{repository_url}/check-runs", json={"head_sha": head_sha, **body})
+    logger.info("Creating check run ... %s", response.status_code)
+    if response.status_code != 201:
+        raise CommandException("Failed to create check run")
+
+
+class JiraMatcher:
+    # Matches an issue key of any of the configured Jira projects, or the NO_JIRA marker, at the start of a string.
+    # The project keys are case folded and factored by their common prefixes into a single regex which is compiled once,
+    # so matching stays a single anchored scan no matter how many projects there are.
+
+    def __init__(self, projects: Iterable[str] = _DEFAULT_JIRA_PROJECTS):
+        self.projects = sorted({project.strip().casefold() for project in projects if project.strip()})
+        if len(self.projects) == 0:
+            raise CommandException("No Jira projects configured")
+        invalid_projects = [project for project in self.projects if not _JIRA_PROJECT_RE.match(project)]
+        if len(invalid_projects) > 0:
+            raise CommandException(f"Invalid Jira project keys: {', '.join(invalid_projects)}")
+        self.pattern = f"{self._factor(self.projects)}-[0-9]+"
+        self._re = re.compile(f"({self.pattern}|{_NO_JIRA_MARKER})", re.IGNORECASE)
+
+    @staticmethod
+    def _factor(keys: list[str]) -> str:
+        # Build a trie of the keys and turn it into a regex, i.e. aap, abc and abd become a(?:ap|b[cd])
+        trie: dict = {}
+        for key in keys:
+            node = trie
+            for char in key:
+                node = node.setdefault(char, {})
+            node[""] = {}
+
+        def to_pattern(node: dict) -> str:
+            chars = sorted(char for char in node if char)
+            if len(chars) == 0:
+                return ""
+            if len(chars) > 1 and all(node[char] == {"": {}} for char in chars):
+                pattern = f"[{''.join(re.escape(char) for char in chars)}]"
+            else:
+                branches = [re.escape(char) + to_pattern(node[char]) for char in chars]
+                pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+            if "" in node:
+                # A key ends here which is also the prefix of longer keys
+                pattern = f"(?:{pattern})?"
+            return pattern
+
+        return to_pattern(trie)
+
+    @property
+    def description(self) -> str:
+        projects = [project.upper() for project in self.projects]
+        return f"{projects[0]}-[0-9]+" if len(projects) == 1 else f"({'|'.join(projects)})-[0-9]+"
+
+    def match(self, string_to_match: Optional[str]) -> Optional[str]:
+        matches = self._re.match(string_to_match or "")
+        return matches.group(1) if matches else None
+
+
+default_jira_matcher = JiraMatcher()
+
+
+def load_jira_matcher(jira_projects: Optional[str] = None, policy_file: Optional[str] = None) -> JiraMatcher:
+    # The policy file is a JSON document like {"jira_projects": ["AAP", "ABC"]}, its projects are added to jira_projects
+    projects = [project for project in (jira_projects or "").split(",") if project.strip()]
+    if policy_file:
+        try:
+            with open(policy_file, encoding="utf-8") as policy:
+                policy_projects = json.load(policy).get("jira_projects", [])
+        except (OSError, ValueError, AttributeError) as e:
+            raise CommandException(f"Failed to load the policy file {policy_file}: {e}")
+        # A single string would otherwise be taken as a list of one letter projects
+        if not isinstance(policy_projects, list) or not all(isinstance(project, str) for project in policy_projects):
+            raise CommandException(f"jira_projects in the policy file {policy_file} must be a list of project keys, got {policy_projects!r}")
+        projects.extend(policy_projects)
+    return JiraMatcher(projects) if projects else default_jira_matcher
+
+
+def does_string_start_with_jira(string_to_match: str, matcher: Optional[JiraMatcher] = None) -> Optional[str]:
+    matcher = matcher or default_jira_matcher
+    jira = matcher.match(string_to_match)
+    logger.info("Checking if %s starts with our RE ... %s", string_to_match, "Good!" if jira else "Failed!")
+    return jira
+
+
+class JiraKeyCache:
+    # The status (open, closed or missing) of the Jira keys looked up recently, kept in a JSON file between runs.
+    # Entries older than ttl seconds are looked up again, the least recently used ones are dropped beyond max_size.
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ttl: float = _DEFAULT_JIRA_CACHE_TTL,
+        max_size: int = _DEFAULT_JIRA_CACHE_SIZE,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.path = os.path.expanduser(path) if path else None
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.load()
+
+    def load(self) -> None:
+        if not self.path:
+            return
+        try:
+            with open(self.path, encoding="utf-8") as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        if not isinstance(cached, dict) or cached.get("version") != _JIRA_CACHE_VERSION:
+            return
+        with self._lock:
+            # The file lists the entries from the least to the most recently used one
+            for key, status, checked_at in cached.get("entries", []):
+                self._entries[key] = (status, checked_at)
+            self._evict()
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            cached = {"version": _JIRA_CACHE_VERSION, "entries": [[key, status, checked_at] for key, (status, checked_at) in self._entries.items()]}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        write_json_atomically(self.path, cached)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self.clock() - entry[1] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, status: str) -> None:
+        with self._lock:
+            self._entries[key] = (status, self.clock())
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class JiraValidator:
+    # Looks up whether Jira keys exist and are not closed. All the keys which are not in the cache
+    # are resolved with a single JQL search (one per _JIRA_KEYS_PER_QUERY keys).
+
+    def __init__(self, url: str, session: GitHubSession, cache: Optional[JiraKeyCache] = None):
+        self.url = url.rstrip("/")
+        self.session = session
+        self.cache = cache if cache is not None else JiraKeyCache()
+
+    def statuses(self, keys: Iterable[str], metrics: Optional[Metrics] = None) -> dict[str, str]:
+        # The status of every key, keyed by the case folded key like decide() uses them
+        session = self.session.with_metrics(metrics) if metrics else self.session
+        keys = list(dict.fromkeys(key.upper() for key in keys))
+        statuses = {key: self.cache.get(key) for key in keys}
+        missing = [key for key, status in statuses.items() if status is None]
+        logger.info("Validating %d JIRA numbers, %d of them with Jira", len(keys), len(missing))
+        for start in range(0, len(missing), _JIRA_KEYS_PER_QUERY):
+            chunk = missing[start : start + _JIRA_KEYS_PER_QUERY]
+            statuses.update(self._search(session, chunk))
+        if missing:
+            # The statuses are good without the cache, a cache which can't be written only costs lookups in later runs
+            try:
+                self.cache.save()
+            except OSError as e:
+                logger.warning("Failed to save the Jira cache to %s: %s", self.cache.path, e)
+        return {key.casefold(): status for key, status in statuses.items()}
+
+    def _search(self, session: GitHubSession, keys: list[str]) -> dict[str, str]:
+        url = f"{self.url}/rest/api/2/search"
+        # Without validateQuery=false Jira rejects the whole query if one of the keys does not exist
+        params = {"jql": f"key in ({', '.join(keys)})", "fields": "status", "maxResults": len(keys), "validateQuery": "false"}
+        response = session.get(url, params=params)
+        logger.debug("Searching %s for %s ... %s", url, ", ".join(keys), response.status_code)
+        if response.status_code != 200:
+            raise CommandException(f"Failed to search {url}, got status {response.status_code}")
+        found = {}
+        for issue in response.json().get("issues", []):
+            category = issue.get("fields", {}).get("status", {}).get("statusCategory", {}).get("key")
+            found[issue["key"].upper()] = _JIRA_STATUS_CLOSED if category == "done" else _JIRA_STATUS_OPEN
+        statuses = {key: found.get(key, _JIRA_STATUS_MISSING) for key in keys}
+        for key, status in statuses.items():
+            self.cache.put(key, status)
+        return statuses
+
+
+def iter_paginated(session: GitHubSession, url: str, params: Optional[dict] = None) -> Iterator[dict]:
+    # Walk a GitHub list endpoint one page at a time, following the Link: rel="next" header. The items are decoded as they are needed.
+    while url:
+        response, items = session.iter_items(url, params)
+        logger.debug("Getting %s ... %s", url, response.status_code)
+        if response.status_code != 200:
+            raise CommandException(f"Failed to get {url}, got status {response.status_code}")
+        yield from items
+        # The next link already carries the query string
+        url = response.links.get("next", {}).get("url")
+        params = None
+
+
+def iter_commit_messages(session: GitHubSession, commit_url: str) -> Iterator[str]:
+    for commit in iter_paginated(session, commit_url, {"per_page": _COMMITS_PER_PAGE}):
+        # Merge commits don't count, they are not the commits the DVCS sync looks at
+        if len(commit.get("parents", [])) <= 1:
+            yield commit["commit"]["message"]
+
+
+def has_local_commits(base_sha: Optional[str], head_sha: Optional[str], repository_path: str = ".") -> bool:
+    # Can git log base..head be trusted to list every commit of the PR?
+    # A shallow clone may cut the history short without git complaining about it.
+    import subprocess
+
+    if not base_sha or not head_sha:
+        return False
+    try:
+        shallow = subprocess.run(
+            ["git", "-C", repository_path, "rev-parse", "--is-shallow-repository"],
+            capture_output=True,
+            text=True,
+        )
+        if shallow.returncode != 0 or shallow.stdout.strip() != "false":
+            return False
+        for sha in (base_sha, head_sha):
+            if subprocess.run(["git", "-C", repository_path, "cat-file", "-e", f"{sha}^{{commit}}"], capture_output=True).returncode != 0:
+                return False
+    except OSError:
+        # git is not installed
+        return False
+    return True
+
+
+def iter_git_commit_messages(base_sha: str, head_sha: str, repository_path: str = ".") -> Iterator[str]:
+    # Stream the commit messages of base..head out of a single git log, each record is "<parents>\n<message>" terminated by a NUL
+    import subprocess
+
+    logger.info("Getting commits %s..%s from git", base_sha, head_sha)
+    process = subprocess.Popen(
+        ["git", "-C", repository_path, "log", "-z", "--format=%P%n%B", f"{base_sha}..{head_sha}"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    finished = False
+    try:
+        pending = b""
+        while True:
+            chunk = process.stdout.read1(_GIT_READ_SIZE)
+            records = (pending + chunk).split(b"\0")
+            # The last piece is either empty or the start of a record we haven't got all of yet
+            pending = records.pop() if chunk else b""
+            for record in records:
+                if not record:
+                    continue
+                parents, _, message = record.decode("utf-8", "replace").partition("\n")
+                # Merge commits don't count, they are not the commits the DVCS sync looks at
+                if len(parents.split()) <= 1:
+                    yield message
+            if not chunk:
+                break
+        finished = True
+    finally:
+        if process.poll() is None:
+            process.kill()
+        stderr = process.communicate()[1]
+    if finished and process.returncode != 0:
+        raise CommandException(f"git log failed: {stderr.decode('utf-8', 'replace').strip()}")
+
+
+def iter_commit_jira_numbers(commit_messages: Iterable[str], matcher: Optional[JiraMatcher] = None) -> Iterator[str]:
+    matcher = matcher or default_jira_matcher
+    for message in commit_messages:
+        jira = matcher.match(message)
+        logger.debug("Checking if %s has a JIRA number in it ... %s", message, f"Good: {jira}" if jira else "None detected")
+        if jira:
+            yield jira
+
+
+def get_compare_commit_messages(session: GitHubSession, repository_url: str, base_sha: str, head_sha: str) -> Optional[list[str]]:
+    # The messages of the commits pushed on top of base_sha. None if head_sha is not a plain fast forward of base_sha,
+    # i.e. after a force push (base_sha is gone or diverged) or when a merge brought in commits which may belong to the base branch.
+    url = f"{repository_url}/compare/{base_sha}...{head_sha}"
+    params: Optional[dict] = {"per_page": _COMMITS_PER_PAGE}
+    messages = []
+    while url:
+        response = session.get(url, params=params)
+        logger.debug("Getting %s ... %s", url, response.status_code)
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise CommandException(f"Failed to get {url}, got status {response.status_code}")
+        compare = response.json()
+        if compare.get("status") not in ("ahead", "identical"):
+            return None
+        for commit in compare.get("commits", []):
+            if len(commit.get("parents", [])) > 1:
+                return None
+            messages.append(commit["commit"]["message"])
+        url = response.links.get("next", {}).get("url")
+        params = None
+    return messages
+
+
+def get_incremental_commit_jiras(
+    session: GitHubSession,
+    pull_request: dict,
+    state: dict,
+    required_jiras: Optional[set[str]],
+    matcher: Optional[JiraMatcher] = None,
+) -> Optional[list[str]]:
+    # Add the JIRAs of the commits pushed since the previous run to the ones it saw.
+    # None if that isn't possible and every commit has to be scanned again.
+    base_sha = pull_request.get("base", {}).get("sha")
+    head_sha = pull_request.get("head", {}).get("sha")
+    if state.get("version") != _STATE_VERSION or not state.get("head") or not head_sha:
+        return None
+    if state.get("base") != base_sha:
+        logger.info("The base branch moved since the previous run, checking every commit")
+        return None
+    seen_jiras = set(state.get("jiras", []))
+    if not state.get("complete") and (required_jiras is None or not required_jiras <= seen_jiras):
+        logger.info("The previous run did not check every commit, checking every commit")
+        return None
+
+    repository_url = pull_request.get("base", {}).get("repo", {}).get("url")
+    messages = get_compare_commit_messages(session, repository_url, state["head"], head_sha)
+    if messages is None:
+        logger.info("%s is not a fast forward of %s, checking every commit", head_sha, state["head"])
+        return None
+    logger.info("Checking the %d commits pushed since the previous run", len(messages))
+    seen_jiras.update(jira.lower() for jira in iter_commit_jira_numbers(messages, matcher))
+    return sorted(seen_jiras)
+
+
+def read_state(comment_body: str) -> Optional[dict]:
+    # The state of the previous run is hidden in its results comment
+    matches = _STATE_RE.search(comment_body)
     if not matches:
-        print("Failed!")
         return None
-    else:
-        print("Good!")
-    return matches.groups()[0]
-
-
-def get_commit_jira_numbers(commit_url: str) -> list[str]:
-    print("Getting commits ... ", end="")
-    commits = requests.get(commit_url)
-    print(commits.status_code)
-    if commits.status_code != 200:
-        raise CommandException("Failed to get commits!")
-    comment_re = re.compile(rf"({_AAP_RE}|{_NO_JIRA_MARKER})", re.IGNORECASE)
-    possible_jiras = []
-    for commit in commits.json():
-        # TODO: How to check if this is a merge commit or a regular comment?
-        matches = comment_re.match(commit["commit"]["message"])
-        print(f"Checking if {commit['commit']['message']} has a JIRA number in it ... ", end="")
-        if matches:
-            print(f"Good: {matches.groups()[0]}")
-            possible_jiras.append(matches.groups()[0])
-        else:
-            print("None detected")
+    try:
+        return json.loads(matches.group(1))
+    except ValueError:
+        return None
+
 
+def render_state(state: dict) -> str:
+    return f"\n<!-- dvcs-state: {json.dumps(state, sort_keys=True)} -->"
+
+
+def get_fingerprint(
+    pull_request: dict, pr_title_jira: Optional[str], source_branch_jira: Optional[str], matcher: JiraMatcher, jira_url: Optional[str] = None
+) -> str:
+    # Everything the results depend on, an event which leaves all of it alone (i.e. editing the PR body) can't change the results.
+    # jira_url is the Jira the JIRAs are validated against, None if they are not validated.
+    inputs = {
+        "version": _STATE_VERSION,
+        "projects": matcher.projects,
+        "jira": jira_url,
+        "title": pr_title_jira,
+        "branch": source_branch_jira,
+        "base": pull_request.get("base", {}).get("ref"),
+        "head": pull_request.get("head", {}).get("sha"),
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_event() -> dict:
+    # The webhook payload of the event which triggered the workflow
+    event_path = getenv("GITHUB_EVENT_PATH")
+    if not event_path:
+        return {}
+    try:
+        with open(event_path, encoding="utf-8") as event_file:
+            return json.load(event_file)
+    except (OSError, ValueError) as e:
+        logger.warning("Failed to load the event from %s: %s", event_path, e)
+        return {}
+
+
+def get_required_commit_jiras(pr_title_jira: Optional[str], source_branch_jira: Optional[str]) -> Optional[set[str]]:
+    # The (lower cased) commit JIRAs which are enough for make_decisions to reach its verdict.
+    # An empty set means the commits don't matter at all, None means every commit has to be looked at.
+    if pr_title_jira is not None and pr_title_jira.lower() == _NO_JIRA_MARKER.lower():
+        return set()
+    required = {jira.lower() for jira in (pr_title_jira, source_branch_jira) if jira}
+    return required or None
+
+
+def collect_commit_jira_numbers(
+    commit_messages: Iterable[str],
+    required_jiras: Optional[set[str]] = None,
+    matcher: Optional[JiraMatcher] = None,
+) -> list[str]:
+    # commit_messages is consumed lazily, so any commits after the ones we need are never fetched
+    possible_jiras: list[str] = []
+    if required_jiras is not None and len(required_jiras) == 0:
+        logger.info("The commits can not change the results, not getting them")
+        return possible_jiras
+
+    started = time.monotonic()
+    checked_commits = 0
+
+    def count_commits(messages: Iterable[str]) -> Iterator[str]:
+        nonlocal checked_commits
+        for message in messages:
+            checked_commits += 1
+            yield message
+
+    missing_jiras = None if required_jiras is None else {jira.lower() for jira in required_jiras}
+    for jira in iter_commit_jira_numbers(count_commits(commit_messages), matcher):
+        possible_jiras.append(jira)
+        if missing_jiras is not None:
+            missing_jiras.discard(jira.lower())
+            if len(missing_jiras) == 0:
+                logger.info("Found every JIRA number needed to make decisions, not checking the remaining commits")
+                break
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        "Checked %d commits in %.2f seconds, found JIRA numbers: %s",
+        checked_commits,
+        elapsed,
+        ", ".join(possible_jiras) or "none",
+        extra={"commits": checked_commits, "seconds": round(elapsed, 3), "jiras": possible_jiras},
+    )
     return possible_jiras
 
 
-def make_decisions(
+def get_commit_jira_numbers(
+    commit_url: str,
+    required_jiras: Optional[set[str]] = None,
+    session: Optional[GitHubSession] = None,
+    matcher: Optional[JiraMatcher] = None,
+) -> list[str]:
+    session = session or GitHubSession()
+    logger.info("Getting commits ...")
+    return collect_commit_jira_numbers(iter_commit_messages(session, commit_url), required_jiras, matcher)
+
+
+class Decision:
+    # The outcome of one rule, label and message are what the results comment shows for it
+    def __init__(self, rule: str, passed: bool, label: str, message: str, jiras: Iterable[str] = ()):
+        self.rule = rule
+        self.passed = passed
+        self.label = label
+        self.message = message
+        self.jiras = list(jiras)
+
+    def to_dict(self) -> dict:
+        return {"rule": self.rule, "passed": self.passed, "label": self.label, "message": self.message, "jiras": self.jiras}
+
+
+class DecisionResult:
+    # What decide() found, rendered to the results comment, JSON or check run annotations by the caller
+    def __init__(self, title_jira: Optional[str], source_branch_jira: Optional[str], commit_jiras: Iterable[str], decisions: list[Decision]):
+        self.title_jira = title_jira
+        self.source_branch_jira = source_branch_jira
+        self.commit_jiras = list(commit_jiras)
+        self.decisions = decisions
+
+    @property
+    def passed(self) -> bool:
+        return all(decision.passed for decision in self.decisions)
+
+    def to_markdown(self) -> str:
+        lines = [comment_preamble]
+        lines.extend(f"* {good_icon if decision.passed else bad_icon} {decision.label}: {decision.message}" for decision in self.decisions)
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return {
+            "passed": self.passed,
+            "title_jira": self.title_jira,
+            "source_branch_jira": self.source_branch_jira,
+            "commit_jiras": self.commit_jiras,
+            "decisions": [decision.to_dict() for decision in self.decisions],
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+    def to_annotations(self, path: str = ".github") -> list[dict]:
+        # Check run annotations have to point at a file, the failures are about the PR so they point at the .github directory
+        return [
+            {
+                "path": path,
+                "start_line": 1,
+                "end_line": 1,
+                "annotation_level": "failure",
+                "title": decision.label,
+                "message": decision.message,
+            }
+            for decision in self.decisions
+            if not decision.passed
+        ]
+
+
+def decide(
     pr_title_jira: Optional[str],
-    possible_commit_jiras: list[str],
+    possible_commit_jiras: Iterable[str],
     source_branch_jira: Optional[str],
-) -> str:
-    # Lower case everything for comparison
-    if pr_title_jira is not None:
-        pr_title_jira = pr_title_jira.lower()
-    if source_branch_jira is not None:
-        source_branch_jira = source_branch_jira.lower()
-    for index in range(0, len(possible_commit_jiras)):
-        if possible_commit_jiras[index] is not None:
-            possible_commit_jiras[index] = possible_commit_jiras[index].lower()
-
-    print("")
-    print("Making decisions based on the following:")
-    print(f"JIRA from title: {pr_title_jira}")
-    print(f"JIRA from source branch: {source_branch_jira}")
-    print(f"JIRAS from commits: {', '.join(possible_commit_jiras)}")
-    print("")
-
-    decisions = [comment_preamble]
-    # Now make th decisions if this is in good order....
+    matcher: Optional[JiraMatcher] = None,
+    jira_statuses: Optional[dict[str, str]] = None,
+) -> DecisionResult:
+    # jira_statuses are the Jira statuses of the JIRAs found (see JiraValidator), the JIRAs are not validated without them
+    jira_description = (matcher or default_jira_matcher).description
+    no_jira = _NO_JIRA_MARKER.casefold()
+    # Case fold everything for comparison, the commit JIRAs once into an (insertion ordered) set
+    title_jira = pr_title_jira.casefold() if pr_title_jira else None
+    branch_jira = source_branch_jira.casefold() if source_branch_jira else None
+    commit_jiras = dict.fromkeys(jira.casefold() for jira in possible_commit_jiras if jira)
+
+    logger.info("Making decisions based on the following:")
+    logger.info("JIRA from title: %s", title_jira)
+    logger.info("JIRA from source branch: %s", branch_jira)
+    logger.info("JIRAS from commits: %s", ", ".join(commit_jiras))
+
+    decisions = []
+    result = DecisionResult(title_jira, branch_jira, commit_jiras, decisions)
 
     # First check the PR title
-    if not pr_title_jira:
-        # If there is no PR title JIRA report bad
-        decisions.append(f"* {bad_icon} Title: PR title does not start with a JIRA number (AAP-[0-9]+) or {_NO_JIRA_MARKER}")
-    elif pr_title_jira == _NO_JIRA_MARKER.lower():
+    if not title_jira:
+        decisions.append(Decision("title", False, "Title", f"PR title does not start with a JIRA number ({jira_description}) or {_NO_JIRA_MARKER}"))
+    elif title_jira == no_jira:
         # If we put the _NO_JIRA_MARKER in the title that is good enough.
         # it provides the lowest entry barrier for community as they wouldn't have to fix branches or commit messages
-        decisions.append(f"* {good_icon} Title: reported no jira related, no other checks necessary")
-        return "\n".join(decisions)
+        decisions.append(Decision("title", True, "Title", "reported no jira related, no other checks necessary", [title_jira]))
+        return result
     else:
-        # Report the title is good
-        decisions.append(f"* {good_icon} Title: JIRA number {pr_title_jira}")
+        decisions.append(Decision("title", True, "Title", f"JIRA number {title_jira}", [title_jira]))
 
     # Next check the source branch
-    if not source_branch_jira:
-        # If there is no Source Branch JIRA report bad
-        decisions.append(f"* {bad_icon} Source Branch: The source branch of the PR does not start with a JIRA number (AAP-[0-9]+) or {_NO_JIRA_MARKER}")
+    if not branch_jira:
+        message = f"The source branch of the PR does not start with a JIRA number ({jira_description}) or {_NO_JIRA_MARKER}"
+        decisions.append(Decision("source_branch", False, "Source Branch", message))
     else:
-        # Report the source branch is good
-        decisions.append(f"* {good_icon} Source Branch: JIRA number {source_branch_jira}")
+        decisions.append(Decision("source_branch", True, "Source Branch", f"JIRA number {branch_jira}", [branch_jira]))
 
     # Now compare the source branch to the pr title
-    if pr_title_jira is not None and source_branch_jira is not None and pr_title_jira != source_branch_jira:
-        # If we have source and title JIRAS and there is a mismatch between the title and source branch JIRAs report the mismatch
-        decisions.append(f"* {bad_icon} Mismatch: The JIRAs in the source branch {source_branch_jira} and title {pr_title_jira} do not match!")
+    if title_jira and branch_jira and title_jira != branch_jira:
+        message = f"The JIRAs in the source branch {branch_jira} and title {title_jira} do not match!"
+        decisions.append(Decision("title_branch_match", False, "Mismatch", message, [branch_jira, title_jira]))
 
     # Finally lets check the commits
-    if len(possible_commit_jiras) == 0:
-        # If we got no commit JIRAS the commits are bad
-        decisions.append(f"* {bad_icon} Commits: No commits with a JIRA number (AAP-[0-9]+) or {_NO_JIRA_MARKER} found!")
-    elif source_branch_jira == pr_title_jira:
-        if source_branch_jira is None:
-            # If the source branch JIRA and the title JIRA are missing and we have commit JIRAS report the commits as good
-            decisions.append(f"* {good_icon} Commits: At least one JIRA number in commit messages {', '.join(possible_commit_jiras)}")
+    if not commit_jiras:
+        decisions.append(Decision("commits", False, "Commits", f"No commits with a JIRA number ({jira_description}) or {_NO_JIRA_MARKER} found!"))
+    elif branch_jira == title_jira:
+        if branch_jira is None:
+            # Without title and source branch JIRAs any commit JIRA will do
+            decisions.append(Decision("commits", True, "Commits", f"At least one JIRA number in commit messages {', '.join(commit_jiras)}", commit_jiras))
+        elif branch_jira in commit_jiras:
+            decisions.append(Decision("commits", True, "Commits", "At least one JIRA number in commit messages match the other JIRA numbers", [branch_jira]))
         else:
-            # If the source branch JIRA matches the title JIRA and we have that JIRA in the commits, the commits are good
-            if source_branch_jira in possible_commit_jiras:
-                decisions.append(f"* {good_icon} Commits: At least one JIRA number in commit messages match the other JIRA numbers")
-            else:
-                decisions.append(f"* {bad_icon} Commit Mismatch: At least one commit is required with {source_branch_jira}")
+            decisions.append(Decision("commits", False, "Commit Mismatch", f"At least one commit is required with {branch_jira}", [branch_jira]))
     else:
-        # If we made it here, we have commit JIRAS but we have a mismatch between the source branch and title
-        if source_branch_jira is not None and source_branch_jira not in possible_commit_jiras:
-            decisions.append(f"* {bad_icon} Mismatch: No commit with source branch JIRA number")
-        if pr_title_jira is not None and pr_title_jira not in possible_commit_jiras:
-            decisions.append(f"* {bad_icon} Mismatch: No commit with PR title JIRA number")
+        # We have commit JIRAs but the source branch and title don't agree, each of them needs a commit
+        if branch_jira is not None and branch_jira not in commit_jiras:
+            decisions.append(Decision("branch_commits", False, "Mismatch", "No commit with source branch JIRA number", [branch_jira]))
+        if title_jira is not None and title_jira not in commit_jiras:
+            decisions.append(Decision("title_commits", False, "Mismatch", "No commit with PR title JIRA number", [title_jira]))
 
-    # Construct the new comment
-    return "\n".join(decisions)
+    # And whether the JIRAs are real, open issues
+    if jira_statuses is not None:
+        jiras = [jira for jira in dict.fromkeys([title_jira, branch_jira, *commit_jiras]) if jira and jira != no_jira]
+        invalid = {jira: jira_statuses[jira] for jira in jiras if jira_statuses.get(jira) in (_JIRA_STATUS_CLOSED, _JIRA_STATUS_MISSING)}
+        if invalid:
+            message = ", ".join(f"{jira} is closed" if status == _JIRA_STATUS_CLOSED else f"{jira} does not exist" for jira, status in invalid.items())
+            decisions.append(Decision("jira_issues", False, "Jira", message, invalid))
+        else:
+            decisions.append(Decision("jira_issues", True, "Jira", "All JIRA numbers are open issues", jiras))
 
+    return result
 
-def main(args=[]):
-    global http_headers
 
-    dry_run = False
+def make_decisions(
+    pr_title_jira: Optional[str],
+    possible_commit_jiras: list[str],
+    source_branch_jira: Optional[str],
+    matcher: Optional[JiraMatcher] = None,
+) -> str:
+    # The results comment for the decisions
+    return decide(pr_title_jira, possible_commit_jiras, source_branch_jira, matcher).to_markdown()
+
+
+def check_pull_request(pull_request: dict, session: GitHubSession, matcher: Optional[JiraMatcher] = None) -> dict:
+    # Run the title, source branch and commit checks of a PR without writing anything to it
+    pr_title_jira = does_string_start_with_jira(pull_request.get("title") or "", matcher)
+    source_branch_jira = does_string_start_with_jira(pull_request.get("head", {}).get("ref", ""), matcher)
+    possible_commit_jiras = get_commit_jira_numbers(
+        pull_request.get("_links", {}).get("commits", {}).get("href"),
+        get_required_commit_jiras(pr_title_jira, source_branch_jira),
+        session,
+        matcher,
+    )
+    result = decide(pr_title_jira, possible_commit_jiras, source_branch_jira, matcher)
+    return {
+        "passed": result.passed,
+        "title_jira": pr_title_jira,
+        "source_branch_jira": source_branch_jira,
+        "commit_jiras": possible_commit_jiras,
+        "results": result.to_markdown(),
+    }
+
+
+def list_pull_requests(session: GitHubSession, api_url: str, repository: str, state: str) -> list[dict]:
+    return list(iter_paginated(session, f"{api_url}/repos/{repository}/pulls", {"state": state, "per_page": _PULLS_PER_PAGE}))
+
+
+def audit_pull_requests(
+    session: GitHubSession,
+    api_url: str,
+    repositories: list[str],
+    state: str,
+    concurrency: int,
+    matcher: Optional[JiraMatcher] = None,
+) -> Iterator[dict]:
+    # Check every PR of the repositories, checks start as soon as the PRs of their repository are listed.
+    # A failure to list or check something is reported in the row's error instead of stopping the audit.
+    def list_repository(repository: str) -> tuple[str, list[dict]]:
+        return repository, list_pull_requests(session, api_url, repository, state)
+
+    def audit_pull_request(repository: str, pull_request: dict) -> dict:
+        row = {
+            "repository": repository,
+            "number": pull_request.get("number"),
+            "url": pull_request.get("html_url"),
+            "title": pull_request.get("title"),
+            "source_branch": pull_request.get("head", {}).get("ref"),
+        }
+        try:
+            row.update(check_pull_request(pull_request, session, matcher))
+        # The network errors of both transports are OSErrors
+        except (CommandException, OSError) as e:
+            row["error"] = str(e)
+        return row
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        listings = {executor.submit(list_repository, repository): repository for repository in repositories}
+        checks = []
+        for listing in as_completed(listings):
+            try:
+                repository, pull_requests = listing.result()
+            except (CommandException, OSError) as e:
+                yield {"repository": listings[listing], "error": str(e)}
+                continue
+            checks.extend(executor.submit(audit_pull_request, repository, pull_request) for pull_request in pull_requests)
+
+        for check in as_completed(checks):
+            yield check.result()
+
+
+def write_audit_report(rows: Iterable[dict], report_file: TextIO, report_format: str) -> list[dict]:
+    written = []
+    writer = None
+    if report_format == "csv":
+        import csv
+
+        writer = csv.DictWriter(report_file, fieldnames=_AUDIT_FIELDS)
+        writer.writeheader()
+    for row in rows:
+        row = {field: row.get(field) for field in _AUDIT_FIELDS}
+        if writer:
+            writer.writerow({**row, "commit_jiras": " ".join(row["commit_jiras"] or [])})
+        else:
+            report_file.write(json.dumps(row) + "\n")
+        report_file.flush()
+        written.append(row)
+    return written
+
+
+def run_audit(args: argparse.Namespace, session: GitHubSession, matcher: JiraMatcher) -> bool:
+    # Returns True if every repository and PR could be checked
+    repositories = [repository.strip() for repository in args.repos.split(",") if repository.strip()]
+    api_url = getenv("GITHUB_API_URL") or _DEFAULT_GITHUB_API_URL
+    report_file = sys.stdout if args.report == "-" else open(args.report, "w", newline="", encoding="utf-8")
+    try:
+        # The report may be going to stdout, keep the progress messages of the checks out of it
+        with redirect_stdout(sys.stderr):
+            logger.info("Auditing the %s PRs of %s", args.state, ", ".join(repositories))
+            rows = write_audit_report(
+                audit_pull_requests(session, api_url, repositories, args.state, args.audit_concurrency, matcher),
+                report_file,
+                args.report_format,
+            )
+            failed = [row for row in rows if row["passed"] is False]
+            errors = [row for row in rows if row["error"]]
+            logger.info("Checked %d PRs, %d would fail DVCS, %d could not be checked", len(rows) - len(errors), len(failed), len(errors))
+    finally:
+        if report_file is not sys.stdout:
+            report_file.close()
+    return len(errors) == 0
+
+
+def create_snapshot(args: argparse.Namespace) -> Optional[HttpSnapshot]:
+    # The snapshot for --record or --replay, None for a run against the real APIs
+    if args.replay:
+        return HttpSnapshot(args.replay, replay=True, latency=args.replay_latency)
+    if args.record:
+        return HttpSnapshot(args.record)
+    return None
+
+
+def create_session(args: argparse.Namespace, token: Optional[str], concurrency: int, snapshot: Optional[HttpSnapshot] = None) -> GitHubSession:
+    return GitHubSession(
+        token,
+        timeout=args.timeout,
+        max_retries=args.max_retries,
+        pool_size=max(_POOL_SIZE, concurrency),
+        cache=HttpCache(args.cache_dir, args.cache_max_bytes) if args.cache_dir else None,
+        rate_limiter=RateLimiter(args.rate_limit_reserve, args.rate_limit_max_wait),
+        transport=args.transport,
+        snapshot=snapshot,
+    )
+
+
+def create_jira_validator(args: argparse.Namespace, snapshot: Optional[HttpSnapshot] = None) -> Optional[JiraValidator]:
+    # The validator for --jira-url, None if the JIRAs are not validated
+    if not args.jira_url:
+        return None
+    # A pooled session like the GitHub one, just with Jira's token and headers
+    session = GitHubSession(getenv("JIRA_TOKEN"), timeout=args.timeout, max_retries=args.max_retries, transport=args.transport, snapshot=snapshot)
+    session.headers["Accept"] = "application/json"
+    del session.headers["X-GitHub-Api-Version"]
+    return JiraValidator(args.jira_url, session, JiraKeyCache(args.jira_cache_file, args.jira_cache_ttl, args.jira_cache_size))
+
 
+def run_check(args: argparse.Namespace, pull_request: dict, session: GitHubSession, dry_run: bool, matcher: JiraMatcher) -> None:
+    # Check a single PR and report the results on it, exits with 255 if the PR fails DVCS or something went wrong
+    try:
+        passed = check_and_report(args, pull_request, session, dry_run, matcher)
+    except CommandException as ce:
+        logger.error("%s", ce)
+        exit(255)
+    if not passed:
+        exit(255)
+
+
+def check_and_report(
+    args: argparse.Namespace,
+    pull_request: dict,
+    session: GitHubSession,
+    dry_run: bool,
+    matcher: JiraMatcher,
+    event: Optional[dict] = None,
+    jira_validator: Optional[JiraValidator] = None,
+) -> bool:
+    # Check a single PR and report the results on it. Returns whether the PR passed, raises CommandException if it could not be checked.
+    # event is the webhook payload which triggered the check, the one in $GITHUB_EVENT_PATH by default.
+    # jira_validator validates the JIRAs found, one is made for --jira-url if not given.
+    pull_urls = pull_request.get("_links", {})
+    comments_url = pull_request.get("_links", {}).get("comments", {}).get("href")
+    pr_title = pull_request.get("title")
+    source_branch = pull_request.get("head", {}).get("ref", "")
+
+    metrics = session.metrics
+    graphql_pull_request = None
+    if args.backend == _BACKEND_GRAPHQL:
+        try:
+            with metrics.phase("get pull request"):
+                graphql_pull_request = GraphQLPullRequest(session, getenv("GITHUB_GRAPHQL_URL") or _DEFAULT_GRAPHQL_URL, pull_request, args.bot_login)
+        except CommandException as ce:
+            raise CommandException(f"Failed to get the pull request: {ce}")
+        pr_title = graphql_pull_request.title
+        source_branch = graphql_pull_request.head_ref
+
+    # Check the PR title and source branch
+    pr_title_jira = does_string_start_with_jira(pr_title, matcher)
+    source_branch_jira = does_string_start_with_jira(source_branch, matcher)
+    fingerprint = get_fingerprint(pull_request, pr_title_jira, source_branch_jira, matcher, jira_validator.url if jira_validator else args.jira_url)
+
+    base_sha = pull_request.get("base", {}).get("sha")
+    head_sha = pull_request.get("head", {}).get("sha")
+    repository_url = pull_request.get("base", {}).get("repo", {}).get("url")
+    check_run_mode = args.output_mode == _OUTPUT_MODE_CHECK_RUN
+
+    if check_run_mode and (not repository_url or not head_sha):
+        raise CommandException("The pull request has no base repository or head commit to report a check run on")
+    # Anybody can post a comment starting with the preamble (or create a check run with our name),
+    # the state of a previous run is only taken from our own comments and check runs
+    if (args.incremental or args.skip_unchanged) and not args.bot_login:
+        option = "--incremental" if args.incremental else "--skip-unchanged"
+        raise CommandException(f"{option} needs --bot-login, the previous results are only read from the comments and check runs of that user")
+    if event is None:
+        event = load_event() if args.incremental else {}
+
+    def fetch_check_run(sha: str) -> Optional[dict]:
+        # The check run on a commit takes the place of the results comment, its text keeps the state
+        try:
+            with metrics.phase("get check run"):
+                return get_check_run(repository_url, sha, session, args.bot_login)
+        except CommandException as ce:
+            raise CommandException(f"Failed to get the check run: {ce}")
+
+    def list_comments() -> list[dict]:
+        with metrics.phase("list comments"):
+            return graphql_pull_request.comments if graphql_pull_request else get_previous_comments(comments_url, session, args.bot_login)
+
+    # The previous results are needed up front to reuse them, otherwise only to report the new ones
+    previous_comments: Optional[list[dict]] = None
+    check_run = None
+    previous_results = ""
+    if args.incremental or args.skip_unchanged:
+        if check_run_mode:
+            check_run = state_check_run = fetch_check_run(head_sha)
+            if check_run is None and args.incremental and event.get("action") == "synchronize" and event.get("before"):
+                # A push moved the head to a commit without a check run, the state is in the one on the previous head
+                state_check_run = fetch_check_run(event["before"])
+            output = (state_check_run or {}).get("output") or {}
+            previous_results = f"{output.get('summary') or ''}{output.get('text') or ''}"
+        else:
+            previous_comments = list_comments()
+            previous_results = get_newest_comment(previous_comments)["body"] if previous_comments else ""
+    previous_state = read_state(previous_results) if previous_results else None
+
+    # Nothing the results depend on changed since the previous run, so its results still stand
+    if args.skip_unchanged and previous_state and previous_state.get("fingerprint") == fingerprint:
+        logger.info("The title, source branch and head commit did not change since the previous run, keeping its results:")
+        logger.info("%s", previous_results)
+        return bool(previous_state.get("passed"))
+
+    def prepare_report() -> tuple[list[dict], Optional[dict]]:
+        # The previous results comments or check run to report on, with the old comments deleted in replace mode
+        if dry_run:
+            return previous_comments or [], check_run
+        if check_run_mode:
+            return [], check_run if args.incremental or args.skip_unchanged else fetch_check_run(head_sha)
+        if args.comment_mode == _COMMENT_MODE_UPSERT:
+            return previous_comments if previous_comments is not None else list_comments(), None
+        try:
+            if previous_comments is not None or graphql_pull_request:
+                comments = previous_comments if previous_comments is not None else graphql_pull_request.comments
+                previous_comments_urls = [comment["url"] for comment in comments]
+            else:
+                with metrics.phase("list comments"):
+                    previous_comments_urls = get_previous_comments_urls(comments_url, session, args.bot_login)
+            with metrics.phase("delete comments"):
+                delete_previous_comments(previous_comments_urls, session, args.delete_concurrency)
+        except CommandException as ce:
+            raise CommandException(f"Failed to delete one or more comments:\n{ce}")
+        return [], None
+
+    # Check the PR commits, stopping as soon as the title and source branch JIRAs have been seen
+    required_commit_jiras = get_required_commit_jiras(pr_title_jira, source_branch_jira)
+
+    def read_commit_jiras() -> tuple[list[str], bool]:
+        # The commit JIRAs and whether every commit was looked at
+        if args.incremental and previous_state and required_commit_jiras != set() and event.get("action") == "synchronize":
+            # Only look at the commits pushed since the previous run
+            try:
+                with metrics.phase("get commits"):
+                    incremental_jiras = get_incremental_commit_jiras(session, pull_request, previous_state, required_commit_jiras, matcher)
+            except CommandException as ce:
+                raise CommandException(f"Failed to get commits: {ce}")
+            if incremental_jiras is not None:
+                return incremental_jiras, bool(previous_state.get("complete"))
+
+        use_git = args.commit_source == _COMMIT_SOURCE_GIT and required_commit_jiras != set()
+        if use_git and not has_local_commits(base_sha, head_sha, args.repository_path):
+            logger.info("The commits %s..%s are not in %s, getting them from the API instead", base_sha, head_sha, args.repository_path)
+            use_git = False
+        try:
+            with metrics.phase("get commits"):
+                if use_git:
+                    jiras = collect_commit_jira_numbers(iter_git_commit_messages(base_sha, head_sha, args.repository_path), required_commit_jiras, matcher)
+                elif graphql_pull_request:
+                    jiras = collect_commit_jira_numbers(graphql_pull_request.iter_commit_messages(), required_commit_jiras, matcher)
+                else:
+                    jiras = get_commit_jira_numbers(pull_urls.get("commits", {}).get("href"), required_commit_jiras, session, matcher)
+        except CommandException as ce:
+            raise CommandException(f"Failed to get commits: {ce}")
+        # A scan which did not find everything it was looking for went through every commit
+        return jiras, required_commit_jiras is None or not required_commit_jiras <= {jira.lower() for jira in jiras}
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Getting (and deleting) the previous results doesn't depend on the commits, so it is done while the commits are read.
+    # Leaving the block waits for both, errors of either are raised from here.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        report_ready = executor.submit(prepare_report)
+        possible_commit_jiras, complete = read_commit_jiras()
+    previous_comments, check_run = report_ready.result()
+
+    # Remember what we saw so the next synchronize event only has to look at the new commits
+    state = {
+        "version": _STATE_VERSION,
+        "base": base_sha,
+        "head": head_sha,
+        "jiras": sorted({jira.lower() for jira in possible_commit_jiras}),
+        "complete": complete,
+        "fingerprint": fingerprint,
+    }
+
+    # Validate the JIRAs unless the title says there is none
+    jira_statuses = None
+    if jira_validator is None:
+        jira_validator = create_jira_validator(args, session.snapshot)
+    if jira_validator and required_commit_jiras != set():
+        try:
+            with metrics.phase("validate jiras"):
+                # NO_JIRA is our marker, not an issue key Jira knows about
+                no_jira = _NO_JIRA_MARKER.casefold()
+                jiras = [jira for jira in (pr_title_jira, source_branch_jira, *possible_commit_jiras) if jira and jira.casefold() != no_jira]
+                jira_statuses = jira_validator.statuses(jiras, metrics)
+        except (CommandException, OSError) as e:
+            # Jira being down should not block every PR, the JIRAs are still checked against the accepted projects
+            logger.warning("Failed to validate the JIRA numbers with %s, not validating them: %s", jira_validator.url, e)
+            # The fingerprint says the JIRAs were validated, so these results must not be reused by the next run
+            state["fingerprint"] = None
+
+    with metrics.phase("make decisions"):
+        result = decide(pr_title_jira, possible_commit_jiras, source_branch_jira, matcher, jira_statuses)
+    new_comment_body = result.to_markdown()
+    state["passed"] = result.passed
+    if args.results_file:
+        with open(args.results_file, "w", encoding="utf-8") as results_file:
+            results_file.write(result.to_json())
+    state_text = render_state(state) if args.incremental or args.skip_unchanged else ""
+
+    logger.info("Results:\n%s", new_comment_body, extra={"passed": state["passed"]})
+
+    # Update the existing check run or comment, or add a new one
+    if dry_run:
+        pass
+    elif check_run_mode:
+        try:
+            with metrics.phase("report check run"):
+                report_check_run(repository_url, head_sha, result, state_text, check_run, session)
+        except CommandException as ce:
+            raise CommandException(f"Failed to report the check run: {ce}")
+    elif args.comment_mode == _COMMENT_MODE_UPSERT:
+        try:
+            with metrics.phase("post comment"):
+                upsert_comment(comments_url, previous_comments, new_comment_body + state_text, session, args.delete_concurrency)
+        except CommandException as ce:
+            logger.error("Failed to update the results comment: %s", ce)
+    else:
+        with metrics.phase("post comment"):
+            response = session.post(comments_url, json={"body": new_comment_body + state_text})
+        logger.info("Creating new comment ... %s", response.status_code)
+        if response.status_code != 201:
+            logger.error("Failed to add new comment")
+
+    return state["passed"]
+
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="A tool for checking if a PR matches the DVCS rules.\n\n"
         "This program requires the body of the pull request as an environment variable PULL_REQUEST.\n"
@@ -181,67 +2218,265 @@ def main(args=[]):
         formatter_class=argparse.RawTextHelpFormatter,
     )
     parser.add_argument('--dry-run', action='store_true', help='Add debug messages and do not attempt to write to the PR')
+    parser.add_argument('--timeout', type=float, default=_DEFAULT_TIMEOUT, help='Seconds to wait on each GitHub API call (default: %(default)s)')
+    parser.add_argument(
+        '--max-retries',
+        type=int,
+        default=_DEFAULT_MAX_RETRIES,
+        help='How many times to retry a GitHub API call on 5xx responses and connection resets (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--delete-concurrency',
+        type=int,
+        default=_DEFAULT_DELETE_CONCURRENCY,
+        help='How many old comments to delete at the same time (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--comment-mode',
+        choices=[_COMMENT_MODE_REPLACE, _COMMENT_MODE_UPSERT],
+        default=_COMMENT_MODE_REPLACE,
+        help=f"{_COMMENT_MODE_REPLACE}: delete all previous results comments and post a new one\n"
+        f"{_COMMENT_MODE_UPSERT}: edit the newest results comment in place, only if the results changed\n"
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        '--output-mode',
+        choices=[_OUTPUT_MODE_COMMENT, _OUTPUT_MODE_CHECK_RUN],
+        default=_OUTPUT_MODE_COMMENT,
+        help=f"{_OUTPUT_MODE_COMMENT}: report the results in a comment on the PR, see --comment-mode\n"
+        f"{_OUTPUT_MODE_CHECK_RUN}: report the results in a single check run on the head commit which is updated on every run\n"
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        '--bot-login',
+        default=getenv("DVCS_BOT_LOGIN") or None,
+        help='Login of the user GH_TOKEN belongs to (i.e. github-actions[bot]), only its comments are looked at for previous results.\n'
+        'Every comment is looked at if not set (default: $DVCS_BOT_LOGIN)',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        default=getenv("DVCS_CACHE_DIR") or None,
+        help='Directory for caching GitHub responses between runs (i.e. with actions/cache), disabled if not set (default: $DVCS_CACHE_DIR)',
+    )
+    parser.add_argument(
+        '--cache-max-bytes',
+        type=int,
+        default=_DEFAULT_CACHE_MAX_BYTES,
+        help='Maximum size of the cache directory, least recently used entries are evicted first (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--rate-limit-reserve',
+        type=int,
+        help='Start pacing GitHub API calls until the rate limit resets once fewer than this many calls are left (default: 2%% of the rate limit)',
+    )
+    parser.add_argument(
+        '--rate-limit-max-wait',
+        type=float,
+        default=_DEFAULT_RATE_LIMIT_MAX_WAIT,
+        help='Longest time in seconds to wait for a rate limit, longer waits fail instead (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--backend',
+        choices=[_BACKEND_REST, _BACKEND_GRAPHQL],
+        default=_BACKEND_REST,
+        help=f"{_BACKEND_REST}: get the comments and commits from the REST API\n"
+        f"{_BACKEND_GRAPHQL}: get the title, source branch, commits and comments with a single GraphQL query\n"
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        '--commit-source',
+        choices=[_COMMIT_SOURCE_API, _COMMIT_SOURCE_GIT],
+        default=_COMMIT_SOURCE_API,
+        help=f"{_COMMIT_SOURCE_API}: get the commit messages from the GitHub API\n"
+        f"{_COMMIT_SOURCE_GIT}: read the commit messages between the base and head SHAs from the local clone,\n"
+        f"falling back to the API if the clone doesn't have them\n"
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        '--jira-projects',
+        default=getenv("DVCS_JIRA_PROJECTS") or None,
+        help=f"Comma separated list of the Jira project keys to accept (default: $DVCS_JIRA_PROJECTS or {','.join(_DEFAULT_JIRA_PROJECTS)})",
+    )
+    parser.add_argument(
+        '--policy-file',
+        default=getenv("DVCS_POLICY_FILE") or None,
+        help='JSON file with more Jira project keys to accept, like {"jira_projects": ["AAP", "ABC"]} (default: $DVCS_POLICY_FILE)',
+    )
+    parser.add_argument(
+        '--jira-url',
+        default=getenv("DVCS_JIRA_URL") or None,
+        help='Jira to check that the JIRAs found exist and are not closed, with the token in $JIRA_TOKEN.\n'
+        'Not validated if not set (default: $DVCS_JIRA_URL)',
+    )
+    parser.add_argument(
+        '--jira-cache-file',
+        default=getenv("DVCS_JIRA_CACHE_FILE") or None,
+        help='JSON file to keep the statuses looked up in Jira in between runs (default: $DVCS_JIRA_CACHE_FILE)',
+    )
+    parser.add_argument(
+        '--jira-cache-ttl',
+        type=float,
+        default=_DEFAULT_JIRA_CACHE_TTL,
+        help='Seconds after which a cached Jira status is looked up again (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--jira-cache-size',
+        type=int,
+        default=_DEFAULT_JIRA_CACHE_SIZE,
+        help='Most Jira statuses to cache, the least recently used ones are dropped first (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        default=getenv("DVCS_INCREMENTAL", "").lower() == "true",
+        help='Keep the commit JIRAs seen in the results comment, on synchronize events only the newly pushed commits are checked\n'
+        '(default: $DVCS_INCREMENTAL)',
+    )
+    parser.add_argument(
+        '--skip-unchanged',
+        action='store_true',
+        default=getenv("DVCS_SKIP_UNCHANGED", "").lower() == "true",
+        help='Keep the previous results if the title, source branch, head commit and accepted Jira projects did not change (default: $DVCS_SKIP_UNCHANGED)',
+    )
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        default=getenv("RUNNER_DEBUG") == "1",
+        help='Log every comment and commit message that is looked at, not just the summaries (default: on when the workflow runs with debug logging)',
+    )
+    parser.add_argument(
+        '--log-format',
+        choices=[_LOG_FORMAT_TEXT, _LOG_FORMAT_JSON],
+        default=getenv("DVCS_LOG_FORMAT") or _LOG_FORMAT_TEXT,
+        help=f"{_LOG_FORMAT_TEXT}: plain log lines\n{_LOG_FORMAT_JSON}: one JSON object per line\n(default: $DVCS_LOG_FORMAT or %(default)s)",
+    )
+    parser.add_argument(
+        '--metrics-file',
+        default=getenv("DVCS_METRICS_FILE") or None,
+        help='JSON file to write the time, GitHub API requests, bytes and status codes of each phase to (default: $DVCS_METRICS_FILE)',
+    )
+    parser.add_argument(
+        '--step-summary',
+        default=getenv("GITHUB_STEP_SUMMARY") or None,
+        help='Markdown file to append a table of the metrics to (default: $GITHUB_STEP_SUMMARY)',
+    )
+    parser.add_argument(
+        '--transport',
+        choices=[_TRANSPORT_AUTO, _TRANSPORT_REQUESTS, _TRANSPORT_URLLIB],
+        default=getenv("DVCS_TRANSPORT") or _TRANSPORT_AUTO,
+        help=f"How to talk to GitHub: {_TRANSPORT_REQUESTS} or the standard library's http.client ({_TRANSPORT_URLLIB}),\n"
+        f"{_TRANSPORT_AUTO} uses {_TRANSPORT_REQUESTS} if it is installed (default: $DVCS_TRANSPORT or %(default)s)",
+    )
+    parser.add_argument(
+        '--results-file',
+        default=getenv("DVCS_RESULTS_FILE") or None,
+        help='JSON file to write the verdict, the JIRAs found and the outcome of every rule to (default: $DVCS_RESULTS_FILE)',
+    )
+    parser.add_argument('--repository-path', default='.', help='Path of the local clone used by --commit-source git (default: %(default)s)')
+    snapshots = parser.add_argument_group(
+        'snapshots',
+        'Record the HTTP exchanges and the PULL_REQUEST payload of a run once, then replay them offline to profile or benchmark the check.',
+    )
+    snapshot_options = snapshots.add_mutually_exclusive_group()
+    snapshot_options.add_argument('--record', metavar='DIR', help='Save every HTTP exchange and the PULL_REQUEST payload of this run to DIR')
+    snapshot_options.add_argument(
+        '--replay',
+        metavar='DIR',
+        help='Serve the HTTP exchanges saved by --record from DIR instead of calling GitHub and Jira, the PULL_REQUEST payload is read from DIR as well',
+    )
+    snapshots.add_argument(
+        '--replay-latency',
+        type=float,
+        default=0.0,
+        help='Seconds added to every replayed exchange to simulate the latency of the real APIs (default: %(default)s)',
+    )
+    audit = parser.add_argument_group(
+        'audit mode',
+        'Check every PR of one or more repositories concurrently and write a report, nothing is written to the PRs.\n'
+        'This mode does not use PULL_REQUEST, GH_TOKEN is optional but avoids throttling.',
+    )
+    audit.add_argument('--repos', help='Comma separated list of owner/name repositories to audit')
+    audit.add_argument('--state', choices=['open', 'closed', 'all'], default='open', help='Which PRs to audit (default: %(default)s)')
+    audit.add_argument('--report', default='-', help='File to write the report to, - for stdout (default: %(default)s)')
+    audit.add_argument('--report-format', choices=['jsonl', 'csv'], default='jsonl', help='Format of the report (default: %(default)s)')
+    audit.add_argument(
+        '--audit-concurrency',
+        type=int,
+        default=_DEFAULT_AUDIT_CONCURRENCY,
+        help='How many repositories and PRs to check at the same time (default: %(default)s)',
+    )
+    return parser
+
+
+def main(args=[]):
+    dry_run = False
+
+    parser = build_parser()
     args = parser.parse_args(args)
     if hasattr(args, 'dry_run'):
         dry_run = args.dry_run
+    configure_logging(args.verbose or dry_run, args.log_format)
 
-    # Get and validate the data from the environment (the GitHub action should pass this in)
     try:
-        pull_request = json.loads(getenv("PULL_REQUEST", {}))
-    except json.JSONDecodeError as jde:
-        print(f"Failed to load json from string: {jde}")
+        matcher = load_jira_matcher(args.jira_projects, args.policy_file)
+    except CommandException as ce:
+        logger.error("%s", ce)
         exit(255)
 
-    print(f"Running DVCS v3 in dry-run={dry_run}")
-
-    if not dry_run:
-        GITHUB_TOKEN = getenv("GH_TOKEN")
-        if not GITHUB_TOKEN:
-            print("Did not get a github token, failing!")
-            exit(255)
-        print("Added authentication to headers")
-        http_headers["Authorization"] = f"Bearer {GITHUB_TOKEN}"
-
-    pull_urls = pull_request.get("_links", {})
-    comments_url = pull_request.get("_links", {}).get("comments", {}).get("href")
+    try:
+        snapshot = create_snapshot(args)
+    except (OSError, ValueError) as e:
+        logger.error("Failed to open the snapshot: %s", e)
+        exit(255)
 
-    if not dry_run:
+    if args.repos:
+        session = create_session(args, getenv("GH_TOKEN"), args.audit_concurrency, snapshot)
         try:
-            delete_previous_comments(get_previous_comments_urls(comments_url))
-        except CommandException as ce:
-            print("Failed to delete one or more comments:")
-            print(ce)
+            with session.metrics.phase("audit"):
+                audited = run_audit(args, session, matcher)
+        finally:
+            with redirect_stdout(sys.stderr):
+                logger.info("%s", session.rate_limiter.report())
+            session.metrics.write(args.step_summary, args.metrics_file)
+            if snapshot is not None:
+                snapshot.close()
+        if not audited:
             exit(255)
+        return
 
-    # Check the PR title
-    pr_title_jira = does_string_start_with_jira(pull_request.get("title"))
-
-    # Check the PR commits
+    # Get and validate the data from the environment (the GitHub action should pass this in), or the snapshot being replayed
     try:
-        possible_commit_jiras = get_commit_jira_numbers(pull_urls.get("commits", {}).get("href"))
-    except CommandException as ce:
-        print(f"Failed to get commits: {ce}")
+        pull_request = snapshot.load_pull_request() if args.replay else json.loads(getenv("PULL_REQUEST", {}))
+    except json.JSONDecodeError as jde:
+        logger.error("Failed to load json from string: %s", jde)
         exit(255)
+    except OSError as e:
+        logger.error("Failed to load the pull request from the snapshot: %s", e)
+        exit(255)
+    if args.record:
+        snapshot.save_pull_request(pull_request)
 
-    # Check the PR source branch
-    source_branch_jira = does_string_start_with_jira(pull_request.get("head", {}).get("ref", ""))
-
-    new_comment_body = make_decisions(pr_title_jira, possible_commit_jiras, source_branch_jira)
-
-    print("Results:")
-    print(new_comment_body)
-
-    # Post the new comment
-    if not dry_run:
-        print("Creating new comment ... ", end="")
-        response = requests.post(comments_url, json={"body": new_comment_body}, headers=http_headers)
-        print(response.status_code)
-        if response.status_code != 201:
-            print("Failed to add new comment")
+    logger.info("Running DVCS v3 in dry-run=%s", dry_run)
 
-    # If we had any errors, print them and exit
-    if bad_icon in new_comment_body:
+    # The token is required to write to the PR, in dry-run mode it is only used (if present) to avoid throttling
+    GITHUB_TOKEN = getenv("GH_TOKEN")
+    if args.replay:
+        # Nothing is sent when replaying, the placeholder only makes the writes take the same path as in the recorded run
+        GITHUB_TOKEN = GITHUB_TOKEN or "replay"
+    if not dry_run and not GITHUB_TOKEN:
+        logger.error("Did not get a github token, failing!")
         exit(255)
+    if GITHUB_TOKEN:
+        logger.info("Added authentication to headers")
+
+    session = create_session(args, GITHUB_TOKEN, args.delete_concurrency, snapshot)
+    try:
+        run_check(args, pull_request, session, dry_run, matcher)
+    finally:
+        logger.info("%s", session.rate_limiter.report())
+        session.metrics.write(args.step_summary, args.metrics_file)
+        if snapshot is not None:
+            snapshot.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+# A long running alternative to starting the action for every PR event, i.e. for GitHub Enterprise.
+# GitHub delivers pull_request webhooks to it, bursts of events for the same PR are coalesced and checked by a bounded pool of workers
+# sharing one pool of keep-alive connections to GitHub.
+# Run with: GH_TOKEN=... DVCS_WEBHOOK_SECRET=... ./server_check_dvcs.py --port 8080 [check_dvcs.py options]
+
+import hashlib
+import hmac
+import json
+import logging
+import signal
+import statistics
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import getenv
+from sys import argv, exit
+from typing import Callable, Optional
+
+import check_dvcs
+
+logger = logging.getLogger("check_dvcs.server")
+
+_CHECKED_ACTIONS = frozenset(["opened", "synchronize", "reopened", "edited", "ready_for_review"])
+_DEFAULT_HOST = "127.0.0.1"
+_DEFAULT_PORT = 8080
+_DEFAULT_WORKERS = 4
+# GitHub doesn't deliver payloads over 25MB
+_MAX_BODY_BYTES = 25 * 1024 * 1024
+_SEEN_DELIVERIES = 10000
+_LATENCY_SAMPLES = 1000
+
+
+def verify_signature(secret: bytes, body: bytes, signature: Optional[str]) -> bool:
+    # GitHub signs the body with the webhook secret in the X-Hub-Signature-256 header
+    if not signature or not signature.startswith("sha256="):
+        return False
+    expected = "sha256=" + hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+class EventQueue:
+    # The PRs waiting to be checked, in the order their first waiting event came in.
+    # A newer event for a PR which is already waiting replaces the older one, only the newest head of a PR matters.
+    # A PR is never handed to two workers at the same time, events coming in while it is checked wait for that check to finish.
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic, seen_deliveries: int = _SEEN_DELIVERIES):
+        self.clock = clock
+        self.seen_deliveries = seen_deliveries
+        self.stats = {"received": 0, "duplicates": 0, "coalesced": 0}
+        self._pending: OrderedDict[tuple, dict] = OrderedDict()
+        self._running: set[tuple] = set()
+        self._deliveries: OrderedDict[str, None] = OrderedDict()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def put(self, key: tuple, event: dict, delivery: Optional[str] = None) -> str:
+        # Returns what happened to the event: queued, coalesced or duplicate (a redelivery of an event we already have)
+        with self._condition:
+            self.stats["received"] += 1
+            if delivery:
+                if delivery in self._deliveries:
+                    self.stats["duplicates"] += 1
+                    return "duplicate"
+                self._deliveries[delivery] = None
+                if len(self._deliveries) > self.seen_deliveries:
+                    self._deliveries.popitem(last=False)
+            pending = self._pending.get(key)
+            if pending is not None:
+                # Deliveries can arrive out of order, keep the event of the most recently updated PR
+                self.stats["coalesced"] += 1
+                if event.get("pull_request", {}).get("updated_at", "") >= pending["event"].get("pull_request", {}).get("updated_at", ""):
+                    pending["event"] = event
+                return "coalesced"
+            self._pending[key] = {"event": event, "received_at": self.clock()}
+            self._condition.notify_all()
+            return "queued"
+
+    def get(self) -> Optional[tuple[tuple, dict, float]]:
+        # Blocks until a PR which isn't being checked is waiting, returns None once the queue is closed and drained
+        with self._condition:
+            while True:
+                for key in self._pending:
+                    if key not in self._running:
+                        pending = self._pending.pop(key)
+                        self._running.add(key)
+                        return key, pending["event"], pending["received_at"]
+                if self._closed and not self._running:
+                    return None
+                self._condition.wait()
+
+    def done(self, key: tuple) -> None:
+        with self._condition:
+            self._running.discard(key)
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def depth(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def running(self) -> int:
+        with self._condition:
+            return len(self._running)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    server: "WebhookHTTPServer"
+
+    def reply(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            self.reply(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            self.reply(200, self.server.dvcs.metrics())
+        else:
+            self.reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > _MAX_BODY_BYTES:
+            self.reply(413, {"error": "payload too large"})
+            return
+        body = self.rfile.read(length)
+        if not verify_signature(self.server.dvcs.secret, body, self.headers.get("X-Hub-Signature-256")):
+            self.reply(401, {"error": "bad signature"})
+            return
+        event_name = self.headers.get("X-GitHub-Event")
+        if event_name == "ping":
+            self.reply(200, {"status": "pong"})
+            return
+        try:
+            event = json.loads(body)
+        except ValueError:
+            self.reply(400, {"error": "payload is not JSON"})
+            return
+        if event_name != "pull_request" or event.get("action") not in _CHECKED_ACTIONS:
+            self.reply(200, {"status": "ignored"})
+            return
+        try:
+            key = (event["repository"]["full_name"], event["pull_request"]["number"])
+        except (KeyError, TypeError):
+            self.reply(400, {"error": "payload has no repository or pull request"})
+            return
+        status = self.server.dvcs.queue.put(key, event, self.headers.get("X-GitHub-Delivery"))
+        self.reply(202, {"status": status})
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class WebhookHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], dvcs: "DvcsServer"):
+        super().__init__(address, WebhookHandler)
+        self.dvcs = dvcs
+
+
+class DvcsServer:
+    # Receives the webhooks and checks the PRs on a pool of worker threads.
+    # /healthz answers as long as the server runs, /metrics reports the queue depth, event counts and check latencies.
+
+    def __init__(
+        self,
+        args,
+        session: check_dvcs.GitHubSession,
+        matcher: check_dvcs.JiraMatcher,
+        secret: bytes,
+        host: str = _DEFAULT_HOST,
+        port: int = _DEFAULT_PORT,
+        workers: int = _DEFAULT_WORKERS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.args = args
+        self.session = session
+        self.matcher = matcher
+        # One Jira key cache for all the workers
+        self.jira_validator = check_dvcs.create_jira_validator(args)
+        self.secret = secret
+        self.workers = max(1, workers)
+        self.clock = clock
+        self.queue = EventQueue(clock)
+        self.http = WebhookHTTPServer((host, port), self)
+        self.address = self.http.server_address
+        self.stats = {"checked": 0, "passed": 0, "failed": 0, "errors": 0, "requests": 0}
+        # Seconds from receiving the (first coalesced) event to the end of its check, and of the check alone
+        self.latencies: deque[float] = deque(maxlen=_LATENCY_SAMPLES)
+        self.durations: deque[float] = deque(maxlen=_LATENCY_SAMPLES)
+        self._lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+
+    def start(self) -> None:
+        self._threads = [threading.Thread(target=self.work, name=f"dvcs-worker-{index}", daemon=True) for index in range(self.workers)]
+        self._threads.append(threading.Thread(target=self.http.serve_forever, kwargs={"poll_interval": 0.1}, name="dvcs-http", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        logger.info("Listening for webhooks on %s:%d with %d workers", self.address[0], self.address[1], self.workers)
+
+    def stop(self) -> None:
+        # Stop taking events, then let the workers finish everything which is already queued
+        self.http.shutdown()
+        self.http.server_close()
+        self.queue.close()
+        for thread in self._threads:
+            thread.join()
+        self.session.close()
+        if self.jira_validator:
+            self.jira_validator.session.close()
+
+    def work(self) -> None:
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            key, event, received_at = job
+            try:
+                self.check(key, event, received_at)
+            finally:
+                self.queue.done(key)
+
+    def check(self, key: tuple, event: dict, received_at: float) -> None:
+        pull_request = event["pull_request"]
+        started = self.clock()
+        session = self.session.with_metrics(check_dvcs.Metrics(self.clock))
+        outcome = "errors"
+        try:
+            passed = check_dvcs.check_and_report(self.args, pull_request, session, self.args.dry_run, self.matcher, event, self.jira_validator)
+            outcome = "passed" if passed else "failed"
+        except (check_dvcs.CommandException, OSError) as e:
+            logger.error("Failed to check %s#%s: %s", key[0], key[1], e)
+        except Exception:
+            # Anything else (i.e. an unexpected payload or a truncated response) fails this check, not the worker
+            logger.exception("Failed to check %s#%s", key[0], key[1])
+        finished = self.clock()
+        with self._lock:
+            self.stats["checked"] += 1
+            self.stats[outcome] += 1
+            self.stats["requests"] += session.metrics.to_dict()["requests"]
+            self.latencies.append(finished - received_at)
+            self.durations.append(finished - started)
+        logger.info(
+            "Checked %s#%s at %s: %s in %.2f seconds, %.2f seconds after the event came in, %d PRs waiting",
+            key[0],
+            key[1],
+            pull_request.get("head", {}).get("sha"),
+            outcome,
+            finished - started,
+            finished - received_at,
+            self.queue.depth(),
+            extra={"repository": key[0], "number": key[1], "outcome": outcome, "seconds": round(finished - started, 3)},
+        )
+
+    @staticmethod
+    def summarize(samples: list[float]) -> dict:
+        if not samples:
+            return {"count": 0}
+        ordered = sorted(samples)
+        return {
+            "count": len(ordered),
+            "p50": statistics.median(ordered),
+            "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            "max": ordered[-1],
+        }
+
+    def metrics(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            latencies, durations = list(self.latencies), list(self.durations)
+        return {
+            "queue_depth": self.queue.depth(),
+            "running": self.queue.running(),
+            "workers": self.workers,
+            "events": dict(self.queue.stats),
+            "checks": stats,
+            "latency_seconds": self.summarize(latencies),
+            "check_seconds": self.summarize(durations),
+            "rate_limit": self.session.rate_limiter.used(),
+        }
+
+
+def main(args: list[str]) -> None:
+    parser = check_dvcs.build_parser()
+    parser.description = (
+        "Check the PRs GitHub delivers pull_request webhooks for, instead of running the action for every event.\n"
+        "The webhook secret is read from $DVCS_WEBHOOK_SECRET and the GitHub token from $GH_TOKEN."
+    )
+    server_options = parser.add_argument_group("server")
+    server_options.add_argument("--host", default=_DEFAULT_HOST, help="Address to listen on (default: %(default)s)")
+    server_options.add_argument("--port", type=int, default=_DEFAULT_PORT, help="Port to listen on (default: %(default)s)")
+    server_options.add_argument("--workers", type=int, default=_DEFAULT_WORKERS, help="How many PRs to check at the same time (default: %(default)s)")
+    args = parser.parse_args(args)
+    if args.record or args.replay:
+        parser.error("--record and --replay only apply to a single check or an audit")
+    check_dvcs.configure_logging(args.verbose, args.log_format)
+
+    secret = getenv("DVCS_WEBHOOK_SECRET")
+    token = getenv("GH_TOKEN")
+    if not secret:
+        logger.error("Did not get a webhook secret in DVCS_WEBHOOK_SECRET, failing!")
+        exit(255)
+    if not token and not args.dry_run:
+        logger.error("Did not get a github token, failing!")
+        exit(255)
+    try:
+        matcher = check_dvcs.load_jira_matcher(args.jira_projects, args.policy_file)
+    except check_dvcs.CommandException as ce:
+        logger.error("%s", ce)
+        exit(255)
+
+    # Every worker may be deleting comments concurrently, keep enough connections warm for all of them
+    session = check_dvcs.create_session(args, token, args.workers * max(1, args.delete_concurrency))
+    server = DvcsServer(args, session, matcher, secret.encode("utf-8"), args.host, args.port, args.workers)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    server.start()
+    try:
+        stopping.wait()
+    except KeyboardInterrupt:
+        pass
+    logger.info("Stopping, finishing the %d queued PRs first", server.queue.depth())
+    server.stop()
+
+
+if __name__ == "__main__":
+    main(argv[1:])
@@ -1,11 +1,26 @@
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from os import environ
 from unittest import mock
+from urllib.parse import parse_qs, urlsplit
 
 import pytest
 import requests_mock
 from requests.exceptions import MissingSchema  # type: ignore
 
+import bench_check_dvcs
 import check_dvcs
+import server_check_dvcs
 
 
 class TestDoesStringStartWithJira:
@@ -25,6 +40,283 @@ class TestDoesStringStartWithJira:
         assert result == expected_return
 
 
+class TestGitHubSession:
+
+    def test_headers_and_timeout(self):
+        session = check_dvcs.GitHubSession('1234', timeout=3)
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', 'https://example.com', status_code=200, json=[])
+            session.get('https://example.com')
+            assert m.last_request.headers['Authorization'] == 'Bearer 1234'
+            assert m.last_request.headers['Accept'] == check_dvcs.http_headers['Accept']
+            assert m.last_request.timeout == 3
+
+    def test_retry_policy(self):
+        session = check_dvcs.GitHubSession(max_retries=5)
+        adapter = session._session.get_adapter('https://api.github.com')
+        assert adapter.max_retries.total == 5
+        assert 502 in adapter.max_retries.status_forcelist
+        assert 'GET' in adapter.max_retries.allowed_methods
+        assert 'POST' not in adapter.max_retries.allowed_methods
+
+
+class TestHttpCache:
+
+    def test_conditional_get(self, tmp_path):
+        session = check_dvcs.GitHubSession('1234', cache=check_dvcs.HttpCache(str(tmp_path)))
+        link = '<https://example.com/commits?page=2>; rel="next"'
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', 'https://example.com/commits', status_code=200, json=[{"id": 1}], headers={'ETag': '"abc"', 'Link': link})
+            assert session.get('https://example.com/commits', params={'per_page': 100}).json() == [{"id": 1}]
+            assert 'If-None-Match' not in m.last_request.headers
+
+            m.register_uri('GET', 'https://example.com/commits', status_code=304)
+            response = session.get('https://example.com/commits', params={'per_page': 100})
+            assert m.last_request.headers['If-None-Match'] == '"abc"'
+            assert response.status_code == 200
+            assert response.json() == [{"id": 1}]
+            assert response.links['next']['url'] == 'https://example.com/commits?page=2'
+
+    def test_uncacheable_response(self, tmp_path):
+        session = check_dvcs.GitHubSession('1234', cache=check_dvcs.HttpCache(str(tmp_path)))
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', 'https://example.com', status_code=200, json=[])
+            session.get('https://example.com')
+            session.get('https://example.com')
+            assert 'If-None-Match' not in m.last_request.headers
+        assert list(tmp_path.iterdir()) == []
+
+    def test_lru_eviction(self, tmp_path):
+        cache = check_dvcs.HttpCache(str(tmp_path), max_bytes=1000)
+        body = 'x' * 300
+        cache.put('https://example.com/1', '"1"', None, {}, body)
+        cache.put('https://example.com/2', '"2"', None, {}, body)
+        # Make entry 1 the oldest on disk and then use it, so entry 2 becomes the least recently used one
+        old_time = os.path.getmtime(cache._path('https://example.com/2')) - 10
+        os.utime(cache._path('https://example.com/1'), (old_time - 10, old_time - 10))
+        os.utime(cache._path('https://example.com/2'), (old_time, old_time))
+        assert cache.get('https://example.com/1') is not None
+        cache.put('https://example.com/3', '"3"', None, {}, body)
+        assert cache.get('https://example.com/1') is not None
+        assert cache.get('https://example.com/2') is None
+        assert cache.get('https://example.com/3') is not None
+
+    def test_concurrent_eviction(self, tmp_path):
+        # Every put evicts, the threads keep removing the entries the others are reading or evicting
+        cache = check_dvcs.HttpCache(str(tmp_path), max_bytes=2000)
+        errors = []
+
+        def use_cache(worker):
+            try:
+                for index in range(50):
+                    url = f'https://example.com/{worker}/{index % 5}'
+                    cache.put(url, f'"{index}"', None, {}, 'x' * 300)
+                    cache.get(url)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=use_cache, args=(worker,)) for worker in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+
+    def test_failed_put(self, tmp_path):
+        cache = check_dvcs.HttpCache(str(tmp_path))
+        with pytest.raises(TypeError):
+            cache.put('https://example.com', None, None, {"unserializable": object()}, 'body')
+        assert list(tmp_path.iterdir()) == []
+
+
+class TestRateLimiter:
+
+    @staticmethod
+    def headers(remaining, reset, used=None, limit=5000):
+        headers = {'X-RateLimit-Limit': str(limit), 'X-RateLimit-Remaining': str(remaining), 'X-RateLimit-Reset': str(reset)}
+        if used is not None:
+            headers['X-RateLimit-Used'] = str(used)
+        return headers
+
+    def rate_limiter(self, **kwargs):
+        # A fake clock starting at 1000 which only moves forward when sleeping
+        sleeps = []
+        return check_dvcs.RateLimiter(clock=lambda: 1000.0 + sum(sleeps), sleep=sleeps.append, **kwargs), sleeps
+
+    def test_budget_used(self):
+        rate_limiter, _ = self.rate_limiter()
+        session = check_dvcs.GitHubSession('1234', rate_limiter=rate_limiter)
+        with requests_mock.Mocker() as m:
+            m.register_uri(
+                'GET',
+                'https://api.github.com/1',
+                [
+                    {'status_code': 200, 'json': [], 'headers': self.headers(4990, 2000, 10)},
+                    {'status_code': 304, 'headers': self.headers(4990, 2000, 10)},
+                    {'status_code': 200, 'json': [], 'headers': self.headers(4988, 2000, 12)},
+                    # The budget reset in between
+                    {'status_code': 200, 'json': [], 'headers': self.headers(4999, 5600, 1)},
+                ],
+            )
+            m.register_uri('POST', 'https://api.github.com/graphql', json={}, headers=self.headers(4999, 2000, 1))
+            for _ in range(4):
+                session.get('https://api.github.com/1')
+            session.post('https://api.github.com/graphql')
+        assert rate_limiter.used() == {'core': 4, 'graphql': 1}
+        assert 'core used 4 (4999 of 5000 left' in rate_limiter.report()
+
+    def test_no_information(self):
+        rate_limiter, _ = self.rate_limiter()
+        assert 'no rate limit information' in rate_limiter.report()
+
+    def test_paces_when_budget_is_low(self):
+        rate_limiter, sleeps = self.rate_limiter(reserve=100)
+        response = mock.Mock(status_code=200, headers=self.headers(50, 1100))
+        rate_limiter.update('https://api.github.com/1', response)
+        rate_limiter.wait('https://api.github.com/2')
+        rate_limiter.wait('https://api.github.com/3')
+        # 50 requests left for 100 seconds, the second request gets the next slot
+        assert sleeps == [pytest.approx(2.0)]
+        rate_limiter.wait('https://api.github.com/graphql')
+        assert len(sleeps) == 1
+
+    def test_reserve_is_share_of_limit(self):
+        rate_limiter, sleeps = self.rate_limiter()
+        # 99 of a GITHUB_TOKEN's 1000 calls left is plenty for a run
+        rate_limiter.update('https://api.github.com/1', mock.Mock(status_code=200, headers=self.headers(99, 4600, limit=1000)))
+        for _ in range(5):
+            rate_limiter.wait('https://api.github.com/2')
+        assert sleeps == []
+        rate_limiter.update('https://api.github.com/1', mock.Mock(status_code=200, headers=self.headers(10, 4600, limit=1000)))
+        rate_limiter.wait('https://api.github.com/2')
+        rate_limiter.wait('https://api.github.com/3')
+        assert len(sleeps) == 1
+
+    def test_pacing_is_capped(self):
+        rate_limiter, sleeps = self.rate_limiter(reserve=100)
+        # 10 requests left for an hour would be 6 minutes apart
+        rate_limiter.update('https://api.github.com/1', mock.Mock(status_code=200, headers=self.headers(10, 4600)))
+        for _ in range(5):
+            rate_limiter.wait('https://api.github.com/2')
+        assert sleeps == [pytest.approx(check_dvcs._RATE_LIMIT_MAX_PACING)] * 4
+
+    def test_waits_for_reset_when_exhausted(self):
+        rate_limiter, sleeps = self.rate_limiter()
+        rate_limiter.update('https://api.github.com/1', mock.Mock(status_code=200, headers=self.headers(0, 1030)))
+        rate_limiter.wait('https://api.github.com/2')
+        assert sleeps == [pytest.approx(30)]
+
+    def test_does_not_wait_too_long(self):
+        rate_limiter, sleeps = self.rate_limiter(max_wait=10)
+        rate_limiter.update('https://api.github.com/1', mock.Mock(status_code=200, headers=self.headers(0, 1030)))
+        rate_limiter.wait('https://api.github.com/2')
+        assert sleeps == []
+
+    def test_retries_secondary_rate_limit(self):
+        rate_limiter, sleeps = self.rate_limiter()
+        session = check_dvcs.GitHubSession('1234', rate_limiter=rate_limiter)
+        with requests_mock.Mocker() as m:
+            m.register_uri(
+                'DELETE',
+                'https://api.github.com/1',
+                [{'status_code': 403, 'headers': {'Retry-After': '5'}}, {'status_code': 429, 'text': 'secondary rate limit'}, {'status_code': 204}],
+            )
+            assert session.delete('https://api.github.com/1').status_code == 204
+        assert sleeps == [5, check_dvcs._SECONDARY_RATE_LIMIT_WAIT]
+
+    def test_retries_primary_rate_limit(self):
+        rate_limiter, sleeps = self.rate_limiter()
+        session = check_dvcs.GitHubSession('1234', rate_limiter=rate_limiter)
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', 'https://api.github.com/1', [{'status_code': 403, 'headers': self.headers(0, 1009)}, {'status_code': 200, 'json': []}])
+            assert session.get('https://api.github.com/1').status_code == 200
+        assert sleeps == [10]
+
+    def test_gives_up(self):
+        rate_limiter, sleeps = self.rate_limiter(max_wait=30)
+        session = check_dvcs.GitHubSession('1234', rate_limiter=rate_limiter)
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', 'https://api.github.com/1', status_code=403, headers={'Retry-After': '1'})
+            m.register_uri('GET', 'https://api.github.com/2', status_code=403, headers={'Retry-After': '3600'})
+            m.register_uri('GET', 'https://api.github.com/3', status_code=403, text='Resource not accessible by integration')
+            assert session.get('https://api.github.com/1').status_code == 403
+            assert len(sleeps) == check_dvcs._RATE_LIMIT_RETRIES
+            assert session.get('https://api.github.com/2').status_code == 403
+            assert session.get('https://api.github.com/3').status_code == 403
+            assert len(sleeps) == check_dvcs._RATE_LIMIT_RETRIES
+
+
+class TestJiraMatcher:
+
+    def test_factored_pattern(self):
+        matcher = check_dvcs.JiraMatcher(['AAP', 'abc', 'ABD', 'AA', 'xyz', 'AAP'])
+        assert matcher.projects == ['aa', 'aap', 'abc', 'abd', 'xyz']
+        assert matcher.pattern == '(?:a(?:a(?:p)?|b[cd])|xyz)-[0-9]+'
+        assert matcher.description == '(AA|AAP|ABC|ABD|XYZ)-[0-9]+'
+
+    @pytest.mark.parametrize(
+        "input,expected_return",
+        [
+            ('AA-1 title', 'AA-1'),
+            ('aap-22 title', 'aap-22'),
+            ('ABD-3', 'ABD-3'),
+            ('AB-1 not a project', None),
+            ('AAPX-1 not a project', None),
+            ('Xyz-9', 'Xyz-9'),
+            (f'{check_dvcs._NO_JIRA_MARKER} title', check_dvcs._NO_JIRA_MARKER),
+            ('title ABC-1', None),
+        ],
+    )
+    def test_match(self, input, expected_return):
+        matcher = check_dvcs.JiraMatcher(['AAP', 'ABC', 'ABD', 'AA', 'XYZ'])
+        assert matcher.match(input) == expected_return
+        assert check_dvcs.does_string_start_with_jira(input, matcher) == expected_return
+
+    def test_many_projects(self):
+        projects = [f'P{index}X' for index in range(500)]
+        matcher = check_dvcs.JiraMatcher(projects)
+        messages = [f'p{index}x-{index} commit' for index in range(500)] + ['P500X-1 unknown project']
+        assert check_dvcs.collect_commit_jira_numbers(messages, matcher=matcher) == [f'p{index}x-{index}' for index in range(500)]
+
+    @pytest.mark.parametrize("projects", [[], [' '], ['AAP', '1AB'], ['A-B']])
+    def test_invalid_projects(self, projects):
+        with pytest.raises(check_dvcs.CommandException):
+            check_dvcs.JiraMatcher(projects)
+
+    def test_load(self, tmp_path):
+        assert check_dvcs.load_jira_matcher() is check_dvcs.default_jira_matcher
+        policy_file = tmp_path / 'policy.json'
+        policy_file.write_text('{"jira_projects": ["ABC"]}')
+        assert check_dvcs.load_jira_matcher('AAP, XYZ', str(policy_file)).projects == ['aap', 'abc', 'xyz']
+        assert check_dvcs.load_jira_matcher(policy_file=str(policy_file)).projects == ['abc']
+        with pytest.raises(check_dvcs.CommandException):
+            check_dvcs.load_jira_matcher(policy_file=str(tmp_path / 'missing.json'))
+
+    @pytest.mark.parametrize("policy", ['{"jira_projects": "AAP"}', '{"jira_projects": ["AAP", 1]}', '{"jira_projects": {"AAP": true}}', '["AAP"]'])
+    def test_load_invalid_policy(self, tmp_path, policy):
+        policy_file = tmp_path / 'policy.json'
+        policy_file.write_text(policy)
+        with pytest.raises(check_dvcs.CommandException, match="policy file"):
+            check_dvcs.load_jira_matcher(policy_file=str(policy_file))
+
+    def test_main(self, capsys):
+        environ['PULL_REQUEST'] = json.dumps(
+            {"title": "ABC-1 title", "head": {"ref": "ABC-1-branch"}, "_links": {"commits": {"href": "https://example.com/commits"}}}
+        )
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', 'https://example.com/commits', json=[{"commit": {"message": "ABC-1 commit"}}])
+            check_dvcs.main(['--dry-run', '--jira-projects', 'AAP,ABC'])
+            with pytest.raises(SystemExit):
+                check_dvcs.main(['--dry-run'])
+        assert "(AAP-[0-9]+)" in capsys.readouterr().out
+
+    def test_main_invalid_projects(self, capsys):
+        with pytest.raises(SystemExit) as e:
+            check_dvcs.main(['--dry-run', '--jira-projects', '1AB'])
+        assert e.value.code == 255
+        assert 'Invalid Jira project keys' in capsys.readouterr().out
+
+
 class TestGetPreviousCommentsUrls:
 
     def test_invalid_url(self):
@@ -67,6 +359,32 @@ class TestGetPreviousCommentsUrls:
             response = check_dvcs.get_previous_comments_urls("https://example.com")
             assert response == expected_result
 
+    def test_newest_first(self):
+        data = bench_check_dvcs.PullRequestData(0, 250, "none")
+        data.comments[10] = f"{check_dvcs.comment_preamble} results which should have been deleted"
+        data.comments[210] = f"{check_dvcs.comment_preamble} a duplicate"
+        server = bench_check_dvcs.GitHubStandIn(data)
+        threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True).start()
+        try:
+            comments = check_dvcs.get_previous_comments(server.pull_request()['_links']['comments']['href'], check_dvcs.GitHubSession(), 'github-actions[bot]')
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert [comment['id'] for comment in comments] == [250, 210]
+        # The first page, then straight to the last one which has the results comments
+        assert server.requests == {"GET": 2}
+
+    def test_bot_login(self):
+        comments = [
+            {"body": f"{check_dvcs.comment_preamble} quoted by a human", "url": "https://example.com/1", "user": {"login": "someone"}},
+            {"body": f"{check_dvcs.comment_preamble} results", "url": "https://example.com/2", "user": {"login": "github-actions[bot]"}},
+        ]
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', 'https://example.com', status_code=200, json=comments)
+            assert check_dvcs.get_previous_comments_urls("https://example.com", bot_login='github-actions[bot]') == ["https://example.com/2"]
+            assert check_dvcs.get_previous_comments_urls("https://example.com") == ["https://example.com/2", "https://example.com/1"]
+            assert m.request_history[0].qs == {'per_page': ['100']}
+
 
 class TestDeletePreviousComments:
 
@@ -105,6 +423,64 @@ class TestDeletePreviousComments:
             assert f'{base_url}3' not in str(ce.value)
             assert f'{base_url}4' not in str(ce.value)
 
+    @pytest.mark.parametrize("concurrency", [1, 3, 20])
+    def test_concurrent_deletes(self, concurrency):
+        base_url = 'https://example.com/'
+        urls = [f'{base_url}{index}' for index in range(10)]
+        with requests_mock.Mocker() as m:
+            for index, url in enumerate(urls):
+                m.register_uri('DELETE', url, status_code=500 if index % 3 == 0 else 204)
+            with pytest.raises(check_dvcs.CommandException) as ce:
+                check_dvcs.delete_previous_comments(urls, check_dvcs.GitHubSession('1234'), concurrency)
+            assert m.call_count == len(urls)
+            assert str(ce.value).split('\n') == [url for index, url in enumerate(urls) if index % 3 == 0]
+
+
+class TestUpsertComment:
+    comments_url = 'https://example.com/comments'
+    previous_comments = [
+        {"url": "https://example.com/comments/1", "created_at": "2024-01-01T00:00:00Z", "id": 1, "body": "old"},
+        {"url": "https://example.com/comments/3", "created_at": "2024-01-03T00:00:00Z", "id": 3, "body": "newest"},
+        {"url": "https://example.com/comments/2", "created_at": "2024-01-02T00:00:00Z", "id": 2, "body": "older"},
+    ]
+
+    def test_creates_comment(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', self.comments_url, status_code=201)
+            check_dvcs.upsert_comment(self.comments_url, [], 'new', check_dvcs.GitHubSession('1234'))
+            assert m.last_request.json() == {"body": "new"}
+
+    def test_failed_create(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', self.comments_url, status_code=403)
+            with pytest.raises(check_dvcs.CommandException):
+                check_dvcs.upsert_comment(self.comments_url, [], 'new', check_dvcs.GitHubSession('1234'))
+
+    def test_unchanged_comment(self):
+        with requests_mock.Mocker() as m:
+            check_dvcs.upsert_comment(self.comments_url, self.previous_comments[1:2], 'newest', check_dvcs.GitHubSession('1234'))
+            assert m.call_count == 0
+
+    def test_updates_newest_and_deletes_duplicates(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('PATCH', 'https://example.com/comments/3', status_code=200)
+            m.register_uri('DELETE', 'https://example.com/comments/1', status_code=204)
+            m.register_uri('DELETE', 'https://example.com/comments/2', status_code=204)
+            check_dvcs.upsert_comment(self.comments_url, self.previous_comments, 'changed', check_dvcs.GitHubSession('1234'))
+            methods = sorted((request.method, request.url) for request in m.request_history)
+            assert methods == [
+                ('DELETE', 'https://example.com/comments/1'),
+                ('DELETE', 'https://example.com/comments/2'),
+                ('PATCH', 'https://example.com/comments/3'),
+            ]
+
+    def test_failed_update(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('PATCH', 'https://example.com/comments/3', status_code=500)
+            with pytest.raises(check_dvcs.CommandException) as ce:
+                check_dvcs.upsert_comment(self.comments_url, self.previous_comments[1:2], 'changed', check_dvcs.GitHubSession('1234'))
+            assert 'https://example.com/comments/3' in str(ce.value)
+
 
 class TestGitCommitJiraNumbers:
 
@@ -154,6 +530,889 @@ class TestGitCommitJiraNumbers:
             response = check_dvcs.get_commit_jira_numbers("https://example.com")
             assert response == expected_result
 
+    def test_follows_pagination(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri(
+                'GET',
+                'https://example.com/commits?per_page=100',
+                status_code=200,
+                json=[{"commit": {"message": "AAP-1 first page"}}],
+                headers={'Link': '<https://example.com/commits?per_page=100&page=2>; rel="next"'},
+            )
+            m.register_uri('GET', 'https://example.com/commits?per_page=100&page=2', status_code=200, json=[{"commit": {"message": "AAP-2 second page"}}])
+            response = check_dvcs.get_commit_jira_numbers("https://example.com/commits")
+            assert response == ['AAP-1', 'AAP-2']
+            assert m.call_count == 2
+
+    def test_stops_when_required_jiras_seen(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri(
+                'GET',
+                'https://example.com/commits?per_page=100',
+                status_code=200,
+                json=[{"commit": {"message": "AAP-1 first"}}, {"commit": {"message": "aap-2 second"}}, {"commit": {"message": "AAP-3 third"}}],
+                headers={'Link': '<https://example.com/commits?per_page=100&page=2>; rel="next"'},
+            )
+            m.register_uri('GET', 'https://example.com/commits?per_page=100&page=2', status_code=500)
+            response = check_dvcs.get_commit_jira_numbers("https://example.com/commits", {'aap-2'})
+            assert response == ['AAP-1', 'aap-2']
+            assert m.call_count == 1
+
+    def test_skips_merge_commits(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri(
+                'GET',
+                'https://example.com',
+                status_code=200,
+                json=[
+                    {"commit": {"message": "AAP-1 merge"}, "parents": [{"sha": "1"}, {"sha": "2"}]},
+                    {"commit": {"message": "AAP-2 commit"}, "parents": [{"sha": "1"}]},
+                ],
+            )
+            assert check_dvcs.get_commit_jira_numbers("https://example.com") == ['AAP-2']
+
+    def test_no_required_jiras_skips_fetch(self):
+        with requests_mock.Mocker() as m:
+            assert check_dvcs.get_commit_jira_numbers("https://example.com/commits", set()) == []
+            assert m.call_count == 0
+
+
+@pytest.fixture
+def git_repository(tmp_path):
+    # A local clone with a base commit, a merge commit and two regular commits on top of it
+    def git(*args):
+        return subprocess.run(
+            ['git', '-C', str(tmp_path), '-c', 'user.name=Test', '-c', 'user.email=test@example.com', *args],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+
+    git('init', '-q', '-b', 'main')
+    git('commit', '-q', '--allow-empty', '-m', 'Base commit')
+    base_sha = git('rev-parse', 'HEAD')
+    git('checkout', '-q', '-b', 'side')
+    git('commit', '-q', '--allow-empty', '-m', 'AAP-3 side commit')
+    git('checkout', '-q', 'main')
+    git('commit', '-q', '--allow-empty', '-m', 'AAP-1 first commit\n\nWith a body')
+    git('merge', '-q', '--no-ff', 'side', '-m', 'AAP-2 merge commit')
+    git('commit', '-q', '--allow-empty', '-m', 'No JIRA in this one')
+    return str(tmp_path), base_sha, git('rev-parse', 'HEAD')
+
+
+class TestGitCommitMessages:
+
+    def test_messages(self, git_repository):
+        path, base_sha, head_sha = git_repository
+        assert check_dvcs.has_local_commits(base_sha, head_sha, path)
+        messages = list(check_dvcs.iter_git_commit_messages(base_sha, head_sha, path))
+        assert messages == ['No JIRA in this one\n', 'AAP-1 first commit\n\nWith a body\n', 'AAP-3 side commit\n']
+        assert check_dvcs.collect_commit_jira_numbers(messages) == ['AAP-1', 'AAP-3']
+
+    def test_early_exit(self, git_repository):
+        path, base_sha, head_sha = git_repository
+        messages = check_dvcs.iter_git_commit_messages(base_sha, head_sha, path)
+        assert check_dvcs.collect_commit_jira_numbers(messages, {'aap-1'}) == ['AAP-1']
+
+    def test_bad_range(self, git_repository):
+        path, base_sha, _ = git_repository
+        with pytest.raises(check_dvcs.CommandException):
+            list(check_dvcs.iter_git_commit_messages(base_sha, '0' * 40, path))
+
+    def test_missing_commits(self, git_repository, tmp_path_factory):
+        path, base_sha, head_sha = git_repository
+        assert not check_dvcs.has_local_commits(base_sha, '0' * 40, path)
+        assert not check_dvcs.has_local_commits(None, head_sha, path)
+        assert not check_dvcs.has_local_commits(base_sha, head_sha, str(tmp_path_factory.mktemp('not_a_repository')))
+
+    def test_shallow_clone(self, git_repository, tmp_path_factory):
+        path, base_sha, head_sha = git_repository
+        clone = str(tmp_path_factory.mktemp('shallow'))
+        subprocess.run(['git', 'clone', '-q', '--depth', '1', f'file://{path}', clone], check=True, capture_output=True)
+        assert not check_dvcs.has_local_commits(base_sha, head_sha, clone)
+
+    def test_main_falls_back_to_api(self, git_repository, capsys):
+        path, base_sha, _ = git_repository
+        environ['PULL_REQUEST'] = json.dumps(
+            {
+                "title": "AAP-9 title",
+                "head": {"ref": "AAP-9-branch", "sha": '0' * 40},
+                "base": {"sha": base_sha},
+                "_links": {"commits": {"href": "https://example.com/commits"}},
+            }
+        )
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', 'https://example.com/commits', json=[{"commit": {"message": "AAP-9 commit"}}])
+            check_dvcs.main(['--dry-run', '--commit-source', 'git', '--repository-path', path])
+        assert 'getting them from the API instead' in capsys.readouterr().out
+
+    def test_main_uses_git(self, git_repository):
+        path, base_sha, head_sha = git_repository
+        environ['PULL_REQUEST'] = json.dumps(
+            {
+                "title": "AAP-1 title",
+                "head": {"ref": "AAP-1-branch", "sha": head_sha},
+                "base": {"sha": base_sha},
+                "_links": {"commits": {"href": "https://example.com/commits"}},
+            }
+        )
+        with requests_mock.Mocker() as m:
+            check_dvcs.main(['--dry-run', '--commit-source', 'git', '--repository-path', path])
+            assert m.call_count == 0
+
+
+class TestIncremental:
+    repository_url = 'https://api.github.com/repos/owner/repo'
+    pull_request = {
+        "title": "AAP-1 title",
+        "head": {"ref": "AAP-1-branch", "sha": "new"},
+        "base": {"sha": "base", "repo": {"url": repository_url}},
+        "_links": {"comments": {"href": f"{repository_url}/issues/1/comments"}, "commits": {"href": f"{repository_url}/pulls/1/commits"}},
+    }
+
+    @staticmethod
+    def state(**kwargs):
+        return {"version": check_dvcs._STATE_VERSION, "base": "base", "head": "old", "jiras": [], "complete": True, **kwargs}
+
+    @staticmethod
+    def commit(message, parents=1):
+        return {"commit": {"message": message}, "parents": [{"sha": str(index)} for index in range(parents)]}
+
+    def test_state_round_trip(self):
+        state = self.state(jiras=['aap-1'])
+        assert check_dvcs.read_state(f"{check_dvcs.comment_preamble}\n* results{check_dvcs.render_state(state)}") == state
+        assert check_dvcs.read_state(check_dvcs.comment_preamble) is None
+        assert check_dvcs.read_state('<!-- dvcs-state: {not json} -->') is None
+
+    @pytest.mark.parametrize(
+        "response,expected_result",
+        [
+            ({"status_code": 200, "json": {"status": "ahead", "commits": []}}, []),
+            ({"status_code": 200, "json": {"status": "identical", "commits": []}}, []),
+            ({"status_code": 200, "json": {"status": "diverged", "commits": []}}, None),
+            ({"status_code": 200, "json": {"status": "behind", "commits": []}}, None),
+            ({"status_code": 404}, None),
+        ],
+    )
+    def test_compare_status(self, response, expected_result):
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', f'{self.repository_url}/compare/old...new', **response)
+            assert check_dvcs.get_compare_commit_messages(check_dvcs.GitHubSession(), self.repository_url, 'old', 'new') == expected_result
+
+    def test_compare_pages_and_merges(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri(
+                'GET',
+                f'{self.repository_url}/compare/old...new?per_page=100',
+                json={"status": "ahead", "commits": [self.commit("AAP-2 one")]},
+                headers={'Link': f'<{self.repository_url}/compare/old...new?per_page=100&page=2>; rel="next"'},
+            )
+            m.register_uri('GET', f'{self.repository_url}/compare/old...new?per_page=100&page=2', json={"status": "ahead", "commits": [self.commit("two")]})
+            assert check_dvcs.get_compare_commit_messages(check_dvcs.GitHubSession(), self.repository_url, 'old', 'new') == ["AAP-2 one", "two"]
+            m.register_uri('GET', f'{self.repository_url}/compare/old...merge', json={"status": "ahead", "commits": [self.commit("Merge", 2)]})
+            assert check_dvcs.get_compare_commit_messages(check_dvcs.GitHubSession(), self.repository_url, 'old', 'merge') is None
+            m.register_uri('GET', f'{self.repository_url}/compare/old...broken', status_code=500)
+            with pytest.raises(check_dvcs.CommandException):
+                check_dvcs.get_compare_commit_messages(check_dvcs.GitHubSession(), self.repository_url, 'old', 'broken')
+
+    @pytest.mark.parametrize(
+        "state,required_jiras",
+        [
+            ({"version": 0}, {'aap-1'}),
+            ({"head": None}, {'aap-1'}),
+            ({"base": "moved"}, {'aap-1'}),
+            ({"complete": False, "jiras": ['aap-2']}, {'aap-1'}),
+            ({"complete": False, "jiras": ['aap-1']}, None),
+        ],
+    )
+    def test_needs_full_scan(self, state, required_jiras):
+        with requests_mock.Mocker() as m:
+            assert check_dvcs.get_incremental_commit_jiras(check_dvcs.GitHubSession(), self.pull_request, self.state(**state), required_jiras) is None
+            assert m.call_count == 0
+
+    def test_merges_new_commits(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', f'{self.repository_url}/compare/old...new', json={"status": "ahead", "commits": [self.commit("AAP-1 fix")]})
+            state = self.state(jiras=['aap-3'], complete=False)
+            assert check_dvcs.get_incremental_commit_jiras(check_dvcs.GitHubSession(), self.pull_request, state, {'aap-3'}) == ['aap-1', 'aap-3']
+
+    def run_main(self, tmp_path, action, previous_body, author='github-actions[bot]'):
+        event_path = tmp_path / 'event.json'
+        event_path.write_text(json.dumps({"action": action, "before": "old", "after": "new"}))
+        comments_url = self.pull_request['_links']['comments']['href']
+        comment = {"url": f"{self.repository_url}/issues/comments/1", "body": previous_body, "created_at": "2024-01-01T00:00:00Z", "user": {"login": author}}
+        with mock.patch.dict(environ, {'PULL_REQUEST': json.dumps(self.pull_request), 'GH_TOKEN': "asdf1234", 'GITHUB_EVENT_PATH': str(event_path)}):
+            with requests_mock.Mocker() as m:
+                m.register_uri('GET', comments_url, json=[comment])
+                m.register_uri('GET', f'{self.repository_url}/compare/old...new', json={"status": "ahead", "commits": [self.commit("AAP-1 fix")]})
+                m.register_uri('GET', self.pull_request['_links']['commits']['href'], json=[self.commit("AAP-1 fix")])
+                m.register_uri('PATCH', f'{self.repository_url}/issues/comments/1', status_code=200)
+                m.register_uri('POST', comments_url, status_code=201)
+                check_dvcs.main(['--incremental', '--comment-mode', 'upsert', '--bot-login', 'github-actions[bot]'])
+                return [(request.method, request.path) for request in m.request_history], m.last_request.json()['body']
+
+    def test_main_synchronize(self, tmp_path):
+        previous_body = f"{check_dvcs.comment_preamble}{check_dvcs.render_state(self.state())}"
+        requests, body = self.run_main(tmp_path, 'synchronize', previous_body)
+        assert requests == [
+            ('GET', '/repos/owner/repo/issues/1/comments'),
+            ('GET', '/repos/owner/repo/compare/old...new'),
+            ('PATCH', '/repos/owner/repo/issues/comments/1'),
+        ]
+        assert check_dvcs.read_state(body).items() >= self.state(head='new', jiras=['aap-1']).items()
+
+    def test_main_other_events_scan_everything(self, tmp_path):
+        previous_body = f"{check_dvcs.comment_preamble}{check_dvcs.render_state(self.state())}"
+        requests, body = self.run_main(tmp_path, 'edited', previous_body)
+        assert ('GET', '/repos/owner/repo/pulls/1/commits') in requests
+        assert ('GET', '/repos/owner/repo/compare/old...new') not in requests
+        assert check_dvcs.read_state(body).items() >= self.state(head='new', jiras=['aap-1'], complete=False).items()
+
+    def test_main_without_state(self, tmp_path):
+        requests, _ = self.run_main(tmp_path, 'synchronize', check_dvcs.comment_preamble)
+        assert ('GET', '/repos/owner/repo/pulls/1/commits') in requests
+
+    def test_main_forged_state(self, tmp_path):
+        # The state in somebody else's comment is never used, every commit is checked and a new results comment is posted
+        previous_body = f"{check_dvcs.comment_preamble}{check_dvcs.render_state(self.state(jiras=['aap-1']))}"
+        requests, _ = self.run_main(tmp_path, 'synchronize', previous_body, author='someone')
+        assert ('GET', '/repos/owner/repo/compare/old...new') not in requests
+        assert ('GET', '/repos/owner/repo/pulls/1/commits') in requests
+        assert requests[-1] == ('POST', '/repos/owner/repo/issues/1/comments')
+
+    def test_main_needs_bot_login(self, capsys):
+        with mock.patch.dict(environ, {'PULL_REQUEST': json.dumps(self.pull_request), 'GH_TOKEN': "asdf1234"}):
+            with pytest.raises(SystemExit) as e:
+                check_dvcs.main(['--incremental'])
+        assert e.value.code == 255
+        assert "--incremental needs --bot-login" in capsys.readouterr().out
+
+
+class TestSkipUnchanged:
+    pull_request = TestIncremental.pull_request
+
+    def fingerprint(self, pull_request=None, title_jira='AAP-1', branch_jira='AAP-1', matcher=check_dvcs.default_jira_matcher, jira_url=None):
+        return check_dvcs.get_fingerprint(pull_request or self.pull_request, title_jira, branch_jira, matcher, jira_url)
+
+    def test_fingerprint(self):
+        fingerprint = self.fingerprint()
+        assert fingerprint == self.fingerprint(dict(self.pull_request, title="AAP-1 another title", body="another body"))
+        assert fingerprint != self.fingerprint(dict(self.pull_request, head={"ref": "AAP-1-branch", "sha": "newer"}))
+        assert fingerprint != self.fingerprint(dict(self.pull_request, base={"ref": "stable"}))
+        assert fingerprint != self.fingerprint(title_jira='AAP-2')
+        assert fingerprint != self.fingerprint(branch_jira=None)
+        assert fingerprint != self.fingerprint(matcher=check_dvcs.JiraMatcher(["AAP", "ABC"]))
+        assert fingerprint != self.fingerprint(jira_url='https://issues.example.com')
+
+    def run_main(self, previous_state, author='github-actions[bot]', args=('--bot-login', 'github-actions[bot]'), commit="AAP-1 fix"):
+        comments_url = self.pull_request['_links']['comments']['href']
+        previous_body = f"{check_dvcs.comment_preamble}\n* previous results{check_dvcs.render_state(previous_state)}"
+        comment = {"url": f"{comments_url}/1", "body": previous_body, "created_at": "2024-01-01T00:00:00Z", "user": {"login": author}}
+        with mock.patch.dict(environ, {'PULL_REQUEST': json.dumps(self.pull_request), 'GH_TOKEN': "asdf1234"}):
+            with requests_mock.Mocker() as m:
+                m.register_uri('GET', comments_url, json=[comment])
+                m.register_uri('DELETE', f"{comments_url}/1", status_code=204)
+                m.register_uri('GET', self.pull_request['_links']['commits']['href'], json=[TestIncremental.commit(commit)])
+                m.register_uri('POST', comments_url, status_code=201)
+                check_dvcs.main(['--skip-unchanged', *args])
+                return m.request_history
+
+    def test_unchanged_passed(self, capsys):
+        requests = self.run_main({"fingerprint": self.fingerprint(), "passed": True})
+        assert [request.method for request in requests] == ['GET']
+        assert "previous results" in capsys.readouterr().out
+
+    def test_unchanged_failed(self):
+        with pytest.raises(SystemExit) as e:
+            self.run_main({"fingerprint": self.fingerprint(), "passed": False})
+        assert e.value.code == 255
+
+    def test_forged_state(self):
+        # A PR author can compute the fingerprint and post results of their own, their comments are not even looked at
+        with pytest.raises(SystemExit) as e:
+            self.run_main({"fingerprint": self.fingerprint(), "passed": True}, author='someone', commit="No JIRA in here")
+        assert e.value.code == 255
+
+    def test_needs_bot_login(self, capsys):
+        with pytest.raises(SystemExit) as e:
+            self.run_main({"fingerprint": self.fingerprint(), "passed": True}, args=())
+        assert e.value.code == 255
+        assert "--skip-unchanged needs --bot-login" in capsys.readouterr().out
+
+    def test_changed(self):
+        requests = self.run_main({"fingerprint": self.fingerprint(title_jira='AAP-2'), "passed": True})
+        # The old comment is deleted while the commits are read
+        assert requests[0].method == 'GET' and requests[-1].method == 'POST'
+        assert sorted(request.method for request in requests[1:-1]) == ['DELETE', 'GET']
+        state = check_dvcs.read_state(requests[-1].json()['body'])
+        assert state['fingerprint'] == self.fingerprint()
+        assert state['passed'] is True
+
+
+class TestCheckRun:
+    repository_url = TestIncremental.repository_url
+    pull_request = TestIncremental.pull_request
+    check_run_url = f"{repository_url}/check-runs/7"
+
+    app = {"slug": "github-actions"}
+
+    def run_main(self, check_runs, commit_message="AAP-1 fix", *args, old_check_runs=(), event_path=None):
+        # The requests made and the exit code, None if it did not exit. old_check_runs are on the previous head "old"
+        environment = {'PULL_REQUEST': json.dumps(self.pull_request), 'GH_TOKEN': "asdf1234", 'GITHUB_EVENT_PATH': str(event_path or '')}
+        with mock.patch.dict(environ, environment):
+            with requests_mock.Mocker() as m:
+                m.register_uri('GET', f"{self.repository_url}/commits/new/check-runs", json={"total_count": len(check_runs), "check_runs": check_runs})
+                m.register_uri('GET', f"{self.repository_url}/commits/old/check-runs", json={"check_runs": list(old_check_runs)})
+                m.register_uri('GET', f'{self.repository_url}/compare/old...new', json={"status": "ahead", "commits": [TestIncremental.commit(commit_message)]})
+                m.register_uri('GET', self.pull_request['_links']['commits']['href'], json=[TestIncremental.commit(commit_message)])
+                m.register_uri('POST', f"{self.repository_url}/check-runs", status_code=201)
+                m.register_uri('PATCH', self.check_run_url, status_code=200)
+                try:
+                    check_dvcs.main(['--output-mode', 'check-run', *args])
+                except SystemExit as e:
+                    return m.request_history, e.code
+                return m.request_history, None
+
+    def test_create(self):
+        requests, code = self.run_main([])
+        assert code is None
+        assert [request.method for request in requests] == ['GET', 'GET', 'POST']
+        check_run_request = next(request for request in requests if request.path.endswith('/check-runs'))
+        assert check_run_request.qs == {'check_name': [check_dvcs._CHECK_RUN_NAME.lower()], 'filter': ['latest']}
+        body = requests[-1].json()
+        assert body['head_sha'] == 'new'
+        assert body['name'] == check_dvcs._CHECK_RUN_NAME
+        assert body['status'] == 'completed'
+        assert body['conclusion'] == 'success'
+        assert body['output']['summary'].startswith(check_dvcs.comment_preamble)
+        assert body['output']['annotations'] == []
+        assert 'text' not in body['output']
+
+    def test_update_failure(self):
+        requests, code = self.run_main([{"id": 7, "url": self.check_run_url, "output": {}}], "no jira here")
+        assert code == 255
+        # No comments are listed, deleted or posted
+        assert [request.method for request in requests] == ['GET', 'GET', 'PATCH']
+        body = requests[-1].json()
+        assert 'head_sha' not in body
+        assert body['conclusion'] == 'failure'
+        assert body['output']['title'] == '1 DVCS rule failed'
+        assert [annotation['title'] for annotation in body['output']['annotations']] == ['Commits']
+
+    def test_skip_unchanged(self):
+        fingerprint = check_dvcs.get_fingerprint(self.pull_request, 'AAP-1', 'AAP-1', check_dvcs.default_jira_matcher)
+        state = check_dvcs.render_state({"fingerprint": fingerprint, "passed": True})
+        check_run = {"id": 7, "url": self.check_run_url, "app": self.app, "output": {"summary": check_dvcs.comment_preamble, "text": state}}
+        requests, code = self.run_main([check_run], "AAP-1 fix", '--skip-unchanged', '--bot-login', 'github-actions[bot]')
+        assert code is None
+        assert [request.method for request in requests] == ['GET']
+
+        # The state is kept in the text of the check run
+        requests, code = self.run_main([dict(check_run, output={})], "AAP-1 fix", '--skip-unchanged', '--bot-login', 'github-actions[bot]')
+        assert [request.method for request in requests] == ['GET', 'GET', 'PATCH']
+        assert check_dvcs.read_state(requests[-1].json()['output']['text'])['fingerprint'] == fingerprint
+
+    def test_skip_unchanged_other_app(self):
+        # Another app can create a check run with our name and a passing state, it is not used
+        fingerprint = check_dvcs.get_fingerprint(self.pull_request, 'AAP-1', 'AAP-1', check_dvcs.default_jira_matcher)
+        state = check_dvcs.render_state({"fingerprint": fingerprint, "passed": True})
+        check_run = {"id": 8, "url": f"{self.repository_url}/check-runs/8", "app": {"slug": "other"}, "output": {"text": state}}
+        requests, code = self.run_main([check_run], "no jira here", '--skip-unchanged', '--bot-login', 'github-actions[bot]')
+        assert code == 255
+        assert [request.method for request in requests] == ['GET', 'GET', 'POST']
+
+    def test_incremental_synchronize(self, tmp_path):
+        # The new head has no check run yet, the state is read from the check run on the head before the push
+        event_path = tmp_path / 'event.json'
+        event_path.write_text(json.dumps({"action": "synchronize", "before": "old", "after": "new"}))
+        state = check_dvcs.render_state(TestIncremental.state(jiras=['aap-1']))
+        old_check_run = {"id": 6, "url": f"{self.repository_url}/check-runs/6", "app": self.app, "output": {"text": state}}
+        args = ('--incremental', '--bot-login', 'github-actions[bot]')
+        requests, code = self.run_main([], "Unrelated change", *args, old_check_runs=[old_check_run], event_path=event_path)
+        assert code is None
+        assert [(request.method, request.path) for request in requests] == [
+            ('GET', '/repos/owner/repo/commits/new/check-runs'),
+            ('GET', '/repos/owner/repo/commits/old/check-runs'),
+            ('GET', '/repos/owner/repo/compare/old...new'),
+            ('POST', '/repos/owner/repo/check-runs'),
+        ]
+        body = requests[-1].json()
+        assert body['head_sha'] == 'new'
+        assert check_dvcs.read_state(body['output']['text']).items() >= TestIncremental.state(head='new', jiras=['aap-1']).items()
+
+
+class StandIn(BaseHTTPRequestHandler):
+    # The base of the local keep-alive stand-ins for the GitHub and Jira APIs, see the serve fixture
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, payload=None, headers=None):
+        body = b'' if payload is None else json.dumps(payload).encode()
+        self.send_response(status)
+        for name, value in {'Content-Type': 'application/json', 'Content-Length': str(len(body)), **(headers or {})}.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def serve():
+    # serve(handler_cls, **attrs) starts a server for a subclass of handler_cls with attrs set on it, returns the subclass and the server's URL
+    servers = []
+
+    def start(handler_cls, **attrs):
+        handler = type('Handler', (handler_cls,), attrs)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True).start()
+        servers.append(server)
+        return handler, f'http://127.0.0.1:{server.server_address[1]}'
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+class OverlapStandIn(StandIn):
+    # Serves a PR with one old results comment, which can only be deleted once the commits were asked for
+    commits_requested: threading.Event
+
+    def do_GET(self):
+        host = self.headers['Host']
+        if urlsplit(self.path).path == '/comments':
+            self.reply(200, [{"url": f"http://{host}/comments/1", "body": f"{check_dvcs.comment_preamble} old results"}])
+        else:
+            self.commits_requested.set()
+            self.reply(200, [TestIncremental.commit("AAP-1 fix")])
+
+    def do_DELETE(self):
+        self.reply(204 if self.commits_requested.wait(5) else 504)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.reply(201, {})
+
+
+class TestConcurrentFetch:
+    pull_request = TestIncremental.pull_request
+
+    def test_deletes_while_reading_commits(self, serve):
+        _, url = serve(OverlapStandIn, commits_requested=threading.Event())
+        pull_request = dict(self.pull_request, _links={"comments": {"href": f"{url}/comments"}, "commits": {"href": f"{url}/commits"}})
+        session = check_dvcs.GitHubSession("asdf1234")
+        # Deleting the old comment would time out if the commits were only read after it
+        assert check_dvcs.check_and_report(check_dvcs.build_parser().parse_args([]), pull_request, session, False, check_dvcs.default_jira_matcher)
+
+        # The requests of each thread count towards its own phase
+        phases = session.metrics.to_dict()['phases']
+        assert phases['list comments']['statuses'] == {'200': 1}
+        assert phases['delete comments']['statuses'] == {'204': 1}
+        assert phases['get commits']['statuses'] == {'200': 1}
+        assert phases['post comment']['statuses'] == {'201': 1}
+
+    def test_delete_fails_after_reading_commits(self):
+        comments_url = self.pull_request['_links']['comments']['href']
+        args = check_dvcs.build_parser().parse_args([])
+        with requests_mock.Mocker() as m:
+            m.get(comments_url, json=[{"url": f"{comments_url}/1", "body": f"{check_dvcs.comment_preamble} old results"}])
+            m.delete(f"{comments_url}/1", status_code=403)
+            m.get(self.pull_request['_links']['commits']['href'], json=[TestIncremental.commit("AAP-1 fix")])
+            with pytest.raises(check_dvcs.CommandException) as ce:
+                check_dvcs.check_and_report(args, self.pull_request, check_dvcs.GitHubSession("asdf1234"), False, check_dvcs.default_jira_matcher)
+            assert "Failed to delete one or more comments" in str(ce.value)
+            # Nothing is posted
+            assert 'POST' not in [request.method for request in m.request_history]
+
+    def test_graphql_replace(self, graphql_server):
+        handler, url = graphql_server
+        handler.pull_request = {
+            "title": "AAP-1 title",
+            "headRefName": "AAP-1-branch",
+            "commits": ["AAP-1 commit"],
+            "comments": [{"databaseId": 11, "body": f"{check_dvcs.comment_preamble} old results", "createdAt": ""}],
+        }
+        pull_request = {**TestGraphQLPullRequest.pull_request, "_links": {"comments": {"href": "https://api.example.com/repos/owner/repo/issues/7/comments"}}}
+        args = check_dvcs.build_parser().parse_args(['--backend', 'graphql'])
+        with mock.patch.dict(environ, {'GITHUB_GRAPHQL_URL': url}):
+            with requests_mock.Mocker(real_http=True) as m:
+                m.delete("https://api.example.com/repos/owner/repo/issues/comments/11", status_code=204)
+                m.post(pull_request['_links']['comments']['href'], status_code=201)
+                assert check_dvcs.check_and_report(args, pull_request, check_dvcs.GitHubSession("asdf1234"), False, check_dvcs.default_jira_matcher)
+                # The old results comment from the GraphQL query is deleted
+                assert [request.method for request in m.request_history if 'example.com' in request.url] == ['DELETE', 'POST']
+        assert len(handler.queries) == 1
+
+
+class TestLogging:
+    pull_request = TestIncremental.pull_request
+
+    def run_main(self, capsys, *args):
+        comments_url = self.pull_request['_links']['comments']['href']
+        with mock.patch.dict(environ, {'PULL_REQUEST': json.dumps(self.pull_request), 'GH_TOKEN': "asdf1234"}):
+            with requests_mock.Mocker() as m:
+                m.register_uri('GET', comments_url, json=[{"url": f"{comments_url}/1", "body": "a private comment"}])
+                m.register_uri('GET', self.pull_request['_links']['commits']['href'], json=[{"commit": {"message": "AAP-1 a private commit"}}])
+                m.register_uri('POST', comments_url, status_code=201)
+                check_dvcs.main(list(args))
+        return capsys.readouterr().out
+
+    def test_quiet_by_default(self, capsys):
+        output = self.run_main(capsys)
+        assert "a private" not in output
+        assert "Found 0 results comments out of 1 comments" in output
+        assert "Checked 1 commits in" in output
+        assert "found JIRA numbers: AAP-1" in output
+
+    def test_verbose(self, capsys):
+        output = self.run_main(capsys, '--verbose')
+        assert "Checking if a private comment starts with" in output
+        assert "Checking if AAP-1 a private commit has a JIRA number in it ... Good: AAP-1" in output
+
+    def test_json(self, capsys):
+        entries = [json.loads(line) for line in self.run_main(capsys, '--log-format', 'json').splitlines()]
+        assert all(entry['level'] == 'info' for entry in entries)
+        commits = next(entry for entry in entries if 'commits' in entry)
+        assert commits['jiras'] == ['AAP-1']
+        assert next(entry for entry in entries if 'passed' in entry)['passed'] is True
+
+
+class TestMetrics:
+    def test_phases(self):
+        now = [0.0]
+        metrics = check_dvcs.Metrics(clock=lambda: now[0])
+        session = check_dvcs.GitHubSession(max_retries=0, metrics=metrics)
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', 'https://example.com/comments', text='[1, 2]')
+            m.register_uri('POST', 'https://example.com/comments', status_code=201, text='{}')
+            m.register_uri('DELETE', 'https://example.com/comments/1', status_code=404)
+            with metrics.phase("list comments"):
+                session.get('https://example.com/comments')
+                session.delete('https://example.com/comments/1')
+                now[0] += 2
+            with metrics.phase("post comment"):
+                session.post('https://example.com/comments', json={"body": "results"})
+                now[0] += 1
+        result = metrics.to_dict()
+        assert result['phases']['list comments'] == {"seconds": 2, "requests": 2, "bytes_sent": 0, "bytes_received": 6, "statuses": {"200": 1, "404": 1}}
+        assert result['phases']['post comment']['bytes_sent'] == len('{"body": "results"}')
+        assert result['seconds'] == 3
+        assert result['requests'] == 3
+        assert result['statuses'] == {"200": 1, "201": 1, "404": 1}
+        assert metrics.current_phase == "setup"
+        summary = metrics.render_summary()
+        assert "| list comments | 2.00 | 2 | 0 | 6 | 200: 1, 404: 1 |" in summary
+        assert "| **total** | 3.00 | 3 |" in summary
+
+    def test_main_writes_metrics(self, tmp_path):
+        pull_request = TestIncremental.pull_request
+        comments_url = pull_request['_links']['comments']['href']
+        summary_path = tmp_path / 'summary.md'
+        summary_path.write_text("Earlier step\n")
+        with mock.patch.dict(environ, {'PULL_REQUEST': json.dumps(pull_request), 'GH_TOKEN': "asdf1234"}):
+            with requests_mock.Mocker() as m:
+                m.register_uri('GET', comments_url, json=[{"url": f"{comments_url}/1", "body": check_dvcs.comment_preamble}])
+                m.register_uri('DELETE', f"{comments_url}/1", status_code=204)
+                m.register_uri('GET', pull_request['_links']['commits']['href'], json=[{"commit": {"message": "AAP-1 commit"}}])
+                m.register_uri('POST', comments_url, status_code=201)
+                check_dvcs.main(['--metrics-file', str(tmp_path / 'metrics.json'), '--step-summary', str(summary_path)])
+        phases = json.loads((tmp_path / 'metrics.json').read_text())['phases']
+        assert {name: phase['requests'] for name, phase in phases.items()} == {
+            "list comments": 1,
+            "delete comments": 1,
+            "get commits": 1,
+            "make decisions": 0,
+            "post comment": 1,
+        }
+        assert phases['post comment']['statuses'] == {"201": 1}
+        summary = summary_path.read_text()
+        assert summary.startswith("Earlier step\n### DVCS check metrics")
+        assert "| delete comments |" in summary
+
+
+class TestSnapshot:
+    def test_record_and_replay(self, tmp_path):
+        pull_request = TestIncremental.pull_request
+        comments_url = pull_request['_links']['comments']['href']
+        snapshot = tmp_path / 'snapshot'
+        with mock.patch.dict(environ, {'PULL_REQUEST': json.dumps(pull_request), 'GH_TOKEN': "asdf1234"}):
+            with requests_mock.Mocker() as m:
+                m.register_uri('GET', comments_url, json=[{"url": f"{comments_url}/1", "body": check_dvcs.comment_preamble}])
+                m.register_uri('DELETE', f"{comments_url}/1", status_code=204)
+                m.register_uri('GET', pull_request['_links']['commits']['href'], json=[{"commit": {"message": "AAP-1 ünïcödé commit"}}])
+                m.register_uri('POST', comments_url, status_code=201)
+                check_dvcs.main(['--transport', 'requests', '--record', str(snapshot), '--metrics-file', str(tmp_path / 'recorded.json')])
+        assert json.loads((snapshot / 'pull_request.json').read_text()) == pull_request
+        exchanges = (snapshot / 'exchanges.jsonl').read_text()
+        assert "asdf1234" not in exchanges
+        assert sorted((exchange['method'], exchange['status']) for exchange in map(json.loads, exchanges.splitlines())) == [
+            ("DELETE", 204),
+            ("GET", 200),
+            ("GET", 200),
+            ("POST", 201),
+        ]
+
+        # Neither PULL_REQUEST, a token nor the network is needed to replay the run
+        with mock.patch.dict(environ, {'PULL_REQUEST': "", 'GH_TOKEN': ""}):
+            with mock.patch('check_dvcs.UrllibSession._connect', side_effect=AssertionError("No connections in replay mode")):
+                check_dvcs.main(['--transport', 'urllib', '--replay', str(snapshot), '--metrics-file', str(tmp_path / 'replayed.json')])
+        recorded = json.loads((tmp_path / 'recorded.json').read_text())
+        replayed = json.loads((tmp_path / 'replayed.json').read_text())
+        for name, phase in recorded['phases'].items():
+            assert {key: phase[key] for key in ('requests', 'bytes_sent', 'bytes_received', 'statuses')} == {
+                key: replayed['phases'][name][key] for key in ('requests', 'bytes_sent', 'bytes_received', 'statuses')
+            }
+
+    def test_replay(self, tmp_path):
+        recorder = check_dvcs.HttpSnapshot(str(tmp_path))
+        session = check_dvcs.GitHubSession(max_retries=0, transport='requests', snapshot=recorder)
+        with requests_mock.Mocker() as m:
+            link = {'Link': '<https://example.com/items>; rel="prev"'}
+            m.register_uri('GET', 'https://example.com/items?page=2', [{'json': [1]}, {'json': [2], 'headers': link}])
+            m.register_uri('POST', 'https://example.com/items', [{'status_code': 201, 'json': {"id": 1}}, {'status_code': 201, 'json': {"id": 2}}])
+            assert session.get('https://example.com/items', params={'page': 2}).json() == [1]
+            assert list(session.iter_items('https://example.com/items', params={'page': 2})[1]) == [2]
+            assert session.post('https://example.com/items', json={"item": 2}).json() == {"id": 1}
+            assert session.post('https://example.com/items', json={"item": 1}).json() == {"id": 2}
+        recorder.close()
+
+        replayer = check_dvcs.HttpSnapshot(str(tmp_path), replay=True, latency=0.25)
+        session = check_dvcs.GitHubSession(max_retries=0, transport='urllib', snapshot=replayer)
+        with mock.patch('time.sleep') as sleep:
+            # The same request gets the recorded responses in order, requests with another body are told apart
+            assert session.get('https://example.com/items', params={'page': 2}).json() == [1]
+            response, items = session.iter_items('https://example.com/items', params={'page': 2})
+            assert list(items) == [2]
+            assert response.links['prev']['url'] == 'https://example.com/items'
+            assert session.post('https://example.com/items', json={"item": 1}).json() == {"id": 2}
+            assert session.post('https://example.com/items', json={"item": 2}).json() == {"id": 1}
+        assert sleep.call_args_list == [mock.call(0.25)] * 4
+        assert session.metrics.to_dict()['bytes_received'] == len(b'[1][2]{"id": 2}{"id": 1}')
+        with pytest.raises(ConnectionError, match="is not in the snapshot"):
+            session.get('https://example.com/items', params={'page': 2})
+
+    def test_replay_missing_snapshot(self, tmp_path, capsys):
+        with pytest.raises(SystemExit) as e:
+            check_dvcs.main(['--replay', str(tmp_path / 'missing')])
+        assert e.value.code == 255
+        assert "Failed to open the snapshot" in capsys.readouterr().out
+
+    def test_server_rejects_snapshots(self, tmp_path):
+        with pytest.raises(SystemExit) as e:
+            server_check_dvcs.main(['--record', str(tmp_path)])
+        assert e.value.code == 2
+
+
+class TestGetRequiredCommitJiras:
+
+    @pytest.mark.parametrize(
+        "pr_title_jira,source_branch_jira,expected_result",
+        [
+            (None, None, None),
+            (check_dvcs._NO_JIRA_MARKER, 'AAP-1', set()),
+            ('AAP-1', None, {'aap-1'}),
+            (None, 'AAP-2', {'aap-2'}),
+            ('AAP-1', 'aap-1', {'aap-1'}),
+            ('AAP-1', 'AAP-2', {'aap-1', 'aap-2'}),
+        ],
+    )
+    def test_required_jiras(self, pr_title_jira, source_branch_jira, expected_result):
+        assert check_dvcs.get_required_commit_jiras(pr_title_jira, source_branch_jira) == expected_result
+
+
+class GraphQLStandIn(StandIn):
+    # A local stand-in for the GitHub GraphQL API serving a single PR, cursors are plain offsets
+    pull_request: dict = {}
+    queries: list = []
+
+    @staticmethod
+    def page(items, cursor, page_size):
+        start = int(cursor or 0)
+        end = min(start + page_size, len(items))
+        return {"pageInfo": {"hasNextPage": end < len(items), "endCursor": str(end)}, "nodes": items[start:end]}
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.queries.append(request)
+        variables = request['variables']
+        result = {"title": self.pull_request['title'], "headRefName": self.pull_request['headRefName']}
+        if variables['withCommits']:
+            # Plain commit messages have a single parent, (message, parent count) tuples can describe merge commits
+            commits = [
+                {"commit": {"message": message, "parents": {"totalCount": parents}}}
+                for message, parents in (commit if isinstance(commit, tuple) else (commit, 1) for commit in self.pull_request['commits'])
+            ]
+            result['commits'] = self.page(commits, variables['commitsCursor'], variables['pageSize'])
+        if variables['withComments']:
+            result['comments'] = self.page(self.pull_request['comments'], variables['commentsCursor'], variables['pageSize'])
+        self.reply(200, {"data": {"repository": {"pullRequest": result}}})
+
+
+@pytest.fixture
+def graphql_server(serve):
+    handler, url = serve(GraphQLStandIn, pull_request={}, queries=[])
+    return handler, f'{url}/graphql'
+
+
+class TestGraphQLPullRequest:
+    pull_request = {"number": 7, "base": {"repo": {"full_name": "owner/repo", "url": "https://api.example.com/repos/owner/repo"}}}
+
+    def test_single_round_trip(self, graphql_server):
+        handler, url = graphql_server
+        handler.pull_request = {
+            "title": "AAP-1 title",
+            "headRefName": "AAP-1-branch",
+            "commits": ["First commit", ("AAP-2 merge commit", 2), "AAP-1 second commit"],
+            "comments": [
+                {"databaseId": 10, "body": "Human comment", "createdAt": "2024-01-01T00:00:00Z", "author": {"__typename": "User", "login": "someone"}},
+                {
+                    "databaseId": 11,
+                    "body": f"{check_dvcs.comment_preamble} old results",
+                    "createdAt": "2024-01-02T00:00:00Z",
+                    "author": {"__typename": "Bot", "login": "github-actions"},
+                },
+            ],
+        }
+        graphql_pull_request = check_dvcs.GraphQLPullRequest(check_dvcs.GitHubSession('1234'), url, self.pull_request)
+        assert graphql_pull_request.title == "AAP-1 title"
+        assert graphql_pull_request.head_ref == "AAP-1-branch"
+        assert graphql_pull_request.comments == [
+            {
+                "id": 11,
+                "url": "https://api.example.com/repos/owner/repo/issues/comments/11",
+                "body": f"{check_dvcs.comment_preamble} old results",
+                "created_at": "2024-01-02T00:00:00Z",
+                "user": {"login": "github-actions[bot]"},
+            }
+        ]
+        assert list(graphql_pull_request.iter_commit_messages()) == ["First commit", "AAP-1 second commit"]
+        assert len(handler.queries) == 1
+        assert handler.queries[0]['variables']['owner'] == 'owner'
+        assert handler.queries[0]['variables']['name'] == 'repo'
+        assert handler.queries[0]['variables']['number'] == 7
+
+    def test_pagination_and_early_exit(self, graphql_server):
+        handler, url = graphql_server
+        handler.pull_request = {
+            "title": "AAP-1 title",
+            "headRefName": "AAP-1-branch",
+            "commits": [f"Commit {index}" for index in range(150)] + ["AAP-1 found it"] + [f"Commit {index}" for index in range(200)],
+            "comments": [{"databaseId": index, "body": f"{check_dvcs.comment_preamble} {index}", "createdAt": ""} for index in range(120)],
+        }
+        graphql_pull_request = check_dvcs.GraphQLPullRequest(check_dvcs.GitHubSession('1234'), url, self.pull_request)
+        assert len(graphql_pull_request.comments) == 120
+        assert len(handler.queries) == 2
+        jiras = check_dvcs.collect_commit_jira_numbers(graphql_pull_request.iter_commit_messages(), {'aap-1'})
+        assert jiras == ['AAP-1']
+        # The second page of commits was needed, the last one wasn't
+        assert len(handler.queries) == 3
+
+    def test_bot_login(self, graphql_server):
+        handler, url = graphql_server
+        handler.pull_request = {
+            "title": "AAP-1 title",
+            "headRefName": "AAP-1-branch",
+            "commits": [],
+            "comments": [
+                {"databaseId": 10, "body": f"{check_dvcs.comment_preamble} ours", "createdAt": "", "author": {"__typename": "Bot", "login": "github-actions"}},
+                # A user can't have the [bot] suffix, but may be called like the app
+                {"databaseId": 11, "body": f"{check_dvcs.comment_preamble} fake", "createdAt": "", "author": {"__typename": "User", "login": "github-actions"}},
+                # Comments of deleted users have no author
+                {"databaseId": 12, "body": f"{check_dvcs.comment_preamble} ghost", "createdAt": "", "author": None},
+            ],
+        }
+        graphql_pull_request = check_dvcs.GraphQLPullRequest(check_dvcs.GitHubSession('1234'), url, self.pull_request, 'github-actions[bot]')
+        assert [comment["id"] for comment in graphql_pull_request.comments] == [10]
+        graphql_pull_request = check_dvcs.GraphQLPullRequest(check_dvcs.GitHubSession('1234'), url, self.pull_request)
+        assert [comment["id"] for comment in graphql_pull_request.comments] == [10, 11, 12]
+
+    def test_errors(self, graphql_server):
+        _, url = graphql_server
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', url, status_code=200, json={"errors": [{"message": "Could not resolve to a Repository"}]})
+            with pytest.raises(check_dvcs.CommandException) as ce:
+                check_dvcs.GraphQLPullRequest(check_dvcs.GitHubSession('1234'), url, self.pull_request)
+            assert 'Could not resolve to a Repository' in str(ce.value)
+            m.register_uri('POST', url, status_code=502)
+            with pytest.raises(check_dvcs.CommandException):
+                check_dvcs.GraphQLPullRequest(check_dvcs.GitHubSession('1234'), url, self.pull_request)
+
+    def test_main(self, graphql_server, capsys):
+        handler, url = graphql_server
+        handler.pull_request = {"title": "AAP-2 title", "headRefName": "AAP-2-branch", "commits": ["AAP-2 commit"], "comments": []}
+        environ['PULL_REQUEST'] = json.dumps({**self.pull_request, "title": "stale title"})
+        with mock.patch.dict(environ, {'GITHUB_GRAPHQL_URL': url}):
+            check_dvcs.main(['--dry-run', '--backend', 'graphql'])
+        output = capsys.readouterr()
+        assert check_dvcs.bad_icon not in output.out
+        assert len(handler.queries) == 1
+
+
+class TestAudit:
+
+    @staticmethod
+    def pull_request(repository, number, title, branch):
+        return {
+            "number": number,
+            "html_url": f"https://github.com/{repository}/pull/{number}",
+            "title": title,
+            "head": {"ref": branch},
+            "_links": {"commits": {"href": f"https://api.github.com/repos/{repository}/pulls/{number}/commits"}},
+        }
+
+    def register(self, m):
+        m.register_uri(
+            'GET',
+            'https://api.github.com/repos/owner/a/pulls?state=open',
+            json=[self.pull_request('owner/a', 1, 'AAP-1 good', 'AAP-1-branch'), self.pull_request('owner/a', 2, 'Bad title', 'branch')],
+        )
+        m.register_uri('GET', 'https://api.github.com/repos/owner/b/pulls?state=open', json=[self.pull_request('owner/b', 3, 'AAP-3 title', 'AAP-3')])
+        m.register_uri('GET', 'https://api.github.com/repos/owner/a/pulls/1/commits', json=[{"commit": {"message": "AAP-1 commit"}}])
+        m.register_uri('GET', 'https://api.github.com/repos/owner/a/pulls/2/commits', json=[{"commit": {"message": "no jira"}}])
+        m.register_uri('GET', 'https://api.github.com/repos/owner/b/pulls/3/commits', status_code=500)
+
+    def test_jsonl_report(self, tmp_path):
+        report = tmp_path / 'report.jsonl'
+        with mock.patch.dict(environ, {'GITHUB_API_URL': 'https://api.github.com'}):
+            with requests_mock.Mocker() as m:
+                self.register(m)
+                with pytest.raises(SystemExit) as e:
+                    check_dvcs.main(['--repos', 'owner/a, owner/b', '--report', str(report), '--max-retries', '0'])
+                assert e.value.code == 255
+                assert {request.method for request in m.request_history} == {'GET'}
+
+        rows = {row['number']: row for row in map(json.loads, report.read_text().splitlines())}
+        assert set(rows) == {1, 2, 3}
+        assert rows[1]['passed'] is True
+        assert rows[1]['commit_jiras'] == ['AAP-1']
+        assert rows[2]['passed'] is False
+        assert rows[2]['repository'] == 'owner/a'
+        assert rows[3]['passed'] is None
+        assert '500' in rows[3]['error']
+
+    def test_csv_report(self, tmp_path, capsys):
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', 'https://api.github.com/repos/owner/a/pulls?state=closed', json=[self.pull_request('owner/a', 1, 'AAP-1 good', 'AAP-1-b')])
+            m.register_uri('GET', 'https://api.github.com/repos/owner/a/pulls/1/commits', json=[{"commit": {"message": "AAP-1 commit"}}])
+            check_dvcs.main(['--repos', 'owner/a', '--state', 'closed', '--report-format', 'csv'])
+        output = capsys.readouterr()
+        lines = output.out.splitlines()
+        assert lines[0] == ','.join(check_dvcs._AUDIT_FIELDS)
+        assert lines[1].startswith('owner/a,1,https://github.com/owner/a/pull/1,AAP-1 good,AAP-1-b,True,AAP-1,AAP-1,AAP-1,,')
+        assert 'Checked 1 PRs, 0 would fail DVCS' in output.err
+
+    def test_listing_error(self, tmp_path):
+        report = tmp_path / 'report.jsonl'
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', 'https://api.github.com/repos/owner/missing/pulls', status_code=404)
+            with pytest.raises(SystemExit):
+                check_dvcs.main(['--repos', 'owner/missing', '--report', str(report)])
+        row = json.loads(report.read_text())
+        assert row['repository'] == 'owner/missing'
+        assert '404' in row['error']
+
 
 class TestMain:
 
@@ -215,7 +1474,7 @@ class TestMain:
         environ['GH_TOKEN'] = "asdf1234"
         with mock.patch('check_dvcs.get_previous_comments_urls', return_value=[]):
             with mock.patch('check_dvcs.get_commit_jira_numbers', return_value=[]):
-                with mock.patch('check_dvcs.make_decisions', return_value=""):
+                with mock.patch('check_dvcs.decide', return_value=check_dvcs.DecisionResult(None, None, [], [])):
                     with requests_mock.Mocker() as m:
                         m.register_uri('POST', 'https://example.com', status_code=404)
                         check_dvcs.main()  # We don't raise an exception for this.
@@ -233,6 +1492,15 @@ class TestMain:
                         check_dvcs.main()
                     assert e.value.code == 255
 
+    def test_upsert_unchanged_results(self):
+        environ['PULL_REQUEST'] = '{"title": "NO_JIRA junk", "_links": {"comments": {"href": "https://example.com"}}}'
+        environ['GH_TOKEN'] = "asdf1234"
+        body = check_dvcs.make_decisions(check_dvcs._NO_JIRA_MARKER, [], None)
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', 'https://example.com', status_code=200, json=[{"url": "https://example.com/1", "body": body}])
+            check_dvcs.main(['--comment-mode', 'upsert'])
+            assert [request.method for request in m.request_history] == ['GET']
+
 
 class TestMakeDecisions:
 
@@ -359,3 +1627,515 @@ class TestMakeDecisions:
     def test_decissions_output(self, pr_title_jira, possible_commit_jiras, source_branch_jira, expected_in_message):
         result = check_dvcs.make_decisions(pr_title_jira, possible_commit_jiras, source_branch_jira)
         assert expected_in_message in result
+
+    def test_decide_structured_result(self):
+        commit_jiras = ['AAP-1234', 'aap-1234', 'AAP-5678']
+        result = check_dvcs.decide('AAP-1234', commit_jiras, 'AAP-9999')
+        assert commit_jiras == ['AAP-1234', 'aap-1234', 'AAP-5678']  # The input is not lower cased in place anymore
+        assert result.passed is False
+        assert result.commit_jiras == ['aap-1234', 'aap-5678']
+        assert [(decision.rule, decision.passed) for decision in result.decisions] == [
+            ('title', True),
+            ('source_branch', True),
+            ('title_branch_match', False),
+            ('branch_commits', False),
+        ]
+        assert result.to_markdown() == check_dvcs.make_decisions('AAP-1234', commit_jiras, 'AAP-9999')
+
+        as_dict = json.loads(result.to_json())
+        assert as_dict['passed'] is False
+        assert as_dict['title_jira'] == 'aap-1234'
+        assert as_dict['decisions'][3] == {
+            'rule': 'branch_commits',
+            'passed': False,
+            'label': 'Mismatch',
+            'message': 'No commit with source branch JIRA number',
+            'jiras': ['aap-9999'],
+        }
+
+        annotations = result.to_annotations()
+        assert [annotation['title'] for annotation in annotations] == ['Mismatch', 'Mismatch']
+        assert all(annotation['annotation_level'] == 'failure' for annotation in annotations)
+
+    def test_decide_passed(self):
+        result = check_dvcs.decide('AAP-1234', ['aap-1234'], 'AAP-1234')
+        assert result.passed is True
+        assert result.to_annotations() == []
+        assert check_dvcs.bad_icon not in result.to_markdown()
+
+    def test_results_file(self, tmp_path):
+        results_file = tmp_path / 'results.json'
+        pull_request = {
+            "title": "AAP-1234 title",
+            "head": {"ref": "AAP-1234-branch"},
+            "_links": {"comments": {"href": "https://example.com/comments"}, "commits": {"href": "https://example.com/commits"}},
+        }
+        args = check_dvcs.build_parser().parse_args(['--results-file', str(results_file)])
+        with requests_mock.Mocker() as m:
+            m.get('https://example.com/comments', json=[])
+            m.get('https://example.com/commits', json=[{"commit": {"message": "AAP-1234 fix"}, "parents": [{}]}])
+            m.post('https://example.com/comments', status_code=201)
+            assert check_dvcs.check_and_report(args, pull_request, check_dvcs.GitHubSession("asdf1234"), False, check_dvcs.default_jira_matcher)
+        results = json.loads(results_file.read_text())
+        assert results['passed'] is True
+        assert results['commit_jiras'] == ['aap-1234']
+
+
+class TestJsonArray:
+    document = [
+        {"message": "AAP-1 ünïcödé ✅ split across chunks", "parents": [{"sha": "1"}], "nested": {"list": [1, 2.5, None, True]}},
+        "a string with ] and , and \\\" in it",
+        12345,
+        [],
+        {},
+        1.5,
+        -1.25e-3,
+        2e10,
+        True,
+        False,
+        None,
+        0,
+    ]
+
+    @pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1000])
+    def test_items(self, chunk_size):
+        body = json.dumps(self.document, ensure_ascii=False, indent=1).encode('utf-8')
+        chunks = [body[start : start + chunk_size] for start in range(0, len(body), chunk_size)]
+        assert list(check_dvcs.iter_json_array(chunks)) == self.document
+
+    @pytest.mark.parametrize("split", range(1, 20))
+    def test_scalar_split(self, split):
+        body = b'[1.5,-1e2,true,null]'
+        assert list(check_dvcs.iter_json_array([body[:split], body[split:]])) == [1.5, -100.0, True, None]
+
+    @pytest.mark.parametrize("body", [b'[]', b' [ ] ', b'\n[\n]\n'])
+    def test_empty(self, body):
+        assert list(check_dvcs.iter_json_array([body])) == []
+
+    @pytest.mark.parametrize("body", [b'{"not": "a list"}', b'[1, 2', b'[1 2]', b'[1,]', b'[1] [2]', b''])
+    def test_invalid(self, body):
+        with pytest.raises(ValueError):
+            list(check_dvcs.iter_json_array([body]))
+
+
+class TestBenchmark:
+    def test_parsing(self):
+        result = bench_check_dvcs.measure_parsing(1000)
+        assert result['messages'] == 1000
+        # A single commit at a time instead of the whole page
+        assert result['streamed_peak_bytes'] * 4 < result['full_peak_bytes']
+
+    @pytest.mark.parametrize(
+        "placement,passed,commit_pages",
+        [
+            ("first", True, 1),
+            ("last", True, 3),
+            ("none", False, 3),
+        ],
+    )
+    def test_scenario(self, placement, passed, commit_pages):
+        result = bench_check_dvcs.run_scenario(250, 20, placement, [], repeat=1)
+        assert result['passed'] is passed
+        # The comments, the commit pages, deleting the previous results comment and posting the new one
+        assert result['requests'] == {"GET": 1 + commit_pages, "DELETE": 1, "POST": 1}
+        assert result['peak_bytes'] > 0
+
+
+class TransportStandIn(StandIn):
+    # A keep-alive HTTP server for the urllib transport, /flaky fails with a 503 until `failures` requests have been made
+    requests: list = []
+    failures = 0
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path, dict(self.headers)))
+        if self.path.startswith('/items'):
+            self.reply(200, [1, 2], {'Link': '<http://example.com/items?page=2>; rel="next", <http://example.com/items?page=5>; rel="last"'})
+        elif self.path == '/flaky':
+            self.reply(503 if len(self.requests) <= self.failures else 200, {"ok": True})
+        elif self.path == '/moved':
+            self.reply(301, headers={'Location': '/items?page=1'})
+        elif self.path == '/elsewhere':
+            self.reply(307, headers={'Location': f'http://localhost:{self.server.server_address[1]}/items'})
+        elif self.path == '/etag':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.reply(304, headers={'ETag': '"v1"'})
+            else:
+                self.reply(200, {"cached": True}, {'ETag': '"v1"'})
+        else:
+            self.reply(404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.requests.append(('POST', self.path, dict(self.headers)))
+        self.reply(503 if self.path == '/flaky' else 201, {"received": json.loads(body), "type": self.headers['Content-Type']})
+
+
+@pytest.fixture
+def transport_server(serve):
+    return serve(TransportStandIn, requests=[], failures=0)
+
+
+class TestUrllibTransport:
+    @pytest.mark.parametrize("transport", ['urllib', 'requests'])
+    def test_follows_redirects(self, transport_server, transport):
+        handler, url = transport_server
+        session = check_dvcs.GitHubSession("asdf1234", transport=transport)
+        assert session.get(f'{url}/moved').json() == [1, 2]
+        assert [(method, path) for method, path, _ in handler.requests] == [('GET', '/moved'), ('GET', '/items?page=1')]
+        assert handler.requests[-1][2]['Authorization'] == 'Bearer asdf1234'
+        # The token is not sent to another host
+        assert session.get(f'{url}/elsewhere').json() == [1, 2]
+        assert 'Authorization' not in handler.requests[-1][2]
+
+    def test_keep_alive(self, transport_server):
+        handler, url = transport_server
+        session = check_dvcs.GitHubSession("asdf1234", transport='urllib')
+        for page in range(3):
+            response = session.get(f'{url}/items', params={"page": page})
+            assert response.status_code == 200
+            assert response.json() == [1, 2]
+        assert session._session.connections_opened == 1
+        assert response.links['next']['url'] == 'http://example.com/items?page=2'
+        assert response.headers['content-type'] == response.headers['Content-Type'] == 'application/json'
+        method, path, headers = handler.requests[-1]
+        assert path == '/items?page=2'
+        assert headers['Authorization'] == 'Bearer asdf1234'
+        assert headers['Accept'] == check_dvcs.http_headers['Accept']
+
+    def test_post_json(self, transport_server):
+        _, url = transport_server
+        response = check_dvcs.GitHubSession(transport='urllib').post(f'{url}/echo', json={"body": "results"})
+        assert response.status_code == 201
+        assert response.json() == {"received": {"body": "results"}, "type": "application/json"}
+
+    @pytest.mark.parametrize("failures,expected_status,expected_requests", [(2, 200, 3), (5, 503, 4)])
+    def test_retries_idempotent_requests(self, transport_server, failures, expected_status, expected_requests):
+        handler, url = transport_server
+        handler.failures = failures
+        with mock.patch('check_dvcs.time.sleep'):
+            assert check_dvcs.GitHubSession(transport='urllib', max_retries=3).get(f'{url}/flaky').status_code == expected_status
+        assert len(handler.requests) == expected_requests
+
+    def test_does_not_retry_post(self, transport_server):
+        handler, url = transport_server
+        assert check_dvcs.GitHubSession(transport='urllib', max_retries=3).post(f'{url}/flaky', json={}).status_code == 503
+        assert len(handler.requests) == 1
+
+    def test_connection_errors(self):
+        with socket.socket() as unused:
+            unused.bind(('127.0.0.1', 0))
+            port = unused.getsockname()[1]
+        with pytest.raises(OSError):
+            check_dvcs.GitHubSession(transport='urllib', max_retries=0).get(f'http://127.0.0.1:{port}/')
+        with pytest.raises(ValueError):
+            check_dvcs.GitHubSession(transport='urllib').get('not a url')
+
+    def test_cache(self, transport_server, tmp_path):
+        handler, url = transport_server
+        session = check_dvcs.GitHubSession(transport='urllib', cache=check_dvcs.HttpCache(str(tmp_path)))
+        assert session.get(f'{url}/etag').json() == {"cached": True}
+        response = session.get(f'{url}/etag')
+        assert response.status_code == 200
+        assert response.json() == {"cached": True}
+        assert handler.requests[-1][2]['If-None-Match'] == '"v1"'
+
+    @pytest.mark.parametrize("transport", ['urllib', 'requests'])
+    def test_stream_items(self, transport_server, transport):
+        handler, url = transport_server
+        session = check_dvcs.GitHubSession(transport=transport)
+        response, items = session.iter_items(f'{url}/items')
+        assert response.status_code == 200
+        assert list(items) == [1, 2]
+        # The body is recorded once it was read, the connection is used again after that
+        assert session.metrics.to_dict()['bytes_received'] == len(b'[1, 2]')
+        assert session.get(f'{url}/items').json() == [1, 2]
+        if transport == 'urllib':
+            assert session._session.connections_opened == 1
+
+    def test_streamed_response_body(self, transport_server):
+        # Like requests, the body of a streamed response is read on first use
+        handler, url = transport_server
+        session = check_dvcs.UrllibSession()
+        assert session.request('GET', f'{url}/items', stream=True).json() == [1, 2]
+        assert session.request('GET', f'{url}/items', stream=True).text == '[1, 2]'
+        assert session.connections_opened == 1
+
+    def test_stream_items_stopped_early(self, transport_server):
+        handler, url = transport_server
+        session = check_dvcs.GitHubSession(transport='urllib')
+        _, items = session.iter_items(f'{url}/items')
+        assert next(items) == 1
+        items.close()
+        # The rest of the body is still in the connection, it can't be used again
+        assert session.get(f'{url}/items').json() == [1, 2]
+        assert session._session.connections_opened == 2
+
+    def test_main(self):
+        requests_transport = bench_check_dvcs.run_scenario(250, 20, "last", ['--transport', 'requests'], repeat=1)
+        urllib_transport = bench_check_dvcs.run_scenario(250, 20, "last", ['--transport', 'urllib'], repeat=1)
+        assert urllib_transport['passed'] is requests_transport['passed'] is True
+        assert urllib_transport['requests'] == requests_transport['requests']
+
+
+class JiraStandIn(StandIn):
+    # Answers JQL key searches from `issues`, a dict of issue key to status category
+    issues: dict = {}
+    queries: list = []
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        self.queries.append((url.path, query, self.headers.get('Authorization')))
+        keys = re.findall(r'[A-Z][A-Z0-9_]*-[0-9]+', query['jql'][0])
+        issues = [{"key": key, "fields": {"status": {"statusCategory": {"key": self.issues[key]}}}} for key in keys if key in self.issues]
+        self.reply(200, {"issues": issues})
+
+
+@pytest.fixture
+def jira_server(serve):
+    return serve(JiraStandIn, issues={"AAP-1": "indeterminate", "AAP-2": "done"}, queries=[])
+
+
+class TestJiraValidation:
+    def test_cache_lru_and_ttl(self, tmp_path):
+        now = [1000.0]
+        path = str(tmp_path / 'jira.json')
+        cache = check_dvcs.JiraKeyCache(path, ttl=60, max_size=2, clock=lambda: now[0])
+        cache.put('AAP-1', 'open')
+        cache.put('AAP-2', 'closed')
+        assert cache.get('AAP-1') == 'open'  # AAP-2 is now the least recently used key
+        cache.put('AAP-3', 'missing')
+        assert cache.get('AAP-2') is None
+        cache.save()
+
+        now[0] += 30
+        reloaded = check_dvcs.JiraKeyCache(path, ttl=60, max_size=2, clock=lambda: now[0])
+        assert reloaded.get('AAP-1') == 'open'
+        assert reloaded.get('AAP-3') == 'missing'
+        now[0] += 31
+        assert reloaded.get('AAP-1') is None
+        assert len(reloaded) == 1
+
+    def test_bulk_lookup(self, jira_server, tmp_path):
+        handler, url = jira_server
+        with mock.patch.dict(environ, {'JIRA_TOKEN': 'jira1234'}):
+            args = check_dvcs.build_parser().parse_args(['--jira-url', url, '--jira-cache-file', str(tmp_path / 'jira.json')])
+            validator = check_dvcs.create_jira_validator(args)
+        statuses = validator.statuses(['AAP-1', 'aap-1', 'AAP-2', 'AAP-3'])
+        assert statuses == {'aap-1': 'open', 'aap-2': 'closed', 'aap-3': 'missing'}
+        # One query for all the distinct keys, with the Jira token instead of the GitHub one
+        assert len(handler.queries) == 1
+        path, query, authorization = handler.queries[0]
+        assert path == '/rest/api/2/search'
+        assert query['jql'] == ['key in (AAP-1, AAP-2, AAP-3)']
+        assert query['validateQuery'] == ['false']
+        assert authorization == 'Bearer jira1234'
+
+        # Known keys are served from the cache, also by the next run
+        assert validator.statuses(['AAP-2', 'AAP-4'])['aap-2'] == 'closed'
+        assert handler.queries[1][1]['jql'] == ['key in (AAP-4)']
+        validator = check_dvcs.create_jira_validator(args)
+        assert validator.statuses(['AAP-1', 'AAP-3']) == {'aap-1': 'open', 'aap-3': 'missing'}
+        assert len(handler.queries) == 2
+
+    @pytest.mark.parametrize(
+        "jira,passed,expected_in_message",
+        [
+            ("AAP-1", True, f"* {check_dvcs.good_icon} Jira: All JIRA numbers are open issues"),
+            ("AAP-2", False, f"* {check_dvcs.bad_icon} Jira: aap-2 is closed"),
+            ("AAP-3", False, f"* {check_dvcs.bad_icon} Jira: aap-3 does not exist"),
+        ],
+    )
+    def test_check(self, jira_server, jira, passed, expected_in_message, caplog):
+        handler, url = jira_server
+        caplog.set_level(logging.INFO, logger='check_dvcs')
+        pull_request = dict(TestIncremental.pull_request, title=f"{jira} title", head={"ref": f"{jira}-branch", "sha": "new"})
+        args = check_dvcs.build_parser().parse_args(['--jira-url', url])
+        with requests_mock.Mocker(real_http=True) as m:
+            m.get(pull_request['_links']['commits']['href'], json=[TestIncremental.commit(f"{jira} fix")])
+            assert check_dvcs.check_and_report(args, pull_request, check_dvcs.GitHubSession(), True, check_dvcs.default_jira_matcher) is passed
+        assert expected_in_message in caplog.text
+        assert len(handler.queries) == 1
+
+    def test_no_jira_is_not_looked_up(self, jira_server, caplog):
+        handler, url = jira_server
+        caplog.set_level(logging.INFO, logger='check_dvcs')
+        pull_request = dict(TestIncremental.pull_request, title="AAP-1 title", head={"ref": "NO_JIRA-branch", "sha": "new"})
+        args = check_dvcs.build_parser().parse_args(['--jira-url', url])
+        with requests_mock.Mocker(real_http=True) as m:
+            commits = [TestIncremental.commit("AAP-1 fix"), TestIncremental.commit("NO_JIRA chore")]
+            m.get(pull_request['_links']['commits']['href'], json=commits)
+            check_dvcs.check_and_report(args, pull_request, check_dvcs.GitHubSession(), True, check_dvcs.default_jira_matcher)
+        assert [query['jql'] for _, query, _ in handler.queries] == [['key in (AAP-1)']]
+        assert f"* {check_dvcs.good_icon} Jira: All JIRA numbers are open issues" in caplog.text
+
+    def test_unwritable_cache(self, jira_server, tmp_path, caplog):
+        # The statuses Jira returned are still used when they can't be cached
+        handler, url = jira_server
+        (tmp_path / 'file').write_text('')
+        args = check_dvcs.build_parser().parse_args(['--jira-url', url, '--jira-cache-file', str(tmp_path / 'file' / 'jira.json')])
+        assert check_dvcs.create_jira_validator(args).statuses(['AAP-1', 'AAP-2']) == {'aap-1': 'open', 'aap-2': 'closed'}
+        assert "Failed to save the Jira cache" in caplog.text
+        assert [path.name for path in tmp_path.iterdir()] == ['file']
+
+    def test_jira_down(self, caplog):
+        args = check_dvcs.build_parser().parse_args(['--jira-url', 'http://127.0.0.1:1', '--max-retries', '0'])
+        with requests_mock.Mocker(real_http=True) as m:
+            m.get(TestIncremental.pull_request['_links']['commits']['href'], json=[TestIncremental.commit("AAP-1 fix")])
+            assert check_dvcs.check_and_report(args, TestIncremental.pull_request, check_dvcs.GitHubSession(), True, check_dvcs.default_jira_matcher)
+        assert "Failed to validate the JIRA numbers" in caplog.text
+
+    def test_jira_down_results_are_not_reused(self):
+        # Results which were not validated against Jira are not kept for --skip-unchanged
+        pull_request = TestIncremental.pull_request
+        comments_url = pull_request['_links']['comments']['href']
+        args = check_dvcs.build_parser().parse_args(
+            ['--jira-url', 'http://127.0.0.1:1', '--max-retries', '0', '--skip-unchanged', '--bot-login', 'github-actions[bot]']
+        )
+        with requests_mock.Mocker(real_http=True) as m:
+            m.get(comments_url, json=[])
+            m.get(pull_request['_links']['commits']['href'], json=[TestIncremental.commit("AAP-1 fix")])
+            m.post(comments_url, status_code=201)
+            assert check_dvcs.check_and_report(args, pull_request, check_dvcs.GitHubSession("asdf1234"), False, check_dvcs.default_jira_matcher)
+            state = check_dvcs.read_state(m.last_request.json()['body'])
+        assert state['passed'] is True
+        assert state['fingerprint'] is None
+
+
+class TestStartup:
+    # The action runs the script for every PR event, importing it must stay cheap
+    budget_seconds = 0.25
+
+    def run_python(self, code):
+        return subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=os.path.dirname(check_dvcs.__file__)).stdout
+
+    def test_no_heavy_imports(self):
+        heavy_modules = ('requests', 'urllib3', 'concurrent.futures', 'http.client', 'subprocess', 'csv')
+        loaded = self.run_python(f"import sys, check_dvcs; print(' '.join(m for m in {heavy_modules!r} if m in sys.modules))")
+        assert loaded.strip() == ''
+
+    def test_import_time(self):
+        # The best of a few runs, to keep a busy machine from failing the test
+        code = "import time; started = time.perf_counter(); import check_dvcs; print(time.perf_counter() - started)"
+        timings = [float(self.run_python(code)) for _ in range(3)]
+        assert min(timings) < self.budget_seconds
+
+
+class TestEventQueue:
+    @staticmethod
+    def event(sha, updated_at="2024-01-01T00:00:00Z"):
+        return {"pull_request": {"head": {"sha": sha}, "updated_at": updated_at}}
+
+    def test_coalesces_and_dedupes(self):
+        queue = server_check_dvcs.EventQueue(clock=lambda: 5.0)
+        assert queue.put(('owner/a', 1), self.event('one'), 'delivery-1') == 'queued'
+        assert queue.put(('owner/b', 2), self.event('two'), 'delivery-2') == 'queued'
+        assert queue.put(('owner/a', 1), self.event('three', "2024-01-02T00:00:00Z"), 'delivery-3') == 'coalesced'
+        assert queue.put(('owner/a', 1), self.event('late'), 'delivery-4') == 'coalesced'
+        assert queue.put(('owner/a', 1), self.event('three'), 'delivery-3') == 'duplicate'
+        assert queue.depth() == 2
+        assert queue.stats == {"received": 5, "duplicates": 1, "coalesced": 2}
+        # The PR keeps its place in the line, with the event of its newest update
+        assert queue.get() == (('owner/a', 1), self.event('three', "2024-01-02T00:00:00Z"), 5.0)
+        assert queue.get()[0] == ('owner/b', 2)
+
+    def test_one_check_per_pull_request(self):
+        queue = server_check_dvcs.EventQueue()
+        queue.put(('owner/a', 1), self.event('one'))
+        key, _, _ = queue.get()
+        queue.put(('owner/a', 1), self.event('two'))
+        queue.put(('owner/b', 2), self.event('three'))
+        # owner/a#1 is still being checked, so the next worker gets owner/b#2
+        assert queue.get()[0] == ('owner/b', 2)
+        queue.done(('owner/b', 2))
+        got = []
+        worker = threading.Thread(target=lambda: got.append(queue.get()))
+        worker.start()
+        worker.join(0.1)
+        assert worker.is_alive()
+        queue.done(key)
+        worker.join(1)
+        assert got[0][1] == self.event('two')
+
+    def test_close_drains(self):
+        queue = server_check_dvcs.EventQueue()
+        queue.put(('owner/a', 1), self.event('one'))
+        queue.close()
+        assert queue.get()[0] == ('owner/a', 1)
+        queue.done(('owner/a', 1))
+        assert queue.get() is None
+
+
+class TestWebhookServer:
+    secret = b'webhook secret'
+
+    def test_verify_signature(self):
+        signature = 'sha256=' + hmac.new(self.secret, b'body', hashlib.sha256).hexdigest()
+        assert server_check_dvcs.verify_signature(self.secret, b'body', signature)
+        assert not server_check_dvcs.verify_signature(self.secret, b'other body', signature)
+        assert not server_check_dvcs.verify_signature(b'other secret', b'body', signature)
+        assert not server_check_dvcs.verify_signature(self.secret, b'body', None)
+        assert not server_check_dvcs.verify_signature(self.secret, b'body', signature.replace('sha256=', 'sha1='))
+
+    @pytest.fixture
+    def servers(self):
+        github = bench_check_dvcs.GitHubStandIn(bench_check_dvcs.PullRequestData(150, 3, "last"))
+        github_thread = threading.Thread(target=github.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True)
+        github_thread.start()
+        args = check_dvcs.build_parser().parse_args(['--transport', 'urllib'])
+        session = check_dvcs.create_session(args, "asdf1234", 4)
+        server = server_check_dvcs.DvcsServer(args, session, check_dvcs.default_jira_matcher, self.secret, port=0, workers=2)
+        server.start()
+        yield github, server
+        server.stop()
+        github.shutdown()
+        github.server_close()
+
+    def deliver(self, server, payload, event='pull_request', delivery='delivery-1', secret=None):
+        body = json.dumps(payload).encode()
+        signature = 'sha256=' + hmac.new(secret or self.secret, body, hashlib.sha256).hexdigest()
+        session = check_dvcs.GitHubSession(transport='urllib')
+        url = f'http://127.0.0.1:{server.address[1]}/'
+        headers = {'X-GitHub-Event': event, 'X-GitHub-Delivery': delivery, 'X-Hub-Signature-256': signature, 'Content-Type': 'application/json'}
+        return session._session.request('POST', url, headers=headers, json=payload)
+
+    def test_checks_delivered_pull_requests(self, servers):
+        github, server = servers
+        payload = {"action": "synchronize", "repository": {"full_name": "owner/repo"}, "pull_request": github.pull_request()}
+        assert self.deliver(server, payload, secret=b'wrong').status_code == 401
+        assert self.deliver(server, {"zen": "hi"}, event='ping').json() == {"status": "pong"}
+        assert self.deliver(server, dict(payload, action='labeled'), delivery='delivery-0').json() == {"status": "ignored"}
+        response = self.deliver(server, payload)
+        assert response.status_code == 202
+        assert response.json() == {"status": "queued"}
+        assert self.deliver(server, payload).json() == {"status": "duplicate"}
+
+        deadline = time.monotonic() + 10
+        while server.metrics()['checks']['checked'] < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        metrics = check_dvcs.GitHubSession(transport='urllib').get(f'http://127.0.0.1:{server.address[1]}/metrics').json()
+        assert metrics['queue_depth'] == 0
+        assert metrics['checks']['passed'] == 1
+        assert metrics['checks']['requests'] == github.requests['GET'] + github.requests['DELETE'] + github.requests['POST']
+        assert metrics['latency_seconds']['count'] == 1
+        assert metrics['events'] == {"received": 2, "duplicates": 1, "coalesced": 0}
+        results = [body for body in github.data.comments.values() if body.startswith(check_dvcs.comment_preamble)]
+        assert len(results) == 1
+        assert check_dvcs.bad_icon not in results[0]
+
+    def test_unexpected_error_keeps_the_worker(self, caplog):
+        args = check_dvcs.build_parser().parse_args(['--transport', 'urllib'])
+        session = check_dvcs.GitHubSession(transport='urllib')
+        server = server_check_dvcs.DvcsServer(args, session, check_dvcs.default_jira_matcher, self.secret, port=0, workers=1)
+        with mock.patch('check_dvcs.check_and_report', side_effect=[ValueError("Truncated JSON array"), True]):
+            server.queue.put(('owner/a', 1), {"pull_request": {"head": {"sha": "one"}}})
+            server.queue.put(('owner/b', 2), {"pull_request": {"head": {"sha": "two"}}})
+            server.start()
+            deadline = time.monotonic() + 10
+            while server.metrics()['checks']['checked'] < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            server.stop()
+        assert server.metrics()['checks']['errors'] == 1
+        assert server.metrics()['checks']['passed'] == 1
+        assert "Failed to check owner/a#1" in caplog.text
+        assert "Truncated JSON array" in caplog.text